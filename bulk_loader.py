@@ -0,0 +1,380 @@
+"""
+This module hosts the class BulkLoader.
+BulkLoader is the initial import of a library into an empty (or nearly empty) DB. It runs the ingest of
+MusicMeta, but instead of upserting each album it collects the album and song rows and writes them in large
+batches with COPY FROM STDIN (plain multi-row inserts on SQLite). The secondary indexes and the foreign key
+of song are dropped for the load and built once at the end, together with the search vectors, the
+dimension links, the facet counts and the tag index (see music_index.py).
+Albums already in the DB are skipped: use music_base.py to update them.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import io
+import json
+import os
+import time
+
+from anyio import run
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import is_sqlite  # pylint: disable=import-error
+from music_dims import MusicDimensions  # pylint: disable=import-error
+from music_facets import MusicFacets  # pylint: disable=import-error
+from music_index import DEFAULT_INDEX_PATH, MusicIndex  # pylint: disable=import-error
+from music_fts import ALBUM_VECTOR, SONG_VECTOR  # pylint: disable=import-error
+from music_meta import ALBUM_UPSERT_COLUMNS, SONG_UPSERT_COLUMNS, MusicMeta  # pylint: disable=import-error
+from orm.models import Album  # NOQA # pylint: disable=unused-import, disable=import-error
+from query_cache import bump_library_generation  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+DEFAULT_BATCH_SONGS = 50000
+MAX_EXISTING_ALBUMS = 1000
+
+# Definitions of the dropped indexes and constraints, kept until they are restored in case the load is killed
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser('~'), 'temp', 'bulk_loader_state.json')
+
+LOAD_TABLES = ['album', 'song']
+
+PG_INDEXES_SQL = """
+SELECT indexname, indexdef FROM pg_indexes
+WHERE schemaname = current_schema() AND tablename IN ('album', 'song')
+  AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid IN ('album'::regclass, 'song'::regclass))
+ORDER BY indexname
+"""
+PG_FOREIGN_KEYS_SQL = "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint " \
+                      "WHERE conrelid = 'song'::regclass AND contype = 'f' ORDER BY conname"
+SQLITE_INDEXES_SQL = "SELECT name, sql FROM sqlite_master " \
+                     "WHERE type = 'index' AND tbl_name IN ('album', 'song') AND sql IS NOT NULL ORDER BY name"
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value):
+    """
+    Format a value for COPY in text format.
+    :param value: A Python value
+    :return: A string
+    """
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_rows(cursor, table, columns, rows):
+    """
+    Write rows to a table with COPY FROM STDIN, or a multi-row INSERT on SQLite.
+    :param cursor: DB cursor
+    :param table: Table name
+    :param columns: A list of column names
+    :param rows: A list of tuples
+    :return: void
+    """
+    if not rows:
+        return
+
+    if is_sqlite():
+        cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+                           rows)
+        return
+
+    data = io.StringIO(''.join('\t'.join(copy_value(val) for val in row) + '\n' for row in rows))
+    cursor.cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", data)
+
+
+class BulkLoader(MusicMeta):
+    """
+    This class loads a library into the DB in batches, with the indexes built after the load.
+    """
+
+    def __init__(self, base_dir, batch_songs=DEFAULT_BATCH_SONGS, max_albums=None, state_path=DEFAULT_STATE_PATH,
+                 index_path=DEFAULT_INDEX_PATH):
+        super().__init__(base_dir, max_albums=max_albums, index_path=index_path)
+        self.batch_songs = max(1, int(batch_songs or DEFAULT_BATCH_SONGS))
+        self.state_path = state_path
+        self._known_paths = set()
+        self._albums = {}
+        self._songs = []
+        self.stats = {'albums': 0, 'songs': 0, 'batches': 0, 'copy_seconds': 0.0}
+
+    def album_exists(self, album_path):
+        """
+        Tell whether an album directory is in the DB or in a batch already (read once in prepare()).
+        :param album_path: Album path (relative to the base directory)
+        :return: True if it is, otherwise False
+        """
+        return album_path in self._known_paths
+
+    def tags_to_db(self, dir_tags, from_yaml=None, id_map=None):
+        """
+        Add the album and song rows of a directory to the batch, writing the batch when it is full.
+        :param dir_tags: Tags read from files in a directory (music files)
+        :param from_yaml: Tags read from a YAML file
+        :param id_map: A mapping of track ID's
+        :return: void
+        """
+        album_dict = self.album_field_dict(dir_tags, from_yaml)
+
+        if album_dict['path'] in self._known_paths:
+            return
+
+        # The album ID is only known once the batch is written: songs refer to the album path until then
+        album = Album(**album_dict)  # NOQA
+        song_rows = {}
+
+        for music_tags in dir_tags:
+            song_dict = {**self.song_field_dict(music_tags, album, from_yaml, id_map), 'album_id': album_dict['path']}
+            song_rows[song_dict['file']] = tuple(song_dict[column] for column in SONG_UPSERT_COLUMNS)
+
+        self._known_paths.add(album_dict['path'])
+        self._albums[album_dict['path']] = tuple(album_dict[column] for column in ALBUM_UPSERT_COLUMNS)
+        self._songs += song_rows.values()
+        self.albums_new_mod += 1
+
+        if len(self._songs) >= self.batch_songs:
+            self.write_batch()
+
+    def write_batch(self):
+        """
+        Write the collected albums, then their songs with the album IDs the DB has assigned.
+        :return: void
+        """
+        if not self._albums:
+            return
+
+        start = time.perf_counter()
+        album_ix = SONG_UPSERT_COLUMNS.index('album_id')
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SELECT coalesce(max(id), 0) FROM album")
+            last_id = cursor.fetchone()[0]
+            copy_rows(cursor, 'album', ALBUM_UPSERT_COLUMNS, list(self._albums.values()))
+
+            # IDs are assigned in ascending order and this is the only writer:
+            cursor.execute("SELECT path, id FROM album WHERE id > %s", [last_id])
+            album_ids = dict(cursor.fetchall())
+            copy_rows(cursor, 'song', SONG_UPSERT_COLUMNS,
+                      [row[:album_ix] + (album_ids[row[album_ix]],) + row[album_ix + 1:] for row in self._songs])
+
+        elapsed = time.perf_counter() - start
+        self.stats['albums'] += len(self._albums)
+        self.stats['songs'] += len(self._songs)
+        self.stats['batches'] += 1
+        self.stats['copy_seconds'] += elapsed
+        log_it("info", __name__, f"Batch {self.stats['batches']}: {len(self._albums)} albums, {len(self._songs)} "
+                                 f"songs, {round((len(self._albums) + len(self._songs)) / max(elapsed, 1e-6))} rows/s")
+        self._albums = {}
+        self._songs = []
+
+    @staticmethod
+    def deferred_definitions(cursor):
+        """
+        Read the definitions of what is dropped for the load: secondary indexes of album and song (primary keys
+        stay) and, on PostgreSQL, the foreign keys of song.
+        :param cursor: DB cursor
+        :return: A dictionary with lists of (name, definition) pairs: indexes, foreign_keys
+        """
+        if is_sqlite():
+            cursor.execute(SQLITE_INDEXES_SQL)
+            return {'indexes': cursor.fetchall(), 'foreign_keys': []}
+
+        cursor.execute(PG_INDEXES_SQL)
+        indexes = cursor.fetchall()
+        cursor.execute(PG_FOREIGN_KEYS_SQL)
+
+        return {'indexes': indexes, 'foreign_keys': cursor.fetchall()}
+
+    def prepare(self, force=False):
+        """
+        Check that the DB is (nearly) empty, read the album paths already in it and drop the indexes.
+        :param force: If True, load even if the DB holds more than MAX_EXISTING_ALBUMS albums
+        :return: void
+        """
+        if os.path.exists(self.state_path):
+            raise ValueError(f"Indexes of a previous load have not been restored, run with -R: {self.state_path}")
+
+        self._known_paths = set(Album.objects.values_list('path', flat=True))  # NOQA
+
+        if len(self._known_paths) > MAX_EXISTING_ALBUMS and not force:
+            raise ValueError(f"The DB holds {len(self._known_paths)} albums, use music_base.py or force the load")
+
+        with connection.cursor() as cursor:
+            definitions = self.deferred_definitions(cursor)
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+
+            with open(self.state_path, 'w', encoding="UTF-8") as state_file:
+                json.dump(definitions, state_file, indent=4)
+
+            for name, _ in definitions['foreign_keys']:
+                cursor.execute(f"ALTER TABLE song DROP CONSTRAINT {name}")
+
+            for name, _ in definitions['indexes']:
+                cursor.execute(f"DROP INDEX {name}")
+
+        log_it("info", __name__, f"Dropped {len(definitions['indexes'])} indexes and "
+                                 f"{len(definitions['foreign_keys'])} foreign keys, saved to {self.state_path}")
+
+    def restore(self):
+        """
+        Compute the search vectors, then re-create the dropped indexes and foreign keys.
+        :return: Number of seconds taken
+        """
+        start = time.perf_counter()
+
+        with open(self.state_path, 'r', encoding="UTF-8") as state_file:
+            definitions = json.load(state_file)
+
+        with connection.cursor() as cursor:
+            if not is_sqlite():
+                # Before the GIN indexes exist, so that they are built once:
+                cursor.execute(f"UPDATE album SET search_vector = {ALBUM_VECTOR} WHERE search_vector IS NULL")
+                cursor.execute(f"UPDATE song SET search_vector = {SONG_VECTOR} WHERE search_vector IS NULL")
+
+            for name, definition in definitions['indexes']:
+                log_it("info", __name__, f"Building {name}")
+                cursor.execute(definition)
+
+            for name, definition in definitions['foreign_keys']:
+                cursor.execute(f"ALTER TABLE song ADD CONSTRAINT {name} {definition}")
+
+            for table in LOAD_TABLES:
+                cursor.execute(f"ANALYZE {table}")
+
+        os.remove(self.state_path)
+
+        return time.perf_counter() - start
+
+    def derive(self):
+        """
+        Fill the tables derived from album and song: dimension links and facet counts, and rebuild the tag index,
+        which the batches do not update album by album as MusicMeta.tags_to_db() does.
+        :return: void
+        """
+        MusicDimensions().rebuild()
+        MusicFacets.rebuild()
+
+        if self.index:
+            self.index.close()
+            self.index = MusicIndex.build_from_db(self.index.path)
+        else:
+            log_it("warning", __name__, "No tag index rebuilt, searches of the index need: music_index.py -b db")
+
+        bump_library_generation()
+
+    async def load(self, force=False):
+        """
+        Load the library: collect the tags, write them in batches and build the indexes and derived tables.
+        :param force: See prepare()
+        :return: A dictionary of statistics
+        """
+        start = time.perf_counter()
+        await sync_to_async(self.prepare)(force)
+
+        try:
+            await self.collect_tags()
+            await sync_to_async(self.write_batch)()
+        finally:
+            self.stats['index_seconds'] = await sync_to_async(self.restore)()
+
+        derive_start = time.perf_counter()
+        await sync_to_async(self.derive)()
+        self.stats['derive_seconds'] = time.perf_counter() - derive_start
+        self.stats['total_seconds'] = time.perf_counter() - start
+        self.stats['rows_per_sec'] = round((self.stats['albums'] + self.stats['songs']) /
+                                           max(self.stats['copy_seconds'], 1e-6))
+        self.stats['songs_per_sec_total'] = round(self.stats['songs'] / max(self.stats['total_seconds'], 1e-6))
+
+        return {key: round(val, 2) if isinstance(val, float) else val for key, val in self.stats.items()}
+
+
+PROGRAM_DESCRIPTION = "This program imports a music library into an empty DB in bulk, building the indexes " \
+                      "after the load."
+
+
+async def main():
+    """
+    Main function
+    :return: void
+    """
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-d", "--directory",
+                        help="Full path to the parent directory containing sub-directories with music files.",
+                        type=str,
+                        dest='base_dir',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-b", "--batch",
+                        help=f"Number of songs written per batch, default: {DEFAULT_BATCH_SONGS}",
+                        type=int,
+                        dest='batch_songs',
+                        default=DEFAULT_BATCH_SONGS,
+                        required=False)
+
+    parser.add_argument("-l", "--limit",
+                        help="If provided, determines the max number of album directories to load.",
+                        type=int,
+                        dest='limit',
+                        default=-1,
+                        required=False)
+
+    parser.add_argument("-F", "--force",
+                        help=f"If provided, load even if the DB holds more than {MAX_EXISTING_ALBUMS} albums.",
+                        action='store_true',
+                        dest='force',
+                        required=False)
+
+    parser.add_argument("-R", "--restore",
+                        help="If provided, only re-create the indexes dropped by a load which has been killed.",
+                        action='store_true',
+                        dest='restore',
+                        required=False)
+
+    parser.add_argument("-s", "--state",
+                        help=f"Path to the file keeping the dropped index definitions, default: {DEFAULT_STATE_PATH}",
+                        type=str,
+                        dest='state_path',
+                        default=DEFAULT_STATE_PATH,
+                        required=False)
+
+    parser.add_argument("-n", "--index",
+                        help=f"Path to the tag index file rebuilt after the load, default: {DEFAULT_INDEX_PATH}, "
+                             "'' to leave the index as it is.",
+                        type=str,
+                        dest='index_path',
+                        default=DEFAULT_INDEX_PATH,
+                        required=False)
+
+    args = parser.parse_args()
+
+    if not args.restore and not args.base_dir:
+        parser.error("Provide the library directory (-d)")
+
+    loader = BulkLoader(args.base_dir, batch_songs=args.batch_songs, max_albums=args.limit,
+                        state_path=args.state_path, index_path=args.index_path)
+
+    if args.restore:
+        if not os.path.exists(args.state_path):
+            parser.error(f"Nothing to restore: {args.state_path} not found")
+
+        log_it("info", __name__, f"Restored in {round(await sync_to_async(loader.restore)(), 2)} s")
+        return
+
+    try:
+        print(json.dumps(await loader.load(force=args.force), indent=4))
+    except ValueError as load_err:
+        parser.error(str(load_err))
+
+
+if __name__ == '__main__':
+    run(main)
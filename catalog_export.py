@@ -0,0 +1,268 @@
+"""
+This module hosts the class CatalogExport.
+CatalogExport dumps the song catalog, each song with its album, to CSV, NDJSON, Parquet or Arrow (IPC) for
+analysis. Rows are read from a server-side DB cursor and written chunk by chunk, so the memory use does not
+depend on the size of the catalog. Parquet and Arrow need pyarrow, which is only imported for them.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import csv
+import datetime
+import json
+import sys
+import time
+from itertools import islice
+
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import streaming_transaction  # pylint: disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from search_query import SearchQuery  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+EXPORT_FORMATS = ['csv', 'ndjson', 'parquet', 'arrow']
+BINARY_FORMATS = ['parquet', 'arrow']
+DB_FETCH_CHUNK = 10000
+
+# Exported column: (Song lookup, Arrow type)
+EXPORT_COLUMNS = {
+    'song_id': ('id', 'int64'),
+    'album_id': ('album_id', 'int64'),
+    'album_path': ('album__path', 'string'),
+    'album_title': ('album__title', 'string'),
+    'album_artist': ('album__artist', 'string'),
+    'album_label': ('album__label', 'string'),
+    'album_date': ('album__date', 'date32'),
+    'album_tracks': ('album__track_count', 'int32'),
+    'album_duration': ('album__total_duration', 'float64'),
+    'file': ('file', 'string'),
+    'track': ('track_id', 'int32'),
+    'title': ('title', 'string'),
+    'artist': ('artist', 'string'),
+    'performer': ('performer', 'string'),
+    'composer': ('composer', 'string'),
+    'genre': ('genre', 'string'),
+    'date': ('date', 'date32'),
+    'duration': ('duration', 'float64'),
+    'bitrate': ('bitrate', 'int32'),
+    'samplerate': ('samplerate', 'int32'),
+    'channels': ('channels', 'int16'),
+    'filesize': ('filesize', 'int64'),
+    'mtime': ('mtime', 'float64'),
+    'comment': ('comment', 'string'),
+}
+
+
+def text_value(value):
+    """
+    Convert a value for a text format.
+    :param value: A column value
+    :return: The value, with dates as ISO strings
+    """
+    return value.isoformat() if isinstance(value, datetime.date) else value
+
+
+class CsvWriter:
+    """
+    This class writes rows as CSV with a header line.
+    """
+
+    def __init__(self, out_stream):
+        self.writer = csv.writer(out_stream)
+
+    def begin(self):  # pylint: disable=missing-function-docstring
+        self.writer.writerow(list(EXPORT_COLUMNS.keys()))
+
+    def add(self, rows):
+        """
+        Write a chunk of rows.
+        :param rows: A list of tuples (see EXPORT_COLUMNS)
+        :return: void
+        """
+        self.writer.writerows([text_value(val) for val in row] for row in rows)
+
+    def end(self):  # pylint: disable=missing-function-docstring
+        pass
+
+
+class NdjsonWriter:
+    """
+    This class writes rows as newline-delimited JSON objects.
+    """
+
+    def __init__(self, out_stream):
+        self.out_stream = out_stream
+        self.columns = list(EXPORT_COLUMNS.keys())
+
+    def begin(self):  # pylint: disable=missing-function-docstring
+        pass
+
+    def add(self, rows):
+        """
+        Write a chunk of rows.
+        :param rows: A list of tuples (see EXPORT_COLUMNS)
+        :return: void
+        """
+        self.out_stream.write(''.join(json.dumps(dict(zip(self.columns, map(text_value, row))), ensure_ascii=False)
+                                      + '\n' for row in rows))
+
+    def end(self):  # pylint: disable=missing-function-docstring
+        pass
+
+
+class ArrowWriter:
+    """
+    This class writes rows as a Parquet file (one row group per chunk) or an Arrow IPC file (one record batch
+    per chunk).
+    """
+
+    def __init__(self, out_path, export_format='parquet'):
+        self.out_path = out_path
+        self.export_format = export_format
+        self.pa = None
+        self.schema = None
+        self.writer = None
+
+    def begin(self):
+        """
+        Import pyarrow and open the file.
+        :return: void
+        """
+        try:
+            import pyarrow  # pylint: disable=import-outside-toplevel, disable=import-error
+            import pyarrow.parquet  # pylint: disable=import-outside-toplevel, disable=import-error
+        except ImportError as import_err:
+            raise ValueError(f"The {self.export_format} format needs pyarrow: pip install pyarrow") from import_err
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([(name, getattr(pyarrow, arrow_type)())
+                                      for name, (_, arrow_type) in EXPORT_COLUMNS.items()])
+
+        if self.export_format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.out_path, self.schema, compression='zstd')
+        else:
+            self.writer = pyarrow.ipc.new_file(self.out_path, self.schema)
+
+    def add(self, rows):
+        """
+        Write a chunk of rows.
+        :param rows: A list of tuples (see EXPORT_COLUMNS)
+        :return: void
+        """
+        columns = list(zip(*rows))
+        batch = self.pa.record_batch([self.pa.array(values, type=field.type)
+                                      for values, field in zip(columns, self.schema)], schema=self.schema)
+
+        if self.export_format == 'parquet':
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def end(self):  # pylint: disable=missing-function-docstring
+        if self.writer:
+            self.writer.close()
+
+
+class CatalogExport:
+    """
+    This class exports the songs matching a query (all songs by default), ordered by album path and track.
+    """
+
+    def __init__(self, query=None, chunk_size=DB_FETCH_CHUNK):
+        self.query = query
+        self.chunk_size = max(1, int(chunk_size or DB_FETCH_CHUNK))
+        self.rows_written = 0
+
+    def rows(self):
+        """
+        Read the rows to export from a server-side cursor, streamed (see streaming_transaction()).
+        :return: A generator of tuples (see EXPORT_COLUMNS)
+        """
+        songs = Song.objects.order_by('album__path', 'track_id', 'id')  # NOQA
+
+        if self.query:
+            songs = songs.filter(self.query.to_q())
+
+        with streaming_transaction():
+            yield from songs.values_list(*[lookup for lookup, _ in EXPORT_COLUMNS.values()]).iterator(
+                chunk_size=self.chunk_size)
+
+    def write(self, writer):
+        """
+        Write the export.
+        :param writer: A CsvWriter, NdjsonWriter or ArrowWriter
+        :return: Number of rows written
+        """
+        start = time.perf_counter()
+        rows = self.rows()
+        self.rows_written = 0
+        writer.begin()
+
+        try:
+            while chunk := list(islice(rows, self.chunk_size)):
+                writer.add(chunk)
+                self.rows_written += len(chunk)
+        finally:
+            writer.end()
+
+        elapsed = time.perf_counter() - start
+        log_it("info", __name__, f"{self.rows_written} rows in {round(elapsed, 2)} s, "
+                                 f"{round(self.rows_written / max(elapsed, 1e-6))} rows/s")
+
+        return self.rows_written
+
+
+PROGRAM_DESCRIPTION = "This program exports the song catalog, with album columns, to CSV, NDJSON, Parquet or Arrow."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-t", "--format",
+                        help="Export format, default: csv",
+                        type=str,
+                        dest='export_format',
+                        choices=EXPORT_FORMATS,
+                        default='csv',
+                        required=False)
+
+    parser.add_argument("-o", "--output",
+                        help="Path to the export file, stdout if not provided (CSV and NDJSON only).",
+                        type=str,
+                        dest='out_path',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-q", "--query",
+                        help="If provided, export only the songs matching a field-scoped query, "
+                             "e.g. 'genre:jazz year:1955..1965'.",
+                        type=str,
+                        dest='query',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-c", "--chunk",
+                        help=f"Number of rows fetched and written at a time, default: {DB_FETCH_CHUNK}",
+                        type=int,
+                        dest='chunk_size',
+                        default=DB_FETCH_CHUNK,
+                        required=False)
+
+    args = parser.parse_args()
+    export = CatalogExport(query=SearchQuery(args.query) if args.query else None, chunk_size=args.chunk_size)
+
+    try:
+        if args.export_format in BINARY_FORMATS:
+            if not args.out_path:
+                parser.error(f"The {args.export_format} format needs an output file (-o)")
+
+            export.write(ArrowWriter(args.out_path, args.export_format))
+        elif args.out_path:
+            with open(args.out_path, 'w', encoding="UTF-8", newline='') as out:
+                export.write(CsvWriter(out) if args.export_format == 'csv' else NdjsonWriter(out))
+        else:
+            export.write(CsvWriter(sys.stdout) if args.export_format == 'csv' else NdjsonWriter(sys.stdout))
+    except ValueError as export_err:
+        parser.error(str(export_err))
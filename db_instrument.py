@@ -0,0 +1,124 @@
+"""
+This module hosts the class QueryStats.
+QueryStats wraps the DB execution of Django (connection.execute_wrapper) while an album is ingested and
+records the number of statements, their total time and the slowest ones per album, so that N+1 query
+patterns show up as statements repeated for every album. Statements slower than a threshold can be
+logged with the album path as they run.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import heapq
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+DEFAULT_TOP = 5
+MAX_SQL_CHARS = 200
+
+
+def short_sql(sql):
+    """
+    Shorten a statement for a log or a summary.
+    :param sql: SQL text
+    :return: The SQL on one line, truncated to MAX_SQL_CHARS
+    """
+    sql = ' '.join(sql.split())
+
+    return sql if len(sql) <= MAX_SQL_CHARS else sql[:MAX_SQL_CHARS - 3] + '...'
+
+
+class QueryStats:
+    """
+    This class records the statements run by the DB connection of the current thread, per album.
+    """
+
+    def __init__(self, slow_ms=None, top=DEFAULT_TOP):
+        self.slow_ms = slow_ms
+        self.top = max(1, int(top or DEFAULT_TOP))
+        self.album_path = None
+        self.albums = {}
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, (time.perf_counter() - start) * 1000)
+
+    def record(self, sql, elapsed_ms):
+        """
+        Record a statement run for the current album.
+        :param sql: SQL text, with placeholders: the same text for every album if only the parameters differ
+        :param elapsed_ms: Run time in milliseconds
+        :return: void
+        """
+        album_path = self.album_path or ''
+        album = self.albums.setdefault(album_path, {'queries': 0, 'ms': 0.0, 'slowest': []})
+        album['queries'] += 1
+        album['ms'] += elapsed_ms
+
+        if len(album['slowest']) < self.top:
+            heapq.heappush(album['slowest'], (elapsed_ms, sql))
+        else:
+            heapq.heappushpop(album['slowest'], (elapsed_ms, sql))
+
+        statement = self.statements.setdefault(sql, [0, 0.0])
+        statement[0] += 1
+        statement[1] += elapsed_ms
+
+        if self.slow_ms is not None and elapsed_ms >= self.slow_ms:
+            log_it("warning", __name__, f"Slow query ({round(elapsed_ms, 2)} ms) album={album_path}: {short_sql(sql)}")
+
+    @contextmanager
+    def album(self, album_path):
+        """
+        Record the statements run in the block for an album.
+        :param album_path: Album path (relative to the library directory)
+        :return: A context manager
+        """
+        previous = self.album_path
+        self.album_path = album_path
+
+        try:
+            if self in connection.execute_wrappers:
+                yield self
+            else:
+                with connection.execute_wrapper(self):
+                    yield self
+        finally:
+            self.album_path = previous
+
+    def summary(self):
+        """
+        Summarise the statements recorded.
+        :return: A dictionary
+        """
+        queries = sum(album['queries'] for album in self.albums.values())
+        total_ms = sum(album['ms'] for album in self.albums.values())
+        busiest = heapq.nlargest(self.top, self.albums.items(), key=lambda item: (item[1]['queries'], item[1]['ms']))
+        slowest = heapq.nlargest(self.top, ((elapsed_ms, sql, path) for path, album in self.albums.items()
+                                            for elapsed_ms, sql in album['slowest']))
+        repeated = heapq.nlargest(self.top, self.statements.items(), key=lambda item: item[1][0])
+
+        return {
+            'albums': len(self.albums),
+            'queries': queries,
+            'ms': round(total_ms, 2),
+            'queries_per_album': round(queries / max(1, len(self.albums)), 1),
+            'ms_per_album': round(total_ms / max(1, len(self.albums)), 2),
+            'busiest_albums': [{'path': path, 'queries': album['queries'], 'ms': round(album['ms'], 2)}
+                               for path, album in busiest],
+            'slowest': [{'ms': round(elapsed_ms, 2), 'path': path, 'sql': short_sql(sql)}
+                        for elapsed_ms, sql, path in slowest],
+            'repeated': [{'count': count, 'per_album': round(count / max(1, len(self.albums)), 1),
+                          'ms': round(elapsed_ms, 2), 'sql': short_sql(sql)} for sql, (count, elapsed_ms) in repeated],
+        }
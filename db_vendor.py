@@ -0,0 +1,115 @@
+"""
+This module hides the differences between the DB backends (PostgreSQL, SQLite; see settings.py)
+from the hand-written SQL of the other modules.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import datetime
+from contextlib import nullcontext
+
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from utils import fold_text  # pylint: disable=import-error
+
+# SQL function folding text like utils.fold_text(): a Python function on SQLite (registered on every
+# connection, see register_functions()), lower(unaccent()) on PostgreSQL (see migration 0013)
+FOLD_FUNCTION = 'music_fold'
+
+
+def is_sqlite():
+    """
+    Tell whether the DB is SQLite.
+    :return: True for SQLite, False for PostgreSQL
+    """
+    return connection.vendor == 'sqlite'
+
+
+def year_sql(column):
+    """
+    Get the SQL expression of the year of a date column, as an integer.
+    :param column: Column name, e.g. 's.date'
+    :return: A string
+    """
+    if is_sqlite():
+        # SQLite keeps dates as 'YYYY-MM-DD' text:
+        return f"CAST(substr({column}, 1, 4) AS integer)"
+
+    return f"CAST(extract(year FROM {column}) AS integer)"
+
+
+def extension_sql(column):
+    """
+    Get the SQL expression of the lower-cased extension of a file name column, without the dot.
+    :param column: Column name, e.g. 's.file'
+    :return: A string, the expression is '' for a file name without an extension
+    """
+    if is_sqlite():
+        # rtrim() strips the characters other than dots from the end, which leaves the name up to the last dot:
+        return f"CASE WHEN instr({column}, '.') > 1 " \
+               f"THEN lower(replace({column}, rtrim({column}, replace({column}, '.', '')), '')) ELSE '' END"
+
+    return f"coalesce(lower(substring({column} from '[^/]\\.([^./]*)$')), '')"
+
+
+def streaming_transaction():
+    """
+    Get the context in which to read a large result through a server-side cursor: on PostgreSQL a transaction,
+    as outside one Django declares the cursor WITH HOLD, which makes the server compute the whole result first;
+    on SQLite nothing, as rows are read as they are stepped through and a transaction would take the write lock
+    (see settings.py).
+    :return: A context manager
+    """
+    return nullcontext() if is_sqlite() else transaction.atomic()
+
+
+def clear_tables(cursor, tables):
+    """
+    Delete every row of tables (TRUNCATE where there is one).
+    :param cursor: DB cursor
+    :param tables: A list of table names
+    :return: void
+    """
+    if is_sqlite():
+        for table in tables:
+            cursor.execute(f"DELETE FROM {table}")
+    else:
+        cursor.execute(f"TRUNCATE {', '.join(tables)}")
+
+
+def as_date(value):
+    """
+    Convert a date read with raw SQL, which SQLite returns as text.
+    :param value: A date, an ISO date string or None
+    :return: A datetime.date or None
+    """
+    if value is None or isinstance(value, datetime.date):
+        return value
+
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def fold_value(value):
+    """
+    Fold a column value for FOLD_FUNCTION on SQLite.
+    :param value: A column value
+    :return: The folded text (see utils.fold_text()) or None for NULL
+    """
+    return None if value is None else fold_text(value)
+
+
+def register_functions(sender, connection, **kwargs):  # pylint: disable=redefined-outer-name, unused-argument
+    """
+    Register the SQL functions the other modules use on a new SQLite connection (handler of connection_created).
+    :param sender: Database wrapper class
+    :param connection: The new connection (database wrapper)
+    :return: void
+    """
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function(FOLD_FUNCTION, 1, fold_value, deterministic=True)
+
+
+connection_created.connect(register_functions)
@@ -0,0 +1,323 @@
+"""
+This module hosts the class FuzzySearch.
+It finds artist, title and composer values close to a possibly misspelt query, e.g. "mclauglin" or
+"namyslowski", using a trigram index over the words of the values and a bounded edit distance.
+The index is built in memory from the DB or from a tag cache (JSON written by music_meta_search.py).
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import json
+import re
+import time
+
+from django.db.models import Count
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from utils import fold_text, log_it  # pylint: disable=import-error
+
+# Query field: Song field
+FUZZY_FIELDS = {
+    'artist': 'artist',
+    'title': 'title',
+    'composer': 'composer',
+}
+
+NGRAM_SIZE = 3
+NGRAM_PAD = '$'
+DEFAULT_LIMIT = 20
+DEFAULT_BUDGET_MS = 50
+
+
+def word_ngrams(in_word):
+    """
+    Split a word into n-grams, padded so that the ends of short words are represented too.
+    :param in_word: A folded word
+    :return: A set of strings
+    """
+    padded = f"{NGRAM_PAD}{in_word}{NGRAM_PAD}"
+    return {padded[ix:ix + NGRAM_SIZE] for ix in range(max(1, len(padded) - NGRAM_SIZE + 1))}
+
+
+def default_max_distance(in_word):
+    """
+    Choose the number of typos to tolerate in a word.
+    :param in_word: A folded word
+    :return: An int
+    """
+    if len(in_word) <= 3:
+        return 0
+
+    return 1 if len(in_word) <= 6 else 2
+
+
+def bounded_levenshtein(first, second, max_distance):
+    """
+    Compute the edit distance between two strings, giving up once it exceeds a bound.
+    Only the diagonal band of width 2 * max_distance + 1 is computed.
+    :param first: A string
+    :param second: A string
+    :param max_distance: The bound
+    :return: The distance or None if it is greater than max_distance
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return None
+
+    if first == second:
+        return 0
+
+    too_far = max_distance + 1
+    prev = list(range(len(second) + 1))
+
+    for ix, char in enumerate(first, 1):
+        lo = max(1, ix - max_distance)
+        hi = min(len(second), ix + max_distance)
+        curr = [too_far] * (len(second) + 1)
+        curr[0] = ix if ix <= max_distance else too_far
+
+        for jx in range(lo, hi + 1):
+            cost = 0 if char == second[jx - 1] else 1
+            curr[jx] = min(prev[jx] + 1, curr[jx - 1] + 1, prev[jx - 1] + cost)
+
+        if min(curr[lo - 1:hi + 1]) > max_distance:
+            return None
+
+        prev = curr
+
+    return prev[-1] if prev[-1] <= max_distance else None
+
+
+class FuzzySearch:
+    """
+    This class encapsulates a typo-tolerant search over tag values.
+    """
+
+    def __init__(self):
+        self.values = []  # (field, value, number of songs)
+        self.words = []
+        self._word_ids = {}
+        self._word_values = []  # word ID -> set of value IDs
+        self._ngram_words = {}  # n-gram -> list of word IDs
+
+    @property
+    def size(self):  # pylint: disable=missing-function-docstring
+        return len(self.values)
+
+    def add(self, field, value, count=1):
+        """
+        Add a tag value to the index.
+        :param field: Field name (see FUZZY_FIELDS)
+        :param value: Tag value
+        :param count: Number of songs with this value
+        :return: void
+        """
+        value_id = len(self.values)
+        self.values.append((field, value, count))
+
+        for word in set(re.findall(r'\w+', fold_text(value))):
+            word_id = self._word_ids.get(word)
+
+            if word_id is None:
+                word_id = self._word_ids[word] = len(self.words)
+                self.words.append(word)
+                self._word_values.append(set())
+
+                for ngram in word_ngrams(word):
+                    self._ngram_words.setdefault(ngram, []).append(word_id)
+
+            self._word_values[word_id].add(value_id)
+
+    @classmethod
+    def build_from_db(cls):
+        """
+        Build an index of the distinct artist, title and composer values in the song table.
+        :return: A FuzzySearch instance
+        """
+        fuzzy = cls()
+
+        for field, db_field in FUZZY_FIELDS.items():
+            rows = Song.objects.exclude(**{f"{db_field}__isnull": True}).exclude(**{db_field: ''}).values(  # NOQA
+                db_field).annotate(songs=Count('id'))
+
+            for row in rows.iterator():
+                fuzzy.add(field, row[db_field], row['songs'])
+
+        return fuzzy
+
+    @classmethod
+    def build_from_tag_cache(cls, cache_path):
+        """
+        Build an index of the distinct artist, title and composer values in a tag cache.
+        :param cache_path: Path to the JSON file written by music_meta_search.py
+        :return: A FuzzySearch instance
+        """
+        with open(cache_path, encoding="UTF-8") as f_cache:
+            cache = json.load(f_cache)
+
+        counts = {}
+
+        for dir_tags in cache.values():
+            for song_tags in dir_tags:
+                for field in FUZZY_FIELDS:
+                    value = song_tags.get(field)
+
+                    if value and isinstance(value, str):
+                        counts[(field, value)] = counts.get((field, value), 0) + 1
+
+        fuzzy = cls()
+
+        for (field, value), count in counts.items():
+            fuzzy.add(field, value, count)
+
+        return fuzzy
+
+    def similar_words(self, in_word, max_distance, deadline):
+        """
+        Find the indexed words within an edit distance of a word.
+        :param in_word: A folded word
+        :param max_distance: Max number of edits
+        :param deadline: time.perf_counter() value after which the search gives up
+        :return: A dictionary of word ID to distance
+        """
+        exact_id = self._word_ids.get(in_word)
+
+        if max_distance == 0:
+            return {exact_id: 0} if exact_id is not None else {}
+
+        ngrams = word_ngrams(in_word)
+        shared = {}
+
+        for ngram in ngrams:
+            for word_id in self._ngram_words.get(ngram, ()):
+                shared[word_id] = shared.get(word_id, 0) + 1
+
+        # An edit changes at most NGRAM_SIZE n-grams, words sharing fewer cannot be close enough:
+        min_shared = max(1, len(ngrams) - NGRAM_SIZE * max_distance)
+        found = {exact_id: 0} if exact_id is not None else {}
+
+        for word_id, count in sorted(shared.items(), key=lambda item: -item[1]):
+            if count < min_shared or time.perf_counter() > deadline:
+                break
+
+            if word_id == exact_id:
+                continue
+
+            distance = bounded_levenshtein(in_word, self.words[word_id], max_distance)
+
+            if distance is not None:
+                found[word_id] = distance
+
+        return found
+
+    def search(self, query, fields=None, limit=DEFAULT_LIMIT, max_distance=None, budget_ms=DEFAULT_BUDGET_MS):
+        """
+        Find the values containing words close to all the words of a query, best first.
+        :param query: Query text
+        :param fields: A list of fields to search (see FUZZY_FIELDS), all if not given
+        :param limit: Max number of results
+        :param max_distance: Max number of edits per word, chosen by word length if not given
+        :param budget_ms: Time budget in milliseconds, the best results found so far are returned when it runs out
+        :return: A dictionary with the query, the results (a list of dictionaries: field, value, distance, songs)
+        and complete (False if the budget ran out)
+        """
+        start = time.perf_counter()
+        deadline = start + budget_ms / 1000
+        query_words = re.findall(r'\w+', fold_text(query or ''))
+        value_distance = None
+
+        for word in query_words:
+            word_max = default_max_distance(word) if max_distance is None else max_distance
+            word_distance = {}
+
+            for word_id, distance in self.similar_words(word, word_max, deadline).items():
+                for value_id in self._word_values[word_id]:
+                    if distance < word_distance.get(value_id, word_max + 1):
+                        word_distance[value_id] = distance
+
+            # Every word of the query has to be matched by some word of the value:
+            value_distance = word_distance if value_distance is None else {
+                value_id: value_distance[value_id] + distance
+                for value_id, distance in word_distance.items() if value_id in value_distance}
+
+            if not value_distance:
+                break
+
+        ranked = sorted(
+            (value_id for value_id in (value_distance or {}) if not fields or self.values[value_id][0] in fields),
+            key=lambda value_id: (value_distance[value_id], -self.values[value_id][2], self.values[value_id][1]))
+
+        return {
+            'query': query,
+            'complete': time.perf_counter() <= deadline,
+            'ms': round((time.perf_counter() - start) * 1000, 2),
+            'results': [{
+                'field': self.values[value_id][0],
+                'value': self.values[value_id][1],
+                'distance': value_distance[value_id],
+                'songs': self.values[value_id][2],
+            } for value_id in ranked[:limit]],
+        }
+
+
+PROGRAM_DESCRIPTION = "This program finds artists, titles and composers close to a possibly misspelt query."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-f", "--find",
+                        help="Text to find, e.g. 'mclauglin' or 'namyslowski'.",
+                        type=str,
+                        dest='search_str',
+                        required=True)
+
+    parser.add_argument("-b", "--build",
+                        help="Build the index from 'db' (default) or from the path to a tag cache "
+                             "(JSON file written by music_meta_search.py).",
+                        type=str,
+                        dest='build',
+                        default='db',
+                        required=False)
+
+    parser.add_argument("-k", "--field",
+                        help="Field to search, repeat for several, all if not given.",
+                        type=str,
+                        dest='fields',
+                        action='append',
+                        choices=list(FUZZY_FIELDS.keys()),
+                        default=[],
+                        required=False)
+
+    parser.add_argument("-e", "--edits",
+                        help="Max number of typos per word, chosen by word length if not given.",
+                        type=int,
+                        dest='max_distance',
+                        default=None,
+                        required=False)
+
+    parser.add_argument("-l", "--limit",
+                        help="Max number of results.",
+                        type=int,
+                        dest='limit',
+                        default=DEFAULT_LIMIT,
+                        required=False)
+
+    parser.add_argument("-t", "--budget",
+                        help="Time budget for the search in milliseconds.",
+                        type=int,
+                        dest='budget_ms',
+                        default=DEFAULT_BUDGET_MS,
+                        required=False)
+
+    args = parser.parse_args()
+
+    build_start = datetime.datetime.now()
+    fuzzy_search = FuzzySearch.build_from_db() if args.build == 'db' else FuzzySearch.build_from_tag_cache(args.build)
+    log_it("info", __name__, f"Indexed {fuzzy_search.size} values in {str(datetime.datetime.now() - build_start)}")
+
+    print(json.dumps(fuzzy_search.search(args.search_str, fields=args.fields, limit=args.limit,
+                                         max_distance=args.max_distance, budget_ms=args.budget_ms),
+                     indent=4, ensure_ascii=False))
@@ -0,0 +1,88 @@
+"""
+This module pages through the song catalog for the web GUI.
+Pages are read with keyset (seek) pagination: each page starts after the sort key and id of the last row
+of the previous one, so that any page costs an index range scan of one page, however deep it is.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import base64
+import binascii
+import json
+
+from django.db.models import F, Q, TextField, Value
+from django.db.models.functions import Coalesce
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+
+PAGE_SIZE = 50
+
+# Sort: Song field, each one has an index on (coalesce(field, ''), id), see migration 0006
+SORT_FIELDS = {
+    'artist': 'artist',
+    'title': 'title',
+    'id': None,
+}
+DEFAULT_SORT = 'artist'
+
+
+def encode_cursor(sort_key, song_id):
+    """
+    Encode the position after which the next page starts.
+    :param sort_key: Sort key of the last row of a page
+    :param song_id: ID of the last row of a page
+    :return: A URL-safe string
+    """
+    return base64.urlsafe_b64encode(json.dumps([sort_key, song_id]).encode('UTF-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a position encoded by encode_cursor().
+    :param cursor: A string
+    :return: A tuple (sort key, song ID) or None if the cursor is missing or malformed
+    """
+    if not cursor:
+        return None
+
+    try:
+        sort_key, song_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_key, int(song_id)
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+def song_page(query=None, sort=DEFAULT_SORT, after=None, page_size=PAGE_SIZE):
+    """
+    Read a page of songs.
+    :param query: A SearchQuery to filter the songs or None for all
+    :param sort: A key of SORT_FIELDS
+    :param after: A cursor (see encode_cursor()) or None for the first page
+    :param page_size: Number of songs per page
+    :return: A tuple (list of Song instances with the album selected, cursor of the next page or None)
+    """
+    field = SORT_FIELDS.get(sort, SORT_FIELDS[DEFAULT_SORT])
+    songs = Song.objects.select_related('album')  # NOQA
+
+    if query:
+        songs = songs.filter(query.to_q())
+
+    sort_key = Coalesce(field, Value('', output_field=TextField())) if field else F('id')
+    songs = songs.annotate(sort_key=sort_key).order_by('sort_key', 'id')
+    position = decode_cursor(after)
+
+    if position:
+        sort_key, song_id = position
+        # The first condition lets the index scan start at the key, the second skips rows before the position:
+        songs = songs.filter(Q(sort_key__gte=sort_key) & (Q(sort_key__gt=sort_key) | Q(id__gt=song_id)))
+
+    rows = list(songs[:page_size + 1])
+
+    if len(rows) <= page_size:
+        return rows, None
+
+    last = rows[page_size - 1]
+
+    return rows[:page_size], encode_cursor(last.sort_key, last.id)
@@ -0,0 +1,13 @@
+"""
+URLs of the search GUI
+"""
+from django.urls import path
+
+from gui import views  # pylint: disable=import-error
+
+app_name = 'gui'
+
+urlpatterns = [
+    path('', views.search_page, name='search'),
+    path('rows', views.result_rows, name='rows'),
+]
@@ -0,0 +1,79 @@
+"""
+Views of the search GUI: a page with a search box and the first page of results, and the rows
+of the following pages, fetched as HTML fragments while scrolling.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import hashlib
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from gui.catalog import DEFAULT_SORT, PAGE_SIZE, SORT_FIELDS, song_page  # pylint: disable=import-error
+from query_cache import library_generation  # pylint: disable=import-error
+from search_query import QuerySyntaxError, SearchQuery  # pylint: disable=import-error
+
+
+def search_params(request):
+    """
+    Read the search parameters of a request.
+    :param request: HttpRequest
+    :return: A tuple (query text, sort, cursor)
+    """
+    sort = request.GET.get('sort', DEFAULT_SORT)
+
+    return request.GET.get('q', '').strip(), sort if sort in SORT_FIELDS else DEFAULT_SORT, request.GET.get('after')
+
+
+def rows_fragment(query_text, sort, after):
+    """
+    Render a page of result rows. Fragments are cached under the library generation, which the ingest
+    writer bumps whenever an album changes, so a cached fragment is never stale.
+    :param query_text: Query text (see search_query.py)
+    :param sort: A key of SORT_FIELDS
+    :param after: Cursor of the page or None for the first one
+    :return: HTML as a string
+    """
+    query = SearchQuery(query_text) if query_text else None
+    key_src = f"{library_generation()}|{query.canonical() if query else ''}|{sort}|{after or ''}"
+    cache_key = f"gui:rows:{hashlib.sha1(key_src.encode('UTF-8')).hexdigest()}"
+    html = cache.get(cache_key)
+
+    if html is None:
+        songs, next_cursor = song_page(query, sort, after)
+        html = render_to_string('gui/rows.html', {'songs': songs, 'next_cursor': next_cursor})
+        cache.set(cache_key, html)
+
+    return html
+
+
+def search_page(request):
+    """
+    The search page.
+    """
+    query_text, sort, _ = search_params(request)
+    context = {'q': query_text, 'sort': sort, 'sorts': list(SORT_FIELDS.keys()), 'page_size': PAGE_SIZE}
+
+    try:
+        context['rows'] = rows_fragment(query_text, sort, None)
+    except QuerySyntaxError as query_err:
+        context['error'] = str(query_err)
+
+    return render(request, 'gui/search.html', context)
+
+
+def result_rows(request):
+    """
+    The rows of a following page of results.
+    """
+    query_text, sort, after = search_params(request)
+
+    try:
+        return HttpResponse(rows_fragment(query_text, sort, after))
+    except QuerySyntaxError as query_err:
+        return HttpResponse(str(query_err), status=400)
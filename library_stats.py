@@ -0,0 +1,262 @@
+"""
+This module hosts the class LibraryStats.
+LibraryStats reads a few compact columns of the whole library (song year, duration, format, bitrate and file
+size, the genre and artist links, album years) into NumPy arrays, and computes the statistics of the library
+from the arrays (histograms, grouped sums, top-N), rather than from model instances, so that the report of a
+large library takes seconds.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import json
+import time
+
+import numpy as np  # pylint: disable=import-error
+from django.db import connection
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import extension_sql, streaming_transaction, year_sql  # pylint: disable=import-error
+from music_dims import ROLE_ARTIST  # pylint: disable=import-error
+from music_facets import UNKNOWN_YEAR  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+DEFAULT_TOP = 20
+DB_FETCH_CHUNK = 50000
+NO_FORMAT = '(none)'
+
+# Array: (SQL expression, dtype, value read for NULL); integer columns use 0 and float columns -1 for NULL,
+# as NumPy integer arrays have no missing value
+SONG_COLUMNS = {
+    'id': ('s.id', np.int64, 0),
+    'album_id': ('s.album_id', np.int64, 0),
+    'year': (year_sql('s.date'), np.int32, 0),
+    'duration': ('s.duration', np.float64, -1),
+    'bitrate': ('s.bitrate', np.int32, 0),
+    'filesize': ('s.filesize', np.int64, 0),
+}
+
+ALBUM_COLUMNS = {
+    'id': ('a.id', np.int64, 0),
+    'year': (year_sql('a.date'), np.int32, 0),
+}
+
+
+def load_arrays(sql, columns, params=None, text_columns=None):
+    """
+    Read the result of a query into one array per column, through a server-side cursor on PostgreSQL, streamed
+    (see streaming_transaction()).
+    :param sql: SQL text with a {columns} placeholder
+    :param columns: A dictionary: array name -> (SQL expression, dtype, value read for NULL)
+    :param params: Query parameters
+    :param text_columns: A dictionary: list name -> SQL expression of a text column, selected after the columns
+    :return: A dictionary: column name -> array or list
+    """
+    chunks = {name: [] for name in columns}
+    text_columns = text_columns or {}
+    texts = {name: [] for name in text_columns}
+    select = ', '.join([f"coalesce({expr}, {null})" for expr, _, null in columns.values()] +
+                       list(text_columns.values()))
+
+    with streaming_transaction(), connection.chunked_cursor() as cursor:
+        cursor.execute(sql.format(columns=select), params or [])
+
+        while rows := cursor.fetchmany(DB_FETCH_CHUNK):
+            values = list(zip(*rows))
+
+            for pos, (name, (_, dtype, _)) in enumerate(columns.items()):
+                chunks[name].append(np.array(values[pos], dtype=dtype))
+
+            for pos, name in enumerate(text_columns, len(columns)):
+                texts[name].extend(values[pos])
+
+    arrays = {name: np.concatenate(parts) if parts else np.empty(0, dtype=columns[name][1])
+              for name, parts in chunks.items()}
+    arrays.update(texts)
+
+    return arrays
+
+
+def name_map(table, ids):
+    """
+    Read the names of dimension rows.
+    :param table: 'genre' or 'artist'
+    :param ids: An array of IDs
+    :return: A dictionary: ID -> name
+    """
+    if not len(ids):
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT id, name FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                       [int(dim_id) for dim_id in ids])
+
+        return dict(cursor.fetchall())
+
+
+def hours(seconds):
+    """
+    Convert a duration for the report.
+    :param seconds: Duration in seconds
+    :return: Duration in hours, rounded
+    """
+    return round(float(seconds) / 3600, 2)
+
+
+def gigabytes(size):
+    """
+    Convert a file size for the report.
+    :param size: Size in bytes
+    :return: Size in GB, rounded
+    """
+    return round(float(size) / 1e9, 2)
+
+
+class LibraryStats:
+    """
+    This class loads the library columns and computes the statistics.
+    """
+
+    def __init__(self, top=DEFAULT_TOP):
+        self.top = max(1, int(top or DEFAULT_TOP))
+        self.songs = {}
+        self.albums = {}
+        self.links = {}
+        self.formats = []
+        self.format_codes = None
+
+    def load(self):
+        """
+        Read the arrays from the DB.
+        :return: void
+        """
+        self.songs = load_arrays("SELECT {columns} FROM song s ORDER BY s.id", SONG_COLUMNS,
+                                 text_columns={'format': extension_sql('s.file')})
+        self.albums = load_arrays("SELECT {columns} FROM album a", ALBUM_COLUMNS)
+        self.links['genre'] = load_arrays("SELECT {columns} FROM song_genre l", {
+            'song_id': ('l.song_id', np.int64, 0), 'dim_id': ('l.genre_id', np.int64, 0)})
+        self.links['artist'] = load_arrays("SELECT {columns} FROM song_artist l WHERE l.role = %s", {
+            'song_id': ('l.song_id', np.int64, 0), 'dim_id': ('l.artist_id', np.int64, 0)}, [ROLE_ARTIST])
+
+        # The format is the file extension, read from the DB: factorize it into one small integer per song
+        formats, codes = np.unique(np.array(self.songs.pop('format'), dtype=str), return_inverse=True)
+        self.format_codes = codes.reshape(-1).astype(np.int32)
+        self.formats = [fmt or NO_FORMAT for fmt in formats.tolist()]
+
+    def decades(self):
+        """
+        Count the songs and albums per decade, without the unknown years.
+        :return: A dictionary: decade -> {'songs', 'albums'}
+        """
+        counts = {}
+
+        for label, years in (('songs', self.songs['year']), ('albums', self.albums['year'])):
+            known = years[(years > 0) & (years != UNKNOWN_YEAR)]
+            decade, count = np.unique(known // 10 * 10, return_counts=True)
+
+            for dec, cnt in zip(decade.tolist(), count.tolist()):
+                counts.setdefault(f"{dec}s", {'songs': 0, 'albums': 0})[label] = cnt
+
+        return dict(sorted(counts.items()))
+
+    def dimension_totals(self, dim):
+        """
+        Total the songs and play time per dimension value (genre, artist), and keep the ones with the most songs.
+        :param dim: 'genre' or 'artist'
+        :return: A list of dictionaries with name, songs and hours
+        """
+        links = self.links[dim]
+        song_ids = self.songs['id']
+
+        if not len(links['dim_id']) or not len(song_ids):
+            return []
+
+        # Links to song rows: the songs are ordered by ID
+        rows = np.searchsorted(song_ids, links['song_id']).clip(0, len(song_ids) - 1)
+        found = song_ids[rows] == links['song_id']
+        dim_ids, rows = links['dim_id'][found], rows[found]
+        durations = self.songs['duration'][rows].clip(min=0)
+
+        unique_ids, inverse = np.unique(dim_ids, return_inverse=True)
+        songs = np.bincount(inverse)
+        seconds = np.bincount(inverse, weights=durations)
+        top = np.lexsort((-seconds, -songs))[:self.top]
+        names = name_map(dim, unique_ids[top])
+
+        return [{'name': names.get(int(unique_ids[pos]), ''), 'songs': int(songs[pos]), 'hours': hours(seconds[pos])}
+                for pos in top]
+
+    def format_mix(self):
+        """
+        Count the songs, play time and size per format, with the mean bitrate of the songs whose bitrate is known.
+        :return: A dictionary: format -> {'songs', 'hours', 'gb', 'kbps'}
+        """
+        codes = self.format_codes
+        bitrates = self.songs['bitrate']
+        songs = np.bincount(codes, minlength=len(self.formats))
+        seconds = np.bincount(codes, weights=self.songs['duration'].clip(min=0), minlength=len(self.formats))
+        sizes = np.bincount(codes, weights=self.songs['filesize'], minlength=len(self.formats))
+        known = bitrates > 0
+        kbps = np.bincount(codes[known], weights=bitrates[known], minlength=len(self.formats)) / \
+            np.bincount(codes[known], minlength=len(self.formats)).clip(min=1)
+
+        return {self.formats[pos]: {'songs': int(songs[pos]), 'hours': hours(seconds[pos]),
+                                    'gb': gigabytes(sizes[pos]), 'kbps': round(float(kbps[pos]))}
+                for pos in np.argsort(-songs)}
+
+    def missing_years(self):
+        """
+        Count the albums and songs without a year (no date or the 1900 placeholder).
+        :return: A dictionary
+        """
+        album_years = self.albums['year']
+        song_years = self.songs['year']
+
+        return {
+            'albums': int(np.count_nonzero((album_years == 0) | (album_years == UNKNOWN_YEAR))),
+            'songs': int(np.count_nonzero((song_years == 0) | (song_years == UNKNOWN_YEAR))),
+        }
+
+    def report(self):
+        """
+        Compute the statistics.
+        :return: A dictionary
+        """
+        durations = self.songs['duration']
+
+        return {
+            'songs': len(self.songs['id']),
+            'albums': len(self.albums['id']),
+            'hours': hours(durations[durations >= 0].sum()),
+            'songs_without_duration': int(np.count_nonzero(durations < 0)),
+            'gb': gigabytes(self.songs['filesize'].sum()),
+            'missing_years': self.missing_years(),
+            'decades': self.decades(),
+            'genres': self.dimension_totals('genre'),
+            'artists': self.dimension_totals('artist'),
+            'formats': self.format_mix(),
+        }
+
+
+PROGRAM_DESCRIPTION = "This program shows statistics of the library: songs and albums per decade, genres, " \
+                      "largest artists, play time, size, formats and albums missing a year."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-l", "--limit",
+                        help=f"Number of genres and artists to show, default: {DEFAULT_TOP}",
+                        type=int,
+                        dest='limit',
+                        default=DEFAULT_TOP,
+                        required=False)
+
+    args = parser.parse_args()
+    stats = LibraryStats(top=args.limit)
+    start = time.perf_counter()
+    stats.load()
+    loaded = time.perf_counter()
+    print(json.dumps(stats.report(), indent=4, ensure_ascii=False))
+    log_it("info", __name__, f"Loaded in {round(loaded - start, 2)} s, "
+                             f"computed in {round(time.perf_counter() - loaded, 3)} s")
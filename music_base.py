@@ -7,6 +7,7 @@ import sys
 # from mutagen.flac import FLAC, FLACNoHeaderError  # NOQA
 from anyio import run
 import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_instrument import QueryStats  # pylint: disable=import-error
 from music_meta import MusicMeta  # pylint: disable=import-error
 from orm.models import Album, Song  # NOQA  # pylint: disable=unused-import, disable=import-error
 
@@ -59,13 +60,38 @@ async def main():
                         default='',
                         required=False)
 
+    parser.add_argument("-i", "--index",
+                        help="If provided, the path to the tag index file (see music_index.py) to update with the "
+                             "albums written to the DB",
+                        type=str,
+                        dest='index_path',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-q", "--query_stats",
+                        help="If provided, record the number and time of DB statements per album and log a summary "
+                             "at the end of the run.",
+                        action='store_true',
+                        dest='query_stats',
+                        required=False)
+
+    parser.add_argument("-w", "--slow_ms",
+                        help="If provided, log the DB statements slower than this number of milliseconds, with the "
+                             "album path (implies -q).",
+                        type=float,
+                        dest='slow_ms',
+                        default=None,
+                        required=False)
+
     args = parser.parse_args()
 
     rd = MusicMeta(
         base_dir=args.base_dir,
         check_only=args.check_only,
         max_albums=args.limit,
-        update_records=args.update)
+        update_records=args.update,
+        index_path=args.index_path,
+        query_stats=QueryStats(slow_ms=args.slow_ms) if args.query_stats or args.slow_ms is not None else None)
 
     if args.tags_only:
         await rd.collect_tags()
@@ -0,0 +1,595 @@
+"""
+This module contains benchmarks for the search and ingest code paths.
+DB benchmarks work on temporary tables, so they never touch the album and song data.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import json
+import random
+import re
+import time
+
+from django.db import connection, transaction
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import is_sqlite  # pylint: disable=import-error
+from music_db_search import SEARCH_LOOKUPS, regex_to_sql  # pylint: disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from tag_matcher import TagMatcher  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+DEFAULT_SIZES = '10000,100000,1000000'
+
+# Search: ((regex search, ignore case) of MusicDbSearch, search text)
+TRIGRAM_SEARCHES = {
+    'LIKE': ((False, False), 'c0ffee'),
+    'ILIKE': ((False, True), 'C0FFEE'),
+    '~*': ((True, True), 'c0f+ee[0-9]'),
+}
+
+
+def time_query(cursor, sql, params, repeat=3):
+    """
+    Run a query several times and return the best time.
+    :param cursor: DB cursor
+    :param sql: SQL to run
+    :param params: A list of query parameters
+    :param repeat: Number of runs
+    :return: The best run time in milliseconds as a float
+    """
+    best = None
+
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def search_sql(search, term, table='bench_song'):
+    """
+    Compile the predicate which the DB search (MusicDbSearch.build_filter()) puts on a search column, here the
+    title, into a count of the rows of a song-like table, so that the benchmark runs the SQL the search runs.
+    :param search: (regex search, ignore case), see SEARCH_LOOKUPS
+    :param term: Search text or pattern
+    :param table: Table with a title column
+    :return: A tuple (SQL, list of parameters)
+    """
+    term = regex_to_sql(term) if search[0] else term
+    sql, params = Song.objects.filter(**{f"title__{SEARCH_LOOKUPS[search]}": term}).values('id').query.sql_with_params()
+    sql = sql.replace(connection.ops.quote_name('song'), table)
+
+    return f"SELECT count(*) FROM ({sql}) AS q", list(params)
+
+
+def make_bench_song_table(cursor, size):
+    """
+    Create (or re-create) a temporary song-like table with synthetic text.
+    :param cursor: DB cursor
+    :param size: Number of rows
+    :return: void
+    """
+    cursor.execute("DROP TABLE IF EXISTS bench_song")
+    cursor.execute(
+        "CREATE TEMP TABLE bench_song AS "
+        "SELECT i AS id, md5(i::text) || ' ' || md5((i * 7)::text) AS title "
+        "FROM generate_series(1, %s) AS i", [size])
+    cursor.execute("ANALYZE bench_song")
+
+
+def bench_trigram(sizes, repeat=3):
+    """
+    Measure the latency of the substring and regex queries of the DB search against table size, with and
+    without a trigram index.
+    :param sizes: A list of table sizes (number of rows)
+    :param repeat: Number of runs per query, the best one is reported
+    :return: A list of dictionaries, one per table size and query
+    """
+    results = []
+
+    if is_sqlite():
+        log_it("info", __name__, "Trigram indexes are PostgreSQL only")
+        return results
+
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        queries = {op: search_sql(search, term) for op, (search, term) in TRIGRAM_SEARCHES.items()}
+
+        for size in sizes:
+            make_bench_song_table(cursor, size)
+            no_index = {op: time_query(cursor, sql, params, repeat) for op, (sql, params) in queries.items()}
+
+            cursor.execute("CREATE INDEX ON bench_song USING gin (title gin_trgm_ops)")
+            cursor.execute("ANALYZE bench_song")
+            with_index = {op: time_query(cursor, sql, params, repeat) for op, (sql, params) in queries.items()}
+
+            for op in queries:
+                results.append({
+                    'rows': size,
+                    'query': op,
+                    'seq_ms': round(no_index[op], 2),
+                    'trgm_ms': round(with_index[op], 2),
+                })
+
+        cursor.execute("DROP TABLE IF EXISTS bench_song")
+
+    return results
+
+
+MATCHER_WORDS = ['Miles', 'Davis', 'Coltrane', 'Namysłowski', 'Komeda', 'Évora', 'Bartók', 'Blue', 'Kind', 'Live',
+                 'Jazz', 'Folk', 'Quartet', 'Trio', 'Sonata', 'Concerto', 'Polydor', 'ECM', 'Impulse', 'Verve']
+
+MATCHER_TERMS = ['Mingus', 'Monk', 'Parker', 'Gillespie', 'Ellington', 'Basie', 'Brubeck', 'Evans', 'Hancock',
+                 'Shorter']
+
+
+def make_tag_dicts(size, seed=1):
+    """
+    Generate synthetic tag dictionaries, similar to the ones read from audio files.
+    :param size: Number of dictionaries
+    :param seed: Random seed, so that runs are comparable
+    :return: A list of dictionaries
+    """
+    rnd = random.Random(seed)
+
+    def words(count):
+        return " ".join(rnd.choice(MATCHER_WORDS) for _ in range(count))
+
+    return [{
+        'title': words(3),
+        'artist': words(2),
+        'album': words(3),
+        'genre': words(1),
+        'composer': words(2),
+        'comment': words(40),
+        'track': str(ix % 12 + 1),
+        'year': str(1950 + ix % 70),
+        'duration': 300.5,
+    } for ix in range(size)]
+
+
+def legacy_search_in_tags(tag_dict, find_this, use_regex):
+    """
+    The search done by MusicMetaSearch.search_in_tags() before TagMatcher: one value at a time,
+    compiling the pattern on each call.
+    """
+    for val in tag_dict.values():
+        if use_regex:
+            if re.search(re.compile(find_this), str(val)):
+                return True
+
+            continue
+
+        if find_this in str(val):
+            return True
+
+    return False
+
+
+def time_calls(func, items, repeat=3):
+    """
+    Call a function on each item several times and return the best time.
+    :param func: A function taking one item
+    :param items: A list of items
+    :param repeat: Number of runs
+    :return: The best run time in milliseconds as a float
+    """
+    best = None
+
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+
+        for item in items:
+            func(item)
+
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def bench_matcher(sizes, repeat=3):
+    """
+    Compare the legacy per-value search with TagMatcher on synthetic tag dictionaries, for 1 and 10 terms
+    (none of which are found, the costliest case as every value has to be scanned).
+    :param sizes: A list of corpus sizes (number of tag dictionaries)
+    :param repeat: Number of runs, the best one is reported
+    :return: A list of dictionaries, one per corpus size and search
+    """
+    results = []
+
+    for size in sizes:
+        corpus = make_tag_dicts(size)
+
+        for use_regex in [False, True]:
+            for term_count in [1, len(MATCHER_TERMS)]:
+                terms = MATCHER_TERMS[:term_count]
+                matcher = TagMatcher(terms, use_regex=use_regex)
+                folding_matcher = TagMatcher(terms, use_regex=use_regex, ignore_case=True)
+                legacy_ms = time_calls(
+                    lambda tags, t=terms, rx=use_regex: any(legacy_search_in_tags(tags, term, rx) for term in t),
+                    corpus, repeat)
+
+                results.append({
+                    'dicts': size,
+                    'regex': use_regex,
+                    'terms': term_count,
+                    'legacy_ms': round(legacy_ms, 2),
+                    'matcher_ms': round(time_calls(matcher.matches, corpus, repeat), 2),
+                    'matcher_i_ms': round(time_calls(folding_matcher.matches, corpus, repeat), 2),
+                })
+
+    return results
+
+
+# Search texts of the lookup check, which differ in case only
+LOOKUP_CHECK_TERMS = ['Miles', 'miles', 'MILES', 'Quartet', 'QUARTET']
+
+
+def bench_lookups(sizes, repeat=3):
+    """
+    Check that the lookups of the DB search (SEARCH_LOOKUPS) find the same songs as the matcher of the fs search
+    on the current backend, in particular that case is ignored only when asked, and measure their latency.
+    :param sizes: A list of table sizes (number of songs)
+    :param repeat: Number of runs per query, the best one is reported
+    :return: A list of dictionaries, one per table size, lookup and search text
+    """
+    results = []
+
+    with connection.cursor() as cursor:
+        for size in sizes:
+            titles = [tag_dict['title'] for tag_dict in make_tag_dicts(size)]
+            cursor.execute("DROP TABLE IF EXISTS bench_song")
+            cursor.execute("CREATE TEMP TABLE bench_song (id integer PRIMARY KEY, title text)")
+            cursor.executemany("INSERT INTO bench_song (id, title) VALUES (%s, %s)", list(enumerate(titles, 1)))
+
+            for search, lookup in SEARCH_LOOKUPS.items():
+                for term in LOOKUP_CHECK_TERMS:
+                    sql, params = search_sql(search, term)
+                    cursor.execute(sql, params)
+                    db_rows = cursor.fetchone()[0]
+                    matcher = TagMatcher([term], use_regex=search[0], ignore_case=search[1])
+                    py_rows = sum(1 for title in titles if matcher.matches({'title': title}))
+
+                    results.append({
+                        'rows': size,
+                        'lookup': lookup,
+                        'term': term,
+                        'db_rows': db_rows,
+                        'py_rows': py_rows,
+                        'same': db_rows == py_rows,
+                        'ms': round(time_query(cursor, sql, params, repeat), 2),
+                    })
+
+        cursor.execute("DROP TABLE IF EXISTS bench_song")
+
+    if not all(res['same'] for res in results):
+        log_it("error", __name__, "The DB search and the fs search find different songs")
+
+    return results
+
+
+SONGS_PER_ALBUM = 10
+
+# Lookups of the ingest writer and the search paths; the song one by title, file and artist is the key of
+# the former get-then-save writer, which the upsert no longer needs:
+LOOKUP_QUERIES = {
+    'album(path)': "SELECT id FROM bench_album WHERE path = %s",
+    'song(album_id)': "SELECT id FROM bench_song WHERE album_id = %s",
+    'song(album_id, file)': "SELECT id FROM bench_song WHERE album_id = %s AND file = %s",
+    'song(title, file, artist)': "SELECT id FROM bench_song WHERE title = %s AND file = %s AND artist = %s",
+}
+
+# The natural-key indexes of migration 0008:
+NATURAL_KEY_INDEXES = [
+    "CREATE UNIQUE INDEX bench_album_path_key ON bench_album (path)",
+    "CREATE UNIQUE INDEX bench_song_album_file_key ON bench_song (album_id, file)",
+]
+
+# Integers 1 to %s, in SQL both backends run (instead of generate_series()):
+SEQUENCE_CTE = "WITH RECURSIVE seq (i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < %s) "
+
+BENCH_SONG_UPSERT_SQL = (
+    "INSERT INTO bench_song AS s (album_id, file, title, artist) VALUES {rows} "
+    "ON CONFLICT (album_id, file) DO UPDATE SET title = EXCLUDED.title, artist = EXCLUDED.artist "
+    "WHERE (s.title, s.artist) IS DISTINCT FROM (EXCLUDED.title, EXCLUDED.artist) RETURNING id"
+)
+
+
+def bench_album_path(album_id):
+    """
+    Get the path of a synthetic album, the same as make_bench_library_tables() writes.
+    """
+    return f"dir/{album_id:08d}"
+
+
+def bench_song_file(song_id):
+    """
+    Get the file name of a synthetic song, the same as make_bench_library_tables() writes.
+    """
+    return f"{(song_id - 1) % SONGS_PER_ALBUM + 1:02d}.flac"
+
+
+def make_bench_library_tables(cursor, size):
+    """
+    Create (or re-create) temporary album- and song-like tables, without indexes other than the primary keys.
+    :param cursor: DB cursor
+    :param size: Number of songs, there is one album per SONGS_PER_ALBUM songs
+    :return: void
+    """
+    id_column = "id integer PRIMARY KEY" if is_sqlite() else "id bigserial PRIMARY KEY"
+    cursor.execute("DROP TABLE IF EXISTS bench_song")
+    cursor.execute("DROP TABLE IF EXISTS bench_album")
+    cursor.execute(f"CREATE TEMP TABLE bench_album ({id_column}, title text, artist text, path text)")
+    cursor.execute(f"CREATE TEMP TABLE bench_song ({id_column}, album_id bigint, file text, title text, artist text)")
+    cursor.execute(
+        "INSERT INTO bench_album (id, title, artist, path) " + SEQUENCE_CTE +
+        "SELECT i, 'Album ' || i, 'Artist ' || (i %% 997), 'dir/' || substr(CAST(100000000 + i AS text), 2) "
+        "FROM seq", [max(1, size // SONGS_PER_ALBUM)])
+    cursor.execute(
+        "INSERT INTO bench_song (id, album_id, file, title, artist) " + SEQUENCE_CTE +
+        "SELECT i, (i - 1) / %s + 1, substr(CAST(100 + (i - 1) %% %s + 1 AS text), 2) || '.flac', 'Song ' || i, "
+        "'Artist ' || (((i - 1) / %s + 1) %% 997) "
+        "FROM seq", [size, SONGS_PER_ALBUM, SONGS_PER_ALBUM, SONGS_PER_ALBUM])
+
+    if not is_sqlite():
+        cursor.execute("SELECT setval('bench_album_id_seq', (SELECT max(id) FROM bench_album))")
+        cursor.execute("SELECT setval('bench_song_id_seq', (SELECT max(id) FROM bench_song))")
+
+    cursor.execute("ANALYZE bench_album")
+    cursor.execute("ANALYZE bench_song")
+
+
+def lookup_params(size):
+    """
+    Get the parameters of LOOKUP_QUERIES for a song in the middle of the tables.
+    :param size: Number of songs
+    :return: A dictionary: lookup -> list of parameters
+    """
+    song_id = max(1, size // 2)
+    album_id = (song_id - 1) // SONGS_PER_ALBUM + 1
+
+    return {
+        'album(path)': [bench_album_path(album_id)],
+        'song(album_id)': [album_id],
+        'song(album_id, file)': [album_id, bench_song_file(song_id)],
+        'song(title, file, artist)': [f"Song {song_id}", bench_song_file(song_id), f"Artist {album_id % 997}"],
+    }
+
+
+def plan_node(cursor, sql, params):
+    """
+    Get the top node type of a query plan, e.g. 'Seq Scan' or 'Index Scan' (on SQLite the first step,
+    e.g. 'SCAN bench_song' or 'SEARCH bench_song USING INDEX ...').
+    """
+    if is_sqlite():
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+
+        return cursor.fetchone()[-1]
+
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+
+    return plan[0]['Plan']['Node Type']
+
+
+def bench_plans(sizes, repeat=3):
+    """
+    Show the plan and latency of the writer and search lookups against table size, before and after
+    the natural-key indexes of migration 0008.
+    :param sizes: A list of table sizes (number of songs)
+    :param repeat: Number of runs per query, the best one is reported
+    :return: A list of dictionaries, one per table size and lookup
+    """
+    results = []
+
+    with connection.cursor() as cursor:
+        for size in sizes:
+            make_bench_library_tables(cursor, size)
+            params = lookup_params(size)
+            before = {name: (plan_node(cursor, sql, params[name]), time_query(cursor, sql, params[name], repeat))
+                      for name, sql in LOOKUP_QUERIES.items()}
+
+            for index_sql in NATURAL_KEY_INDEXES:
+                cursor.execute(index_sql)
+
+            cursor.execute("ANALYZE bench_album")
+            cursor.execute("ANALYZE bench_song")
+            after = {name: (plan_node(cursor, sql, params[name]), time_query(cursor, sql, params[name], repeat))
+                     for name, sql in LOOKUP_QUERIES.items()}
+
+            for name in LOOKUP_QUERIES:
+                results.append({
+                    'rows': size,
+                    'lookup': name,
+                    'before_plan': before[name][0],
+                    'before_ms': round(before[name][1], 3),
+                    'after_plan': after[name][0],
+                    'after_ms': round(after[name][1], 3),
+                })
+
+        cursor.execute("DROP TABLE IF EXISTS bench_song")
+        cursor.execute("DROP TABLE IF EXISTS bench_album")
+
+    return results
+
+
+def reingest_rows(size, albums):
+    """
+    Get the song rows of re-ingested albums: every other title has changed and each album has a new file.
+    :param size: Number of songs in the tables
+    :param albums: Number of albums to re-ingest
+    :return: A list of lists of (album_id, file, title, artist) tuples, one list per album
+    """
+    album_count = max(1, size // SONGS_PER_ALBUM)
+    album_rows = []
+
+    for album_id in range(1, min(albums, album_count) + 1):
+        first = (album_id - 1) * SONGS_PER_ALBUM + 1
+        artist = f"Artist {album_id % 997}"
+        rows = [(album_id, bench_song_file(song_id), f"Song {song_id}" + (' (live)' if song_id % 2 else ''), artist)
+                for song_id in range(first, first + SONGS_PER_ALBUM)]
+        rows.append((album_id, f"{SONGS_PER_ALBUM + 1:02d}.flac", f"Bonus {album_id}", artist))
+        album_rows.append(rows)
+
+    return album_rows
+
+
+def legacy_write_album(cursor, rows):
+    """
+    Write the songs of an album row by row, as the former writer did: look each one up by its key, then
+    update or insert it.
+    :return: Number of statements run
+    """
+    statements = 0
+
+    for album_id, file_name, title, artist in rows:
+        cursor.execute("SELECT id, title FROM bench_song WHERE album_id = %s AND file = %s", [album_id, file_name])
+        found = cursor.fetchone()
+        statements += 1
+
+        if not found:
+            cursor.execute("INSERT INTO bench_song (album_id, file, title, artist) VALUES (%s, %s, %s, %s)",
+                           [album_id, file_name, title, artist])
+            statements += 1
+        elif found[1] != title:
+            cursor.execute("UPDATE bench_song SET title = %s, artist = %s WHERE id = %s", [title, artist, found[0]])
+            statements += 1
+
+    return statements
+
+
+def upsert_write_album(cursor, rows):
+    """
+    Write the songs of an album with one INSERT ... ON CONFLICT DO UPDATE statement.
+    :return: Number of statements run
+    """
+    sql = BENCH_SONG_UPSERT_SQL.format(rows=', '.join(['(%s, %s, %s, %s)'] * len(rows)))
+    cursor.execute(sql, [val for row in rows for val in row])
+    cursor.fetchall()
+
+    return 1
+
+
+def time_writes(write_album, album_rows, repeat):
+    """
+    Time writing albums; each run is rolled back so that every one starts from the same tables.
+    :return: A tuple (best run time in milliseconds, number of statements per run)
+    """
+    best = None
+    statements = 0
+
+    for _ in range(max(1, repeat)):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                start = time.perf_counter()
+                statements = sum(write_album(cursor, rows) for rows in album_rows)
+                elapsed = (time.perf_counter() - start) * 1000
+
+            transaction.set_rollback(True)
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, statements
+
+
+def bench_upsert(sizes, repeat=3, albums=100):
+    """
+    Compare the former get-then-save writer with one upsert per album, both on indexed tables,
+    re-ingesting albums in which half the songs have changed and one is new.
+    :param sizes: A list of table sizes (number of songs)
+    :param repeat: Number of runs, the best one is reported
+    :param albums: Number of albums re-ingested per run
+    :return: A list of dictionaries, one per table size
+    """
+    results = []
+
+    for size in sizes:
+        with connection.cursor() as cursor:
+            make_bench_library_tables(cursor, size)
+
+            for index_sql in NATURAL_KEY_INDEXES:
+                cursor.execute(index_sql)
+
+        album_rows = reingest_rows(size, albums)
+        legacy_ms, legacy_statements = time_writes(legacy_write_album, album_rows, repeat)
+        upsert_ms, upsert_statements = time_writes(upsert_write_album, album_rows, repeat)
+        results.append({
+            'rows': size,
+            'albums': len(album_rows),
+            'legacy_statements': legacy_statements,
+            'legacy_ms': round(legacy_ms, 2),
+            'upsert_statements': upsert_statements,
+            'upsert_ms': round(upsert_ms, 2),
+        })
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS bench_song")
+        cursor.execute("DROP TABLE IF EXISTS bench_album")
+
+    return results
+
+
+BENCHMARKS = {
+    'trigram': bench_trigram,
+    'matcher': bench_matcher,
+    'lookups': bench_lookups,
+    'plans': bench_plans,
+    'upsert': bench_upsert,
+}
+
+
+def print_results(results):
+    """
+    Print benchmark results as a table.
+    :param results: A list of dictionaries with the same keys
+    :return: void
+    """
+    if not results:
+        return
+
+    columns = list(results[0].keys())
+    widths = {col: max(len(col), *(len(str(res[col])) for res in results)) for col in columns}
+    print("  ".join(col.rjust(widths[col]) for col in columns))
+
+    for res in results:
+        print("  ".join(str(res[col]).rjust(widths[col]) for col in columns))
+
+
+PROGRAM_DESCRIPTION = "This program runs search and ingest benchmarks."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-b", "--bench",
+                        help="Benchmark to run.",
+                        type=str,
+                        dest='bench',
+                        choices=list(BENCHMARKS.keys()),
+                        required=True)
+
+    parser.add_argument("-s", "--sizes",
+                        help=f"Comma-separated data sizes to run the benchmark for, default: {DEFAULT_SIZES}.",
+                        type=str,
+                        dest='sizes',
+                        default=DEFAULT_SIZES,
+                        required=False)
+
+    parser.add_argument("-r", "--repeat",
+                        help="Number of runs per measurement, the best one is reported.",
+                        type=int,
+                        dest='repeat',
+                        default=3,
+                        required=False)
+
+    args = parser.parse_args()
+
+    print_results(BENCHMARKS[args.bench]([int(size) for size in args.sizes.split(',') if size], args.repeat))
@@ -0,0 +1,374 @@
+"""
+This module hosts the class MusicDbSearch.
+It runs the plain-text and regex searches offered by MusicMetaSearch against the
+album and song tables populated by MusicMeta, instead of re-reading audio files.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import datetime
+
+from django.db.models import CharField, Lookup, Q, TextField
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import is_sqlite  # pylint: disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from search_query import SearchQuery  # pylint: disable=import-error
+from tag_matcher import TagMatcher  # pylint: disable=import-error
+from utils import eval_bool, log_it  # pylint: disable=import-error
+
+SONG_SEARCH_FIELDS = ['title', 'artist', 'composer', 'performer', 'genre', 'comment']
+ALBUM_SEARCH_FIELDS = ['album__title', 'album__artist', 'album__label', 'album__comment']
+
+DB_FETCH_CHUNK = 2000
+
+# (regex search, ignore case) -> lookup of the search columns, see build_filter()
+SEARCH_LOOKUPS = {
+    (False, False): 'casecontains',
+    (False, True): 'ilikecontains',
+    (True, False): 'regex',
+    (True, True): 'iregex',
+}
+
+# Python regex constructs which PostgreSQL (ARE) either lacks or interprets differently:
+PY_ONLY_REGEX_CONSTRUCTS = ['(?P', '(?(', '(?>', '(?<', '(?a', '(?L', '(?u', '(?x', '(?s', '(?m',
+                            '*+', '++', '?+', '}+', '\\N{']
+PY_TO_SQL_ESCAPES = {'b': '\\y', 'B': '\\Y'}
+
+
+class CaseContains(Lookup):
+    """
+    Case-sensitive substring lookup, e.g. Song.objects.filter(title__casecontains='Blue'). PostgreSQL runs it as
+    column LIKE pattern; SQLite's LIKE ignores case (also for Django's contains), so it runs instr() there.
+    """
+    lookup_name = 'casecontains'
+    prepare_rhs = False
+
+    def get_db_prep_lookup(self, value, connection):
+        if connection.vendor == 'sqlite':
+            return '%s', [value]
+
+        return '%s', [f"%{connection.ops.prep_for_like_query(value)}%"]
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+
+        return f"{lhs} LIKE {rhs}", [*lhs_params, *rhs_params]
+
+    def as_sqlite(self, compiler, connection):  # pylint: disable=missing-function-docstring
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+
+        return f"instr({lhs}, {rhs}) > 0", [*lhs_params, *rhs_params]
+
+
+class ILikeContains(Lookup):
+    """
+    Case-insensitive substring lookup, e.g. Song.objects.filter(title__ilikecontains='blue'). PostgreSQL runs it
+    as column ILIKE pattern, which the trigram indexes on the columns (migration 0004) serve, unlike the
+    UPPER(column) LIKE UPPER(pattern) of Django's icontains; SQLite's LIKE ignores case as it is.
+    """
+    lookup_name = 'ilikecontains'
+    prepare_rhs = False
+
+    def get_db_prep_lookup(self, value, connection):
+        return '%s', [f"%{connection.ops.prep_for_like_query(value)}%"]
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+
+        return f"{lhs} ILIKE {rhs}", [*lhs_params, *rhs_params]
+
+    def as_sqlite(self, compiler, connection):  # pylint: disable=missing-function-docstring
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+
+        return f"{lhs} LIKE {rhs} ESCAPE '\\'", [*lhs_params, *rhs_params]
+
+
+for text_lookup in [CaseContains, ILikeContains]:
+    TextField.register_lookup(text_lookup)
+    CharField.register_lookup(text_lookup)
+
+
+def regex_to_sql(pattern):
+    """
+    Translate a Python regex pattern to a PostgreSQL (ARE) pattern usable with ~ or ~*.
+    :param pattern: A Python regex pattern as a string
+    :return: The translated pattern as a string or None if the pattern cannot be expressed in PostgreSQL
+    """
+    if not pattern:
+        return None
+
+    # Lookbehind is fine, other '(?<' constructs (named groups) are not:
+    check_str = pattern.replace('(?<=', '').replace('(?<!', '')
+
+    if any(construct in check_str for construct in PY_ONLY_REGEX_CONSTRUCTS):
+        return None
+
+    out_parts = []
+    in_class = False
+    ix = 0
+
+    while ix < len(pattern):
+        char = pattern[ix]
+
+        if char == '\\' and ix + 1 < len(pattern):
+            escaped = pattern[ix + 1]
+            out_parts.append(PY_TO_SQL_ESCAPES.get(escaped, char + escaped) if not in_class else char + escaped)
+            ix += 2
+            continue
+
+        if char == '[' and not in_class:
+            in_class = True
+        elif char == ']' and in_class and not pattern[ix - 1] == '[':
+            in_class = False
+
+        out_parts.append(char)
+        ix += 1
+
+    return "".join(out_parts)
+
+
+class MusicDbSearch:
+    """
+    This class searches music metadata held in the DB (tables album and song).
+    """
+
+    def __init__(self, find_txt=None, use_regex=False, max_albums=None, ignore_case=False, match_all=False,
+                 query=None, on_match=None):
+        self._tags = {}
+        self._find_this = self._rx_search = self._ignore_case = self._match_all = self._query = None
+        self._max_albums = -1
+        self.tags = {}
+        self.find_this = find_txt
+        self.rx_search = use_regex
+        self.ignore_case = ignore_case
+        self.match_all = match_all
+        self.max_albums = max_albums
+        self.query = query
+        self.on_match = on_match
+        self.albums_seen = set()
+
+    @property
+    def tags(self):  # pylint: disable=missing-function-docstring
+        return self._tags
+
+    @tags.setter
+    def tags(self, in_tags):
+        self._tags = {**self._tags, **in_tags}
+
+    @property
+    def find_this(self):
+        """
+        This property holds the text to search for or a regex pattern
+        to use in the search, or a list of such strings.
+        """
+        return self._find_this
+
+    @find_this.setter
+    def find_this(self, in_find_what):
+        self._find_this = in_find_what
+
+    @property
+    def rx_search(self):
+        """
+        This property indicates whether to use regex search.
+        """
+        return self._rx_search
+
+    @rx_search.setter
+    def rx_search(self, in_val):
+        self._rx_search = eval_bool(in_val)
+
+    @property
+    def ignore_case(self):
+        """
+        This property indicates whether the search is case-insensitive (ILIKE, ~*).
+        """
+        return self._ignore_case
+
+    @ignore_case.setter
+    def ignore_case(self, in_val):
+        self._ignore_case = eval_bool(in_val)
+
+    @property
+    def match_all(self):
+        """
+        This property indicates whether all the search terms must be found (otherwise any will do).
+        """
+        return self._match_all
+
+    @match_all.setter
+    def match_all(self, in_val):
+        self._match_all = eval_bool(in_val)
+
+    @property
+    def terms(self):
+        """
+        This property holds the search terms as a list of strings.
+        """
+        if not self.find_this:
+            return []
+
+        return [self.find_this] if isinstance(self.find_this, str) else [term for term in self.find_this if term]
+
+    @property
+    def query(self):
+        """
+        This property holds a SearchQuery (field-scoped query), used instead of find_this when set.
+        """
+        return self._query
+
+    @query.setter
+    def query(self, in_query):
+        self._query = SearchQuery(in_query) if isinstance(in_query, str) and in_query.strip() else in_query or None
+
+    @property
+    def max_albums(self):  # pylint: disable=missing-function-docstring
+        return self._max_albums
+
+    @max_albums.setter
+    def max_albums(self, in_limit):
+        self._max_albums = int(in_limit if in_limit else -1)
+
+    def sql_search_terms(self):
+        """
+        Get the search terms to pass to the DB: the search text or the regex patterns translated for PostgreSQL.
+        On SQLite, Django runs regex lookups with Python's re module, so patterns are passed as they are.
+        :return: A list of strings or None if a regex pattern cannot be run in the DB
+        """
+        if not self.rx_search or is_sqlite():
+            return self.terms
+
+        sql_terms = [regex_to_sql(term) for term in self.terms]
+
+        return None if None in sql_terms else sql_terms
+
+    def build_filter(self, search_terms):
+        """
+        Build the filter matching songs in which the search texts (or patterns) appear in
+        the song or album text columns (see SEARCH_LOOKUPS). Substrings become LIKE/ILIKE and patterns ~/~*
+        predicates on the columns as they are, all of which can use the trigram indexes on these columns.
+        :param search_terms: A list of texts or patterns to search for
+        :return: A Q object to pass to a Song queryset
+        """
+        lookup = '__' + SEARCH_LOOKUPS[(self.rx_search, self.ignore_case)]
+        song_filter = Q()
+
+        for search_term in search_terms:
+            term_filter = Q()
+
+            for field in SONG_SEARCH_FIELDS + ALBUM_SEARCH_FIELDS:
+                term_filter |= Q(**{field + lookup: search_term})
+
+            song_filter = (song_filter & term_filter) if self.match_all else (song_filter | term_filter)
+
+        return song_filter
+
+    @staticmethod
+    def song_values(song):
+        """
+        Get the values of the searchable song and album columns.
+        :param song: Song instance with the related Album selected
+        :return: A list of strings
+        """
+        values = [getattr(song, field) for field in SONG_SEARCH_FIELDS]
+
+        if song.album:
+            values += [getattr(song.album, field.split('__')[-1]) for field in ALBUM_SEARCH_FIELDS]
+
+        return [val for val in values if val]
+
+    def python_matcher(self):
+        """
+        Compile the search terms for rows which have to be filtered in Python.
+        :return: A TagMatcher instance
+        """
+        return TagMatcher(self.terms, match_all=self.match_all, use_regex=self.rx_search, ignore_case=self.ignore_case)
+
+    @staticmethod
+    def song_as_tags(song):
+        """
+        Convert a Song row (and its Album) to the dictionary written by MusicMetaSearch for an audio file.
+        :param song: Song instance with the related Album selected
+        :return: A dictionary of tags
+        """
+        album = song.album
+        tag_dict = {
+            'directory': album.path if album else '',
+            'file': song.file or '',
+            'title': song.title,
+            'artist': song.artist,
+            'albumartist': song.performer,
+            'composer': song.composer,
+            'genre': song.genre,
+            'album': album.title if album else None,
+            'label': album.label if album else None,
+            'track': str(song.track_id) if song.track_id and song.track_id > 0 else None,
+            'year': str(song.date.year) if song.date else None,
+        }
+
+        tag_dict = {k: v for k, v in tag_dict.items() if v}
+        tag_dict['comment'] = song.comment or ''
+
+        return tag_dict
+
+    def save_album_tags(self, dir_name, dir_tags):
+        """
+        Save the tags of a matching album in `self.tags` or, if on_match is set, pass them on
+        so that they need not be kept.
+        :param dir_name: The name of the album/CD directory
+        :param dir_tags: A list of tag dictionaries
+        :return: True if max_albums albums have been found, otherwise False
+        """
+        self.albums_seen.add(dir_name)
+
+        if self.on_match:
+            self.on_match(dir_name, dir_tags)
+        else:
+            self.tags[dir_name] = dir_tags
+
+        return len(self.albums_seen) >= self.max_albums > 0
+
+    def collect_tags(self):
+        """
+        Find songs matching the search criteria and save the first matching song of each album in `self.tags`,
+        keyed by album path, i.e. the same way as MusicMetaSearch.collect_tags().
+        :return: void
+        """
+        start_time = datetime.datetime.now()
+
+        if not self.terms and not self.query:
+            log_it("info", __name__, f"No search criteria provided ({self.find_this})")
+            return
+
+        songs = Song.objects.select_related('album').order_by('album__path', 'track_id', 'id')  # NOQA
+        search_terms = None if self.query else self.sql_search_terms()
+        py_matcher = None
+
+        if self.query:
+            songs = songs.filter(self.query.to_q())
+        elif search_terms is not None:
+            songs = songs.filter(self.build_filter(search_terms))
+        else:
+            log_it("info", __name__, f"Pattern {self.find_this} cannot run in the DB, filtering rows in Python")
+            py_matcher = self.python_matcher()
+
+        for song in songs.iterator(chunk_size=DB_FETCH_CHUNK):
+            dir_name = song.album.path if song.album else ''
+
+            if dir_name in self.albums_seen:
+                continue
+
+            if py_matcher and not py_matcher.matches(dict(enumerate(self.song_values(song)))):
+                continue
+
+            if self.save_album_tags(dir_name, [self.song_as_tags(song)]):
+                break
+
+        log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
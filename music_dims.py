@@ -0,0 +1,327 @@
+"""
+This module hosts the class MusicDimensions.
+The free-text columns song.artist, performer, genre and composer often hold lists, e.g. "Miles Davis, John
+Coltrane". MusicDimensions splits them into names, each of which is a row of a dimension table (artist, genre,
+composer), and links songs to them (song_artist, song_genre, song_composer), so that filtering songs or albums
+by one of these names is an integer join over indexed columns.
+The ingest writer links each album it writes (link_album()); rebuild() re-links the whole library.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import json
+import re
+
+from django.db import connection, transaction
+from django.db.models import Q
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import clear_tables  # pylint: disable=import-error
+from orm.models import Album, Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from utils import fold_text, log_it  # pylint: disable=import-error
+
+ROLE_ARTIST = 0
+ROLE_PERFORMER = 1
+
+# Composers are written "Last, First" (see TagSetter.set_artist_composer), so a comma does not separate them:
+LIST_SEPARATORS = re.compile(r'\s*[;,/]\s*')
+COMPOSER_SEPARATORS = re.compile(r'\s*[;/]\s*')
+
+# Dimension: the song columns linked to it, with the role of each (None if the link table has no role column)
+DIMENSIONS = {
+    'artist': {'artist': ROLE_ARTIST, 'performer': ROLE_PERFORMER},
+    'genre': {'genre': None},
+    'composer': {'composer': None},
+}
+
+SEPARATORS = {
+    'artist': LIST_SEPARATORS,
+    'genre': LIST_SEPARATORS,
+    'composer': COMPOSER_SEPARATORS,
+}
+
+SONG_COLUMNS = ['id', 'artist', 'performer', 'genre', 'composer']
+DB_FETCH_CHUNK = 5000
+INSERT_CHUNK = 1000
+
+
+def name_key(name):
+    """
+    Get the key identifying a name: folded (see fold_text()) with whitespace collapsed.
+    :param name: A name
+    :return: A string
+    """
+    return ' '.join(fold_text(name).split())
+
+
+def split_names(dim, text):
+    """
+    Split a song column into the names it lists.
+    :param dim: A key of DIMENSIONS
+    :param text: Column value
+    :return: A list of (key, name) tuples, without duplicates
+    """
+    names = {}
+
+    for name in SEPARATORS[dim].split(text or ''):
+        key = name_key(name)
+
+        if key and key not in names:
+            names[key] = name.strip()
+
+    return list(names.items())
+
+
+def insert_rows(cursor, sql, rows, width):
+    """
+    Run a multi-row INSERT in chunks.
+    :param cursor: DB cursor
+    :param sql: INSERT statement with a {rows} placeholder for the VALUES list
+    :param rows: A list of tuples
+    :param width: Number of values per row
+    :return: A list of the rows returned by the statement if it has a RETURNING clause, otherwise an empty list
+    """
+    returned = []
+    row_sql = f"({', '.join(['%s'] * width)})"
+
+    for ix in range(0, len(rows), INSERT_CHUNK):
+        chunk = rows[ix:ix + INSERT_CHUNK]
+        cursor.execute(sql.format(rows=', '.join([row_sql] * len(chunk))), [val for row in chunk for val in row])
+
+        if cursor.description:
+            returned += cursor.fetchall()
+
+    return returned
+
+
+class MusicDimensions:
+    """
+    This class maintains the dimension and link tables, with an in-memory cache of dimension IDs
+    so that linking an album only inserts names not seen before.
+    """
+
+    def __init__(self):
+        self._ids = {dim: {} for dim in DIMENSIONS}
+        self._loaded = False
+
+    def load_ids(self):
+        """
+        Load the IDs of every dimension row into the cache.
+        :return: void
+        """
+        with connection.cursor() as cursor:
+            for dim, ids in self._ids.items():
+                cursor.execute(f"SELECT name_key, id FROM {dim}")
+                ids.update(cursor.fetchall())
+
+        self._loaded = True
+
+    def ids(self, dim, names):
+        """
+        Get the IDs of names, inserting the names which are not in the dimension table yet.
+        :param dim: A key of DIMENSIONS
+        :param names: A list of (key, name) tuples
+        :return: A dictionary: key -> ID
+        """
+        if not self._loaded:
+            self.load_ids()
+
+        cache = self._ids[dim]
+        missing = {key: name for key, name in names if key not in cache}
+
+        if missing:
+            # DO UPDATE (not DO NOTHING) so that names inserted meanwhile by another writer are returned too:
+            sql = f"INSERT INTO {dim} (name_key, name) VALUES {{rows}} " \
+                  "ON CONFLICT (name_key) DO UPDATE SET name_key = EXCLUDED.name_key RETURNING name_key, id"
+
+            with connection.cursor() as cursor:
+                cache.update(insert_rows(cursor, sql, list(missing.items()), 2))
+
+        return {key: cache[key] for key, _ in names}
+
+    def song_links(self, song_rows):
+        """
+        Get the links of songs.
+        :param song_rows: An iterable of tuples (see SONG_COLUMNS)
+        :return: A dictionary: dimension -> list of link rows (song ID, dimension ID[, role])
+        """
+        song_rows = list(song_rows)
+        links = {}
+
+        for dim, columns in DIMENSIONS.items():
+            song_names = [(row[0], role, split_names(dim, row[SONG_COLUMNS.index(column)]))
+                          for row in song_rows for column, role in columns.items()]
+            ids = self.ids(dim, list({key: name for _, _, names in song_names for key, name in names}.items()))
+            links[dim] = sorted({(song_id, ids[key]) if role is None else (song_id, ids[key], role)
+                                 for song_id, role, names in song_names for key, _ in names})
+
+        return links
+
+    @staticmethod
+    def write_links(cursor, links):
+        """
+        Insert link rows.
+        :param cursor: DB cursor
+        :param links: A dictionary: dimension -> list of link rows (see song_links())
+        :return: void
+        """
+        for dim, dim_links in links.items():
+            columns = ['song_id', f'{dim}_id'] + (['role'] if dim == 'artist' else [])
+            sql = f"INSERT INTO song_{dim} ({', '.join(columns)}) VALUES {{rows}} ON CONFLICT DO NOTHING"
+            insert_rows(cursor, sql, dim_links, len(columns))
+
+    def link_album(self, album_id):
+        """
+        Re-link the songs of an album, called by the ingest writer after the album has been written.
+        Names no longer used by any song are left in the dimension tables until the next rebuild().
+        :param album_id: ID of the album
+        :return: void
+        """
+        song_rows = list(Song.objects.filter(album_id=album_id).values_list(*SONG_COLUMNS))  # NOQA
+        song_ids = [row[0] for row in song_rows]
+        links = self.song_links(song_rows)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            for dim in DIMENSIONS:
+                for ix in range(0, len(song_ids), INSERT_CHUNK):
+                    chunk_ids = song_ids[ix:ix + INSERT_CHUNK]
+                    cursor.execute(f"DELETE FROM song_{dim} WHERE song_id IN ({', '.join(['%s'] * len(chunk_ids))})",
+                                   chunk_ids)
+
+            self.write_links(cursor, links)
+
+    def rebuild(self):
+        """
+        Re-link every song and drop the names no song uses.
+        :return: A dictionary: table -> number of rows
+        """
+        start_time = datetime.datetime.now()
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                clear_tables(cursor, [f'song_{dim}' for dim in DIMENSIONS])
+                chunk = []
+
+                for row in Song.objects.values_list(*SONG_COLUMNS).iterator(chunk_size=DB_FETCH_CHUNK):  # NOQA
+                    chunk.append(row)
+
+                    if len(chunk) >= DB_FETCH_CHUNK:
+                        self.write_links(cursor, self.song_links(chunk))
+                        chunk = []
+
+                self.write_links(cursor, self.song_links(chunk))
+
+                for dim in DIMENSIONS:
+                    cursor.execute(f"DELETE FROM {dim} WHERE NOT EXISTS "
+                                   f"(SELECT 1 FROM song_{dim} l WHERE l.{dim}_id = {dim}.id)")
+                    cursor.execute(f"ANALYZE song_{dim}")
+
+                counts = {}
+
+                for table in [table for dim in DIMENSIONS for table in [dim, f'song_{dim}']]:
+                    cursor.execute(f"SELECT count(*) FROM {table}")
+                    counts[table] = cursor.fetchone()[0]
+
+        # Deleted names may still be cached:
+        self._ids = {dim: {} for dim in DIMENSIONS}
+        self._loaded = False
+        log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
+
+        return counts
+
+
+def facet_q(dim, name, role=None, prefix=''):
+    """
+    Build a filter on a dimension: the songs (or albums) linked to a name, by an integer join.
+    :param dim: A key of DIMENSIONS
+    :param name: A name, matched by its key (case- and accent-insensitive)
+    :param role: ROLE_ARTIST or ROLE_PERFORMER to restrict artist links to a role, None for any
+    :param prefix: Lookup prefix of the song relation, e.g. 'songs__' ('' for a Song queryset)
+    :return: A Q object
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT id FROM {dim} WHERE name_key = %s", [name_key(name)])
+        row = cursor.fetchone()
+
+    if not row:
+        return Q(pk__in=[])
+
+    link_filter = Q(**{f"{prefix}{dim}_links__{dim}": row[0]})
+
+    if role is not None:
+        link_filter &= Q(**{f"{prefix}{dim}_links__role": role})
+
+    return link_filter
+
+
+def facet_albums(dim, name, role=None):
+    """
+    Get the albums with songs linked to a name, e.g. all albums with a composer.
+    :param dim: A key of DIMENSIONS
+    :param name: A name
+    :param role: See facet_q()
+    :return: A list of dictionaries
+    """
+    albums = Album.objects.filter(facet_q(dim, name, role, prefix='song__')).distinct()  # NOQA
+
+    return list(albums.order_by('path').values('id', 'title', 'artist', 'path'))
+
+
+def top_names(dim, limit=50):
+    """
+    Get the names of a dimension with the most songs.
+    :param dim: A key of DIMENSIONS
+    :param limit: Max number of names
+    :return: A list of dictionaries with name and songs
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT d.name, count(*) AS songs FROM song_{dim} l JOIN {dim} d ON d.id = l.{dim}_id "
+                       "GROUP BY d.name ORDER BY songs DESC, d.name LIMIT %s", [limit])
+
+        return [{'name': name, 'songs': songs} for name, songs in cursor.fetchall()]
+
+
+PROGRAM_DESCRIPTION = "This program maintains and queries the artist, genre and composer dimension tables."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-r", "--rebuild",
+                        help="If provided, re-link every song (needed once for an existing library).",
+                        action='store_true',
+                        dest='rebuild',
+                        required=False)
+
+    parser.add_argument("-k", "--kind",
+                        help="Dimension to query, default: artist",
+                        type=str,
+                        dest='dim',
+                        choices=list(DIMENSIONS.keys()),
+                        default='artist',
+                        required=False)
+
+    parser.add_argument("-n", "--name",
+                        help="If provided, list the albums linked to this name, otherwise the names with most songs.",
+                        type=str,
+                        dest='name',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-l", "--limit",
+                        help="Max number of names to list.",
+                        type=int,
+                        dest='limit',
+                        default=50,
+                        required=False)
+
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print(json.dumps(MusicDimensions().rebuild(), indent=4))
+    elif args.name:
+        print(json.dumps(facet_albums(args.dim, args.name), indent=4, ensure_ascii=False))
+    else:
+        print(json.dumps(top_names(args.dim, args.limit), indent=4, ensure_ascii=False))
@@ -0,0 +1,198 @@
+"""
+This module hosts the class MusicFacets.
+MusicFacets maintains the number of songs and albums per genre, artist, label and decade, for browsing.
+Each album's contribution is kept in album_facet, and the totals in facet_count; when the ingest writer
+has written an album, only the difference between its old and new contributions is applied to the totals,
+so the cost of an update does not depend on the size of the library. rebuild() recomputes everything.
+Genres and artists are read from the dimension tables (see music_dims.py), which must be up to date.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import json
+import time
+
+from django.db import connection, transaction
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import clear_tables, year_sql  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+FACETS = ['genre', 'artist', 'label', 'decade']
+DEFAULT_LIMIT = 50
+
+# The ingest writes 1900 when the year of a song is not known:
+UNKNOWN_YEAR = 1900
+
+# Contributions of albums: (album_id, facet, value_key, value, songs); {album_filter} restricts the songs,
+# {year} is the year of s.date (see db_vendor.year_sql())
+CONTRIBUTIONS_SQL = f"""
+SELECT s.album_id, 'genre', g.name_key, min(g.name), count(DISTINCT s.id)
+FROM song s JOIN song_genre l ON l.song_id = s.id JOIN genre g ON g.id = l.genre_id
+WHERE s.album_id IS NOT NULL AND {{album_filter}}
+GROUP BY s.album_id, g.name_key
+UNION ALL
+SELECT s.album_id, 'artist', d.name_key, min(d.name), count(DISTINCT s.id)
+FROM song s JOIN song_artist l ON l.song_id = s.id JOIN artist d ON d.id = l.artist_id
+WHERE s.album_id IS NOT NULL AND {{album_filter}}
+GROUP BY s.album_id, d.name_key
+UNION ALL
+SELECT s.album_id, 'label', lower(trim(a.label)), min(trim(a.label)), count(*)
+FROM song s JOIN album a ON a.id = s.album_id
+WHERE coalesce(trim(a.label), '') <> '' AND {{album_filter}}
+GROUP BY s.album_id, lower(trim(a.label))
+UNION ALL
+SELECT s.album_id, 'decade', CAST({{year}} / 10 * 10 AS text), CAST({{year}} / 10 * 10 AS text) || 's', count(*)
+FROM song s
+WHERE s.album_id IS NOT NULL AND s.date IS NOT NULL AND {{year}} <> {UNKNOWN_YEAR} AND {{album_filter}}
+GROUP BY s.album_id, {{year}} / 10 * 10
+"""
+
+APPLY_DELTA_SQL = """
+INSERT INTO facet_count AS c (facet, value_key, value, songs, albums) VALUES {rows}
+ON CONFLICT (facet, value_key) DO UPDATE SET
+    songs = c.songs + EXCLUDED.songs, albums = c.albums + EXCLUDED.albums, value = EXCLUDED.value
+"""
+
+FACET_COUNTS_SQL = "SELECT value, songs, albums FROM facet_count WHERE facet = %s " \
+                   "ORDER BY songs DESC, value_key LIMIT %s"
+
+
+def contributions_sql(album_filter):
+    """
+    Get the SQL of album contributions.
+    :param album_filter: SQL condition on the songs, s.album_id = %s or TRUE
+    :return: A tuple (SQL, number of times album_filter occurs)
+    """
+    return CONTRIBUTIONS_SQL.format(album_filter=album_filter, year=year_sql('s.date')), \
+        CONTRIBUTIONS_SQL.count('{album_filter}')
+
+
+class MusicFacets:
+    """
+    This class maintains and reads the facet counts.
+    """
+
+    @staticmethod
+    def update_album(album_id):
+        """
+        Apply the change of an album's contributions to the facet counts, called by the ingest writer after
+        the album (and its dimension links) has been written.
+        :param album_id: ID of the album
+        :return: Number of facet counts changed
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("DELETE FROM album_facet WHERE album_id = %s RETURNING facet, value_key, value, songs",
+                           [album_id])
+            old = {(facet, key): (value, songs) for facet, key, value, songs in cursor.fetchall()}
+            sql, filter_count = contributions_sql("s.album_id = %s")
+            cursor.execute(sql, [album_id] * filter_count)
+            new = {(facet, key): (value, songs) for _, facet, key, value, songs in cursor.fetchall()}
+
+            if new:
+                cursor.execute(
+                    "INSERT INTO album_facet (album_id, facet, value_key, value, songs) VALUES "
+                    f"{', '.join(['(%s, %s, %s, %s, %s)'] * len(new))}",
+                    [val for (facet, key), (value, songs) in new.items()
+                     for val in (album_id, facet, key, value, songs)])
+
+            deltas = []
+
+            for facet_key in old.keys() | new.keys():
+                old_value, old_songs = old.get(facet_key, (None, 0))
+                new_value, new_songs = new.get(facet_key, (None, 0))
+                album_delta = (1 if facet_key in new else 0) - (1 if facet_key in old else 0)
+
+                if new_songs != old_songs or album_delta:
+                    deltas.append((*facet_key, new_value or old_value, new_songs - old_songs, album_delta))
+
+            if deltas:
+                cursor.execute(APPLY_DELTA_SQL.format(rows=', '.join(['(%s, %s, %s, %s, %s)'] * len(deltas))),
+                               [val for delta in deltas for val in delta])
+                cursor.execute("DELETE FROM facet_count WHERE (facet, value_key) IN "
+                               f"(VALUES {', '.join(['(%s, %s)'] * len(deltas))}) AND songs <= 0",
+                               [val for delta in deltas for val in delta[:2]])
+
+        return len(deltas)
+
+    @staticmethod
+    def rebuild():
+        """
+        Recompute the contributions of every album and the facet counts.
+        :return: A dictionary: facet -> number of values
+        """
+        start_time = datetime.datetime.now()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            clear_tables(cursor, ['album_facet', 'facet_count'])
+            cursor.execute("INSERT INTO album_facet (album_id, facet, value_key, value, songs) " +
+                           contributions_sql("TRUE")[0])
+            cursor.execute("INSERT INTO facet_count (facet, value_key, value, songs, albums) "
+                           "SELECT facet, value_key, min(value), sum(songs), count(*) FROM album_facet "
+                           "GROUP BY facet, value_key")
+            cursor.execute("ANALYZE album_facet")
+            cursor.execute("ANALYZE facet_count")
+            cursor.execute("SELECT facet, count(*) FROM facet_count GROUP BY facet")
+            counts = dict(cursor.fetchall())
+
+        log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
+
+        return {facet: counts.get(facet, 0) for facet in FACETS}
+
+    @staticmethod
+    def counts(facet, limit=DEFAULT_LIMIT):
+        """
+        Read the values of a facet with the most songs.
+        :param facet: One of FACETS
+        :param limit: Max number of values
+        :return: A list of dictionaries with value, songs and albums
+        """
+        if facet not in FACETS:
+            raise ValueError(f"Unknown facet: {facet}")
+
+        with connection.cursor() as cursor:
+            cursor.execute(FACET_COUNTS_SQL, [facet, limit])
+
+            return [{'value': value, 'songs': songs, 'albums': albums} for value, songs, albums in cursor.fetchall()]
+
+
+PROGRAM_DESCRIPTION = "This program shows or rebuilds the facet counts (songs and albums per genre, artist, " \
+                      "label and decade)."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-r", "--rebuild",
+                        help="If provided, recompute all the counts (after music_dims.py -r for an existing library).",
+                        action='store_true',
+                        dest='rebuild',
+                        required=False)
+
+    parser.add_argument("-k", "--facet",
+                        help="Facet to show, default: all",
+                        type=str,
+                        dest='facet',
+                        choices=FACETS,
+                        default='',
+                        required=False)
+
+    parser.add_argument("-l", "--limit",
+                        help="Max number of values to show per facet.",
+                        type=int,
+                        dest='limit',
+                        default=DEFAULT_LIMIT,
+                        required=False)
+
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print(json.dumps(MusicFacets.rebuild(), indent=4))
+    else:
+        start = time.perf_counter()
+        show_facets = [args.facet] if args.facet else FACETS
+        facet_counts = {facet: MusicFacets.counts(facet, args.limit) for facet in show_facets}
+        print(json.dumps(facet_counts, indent=4, ensure_ascii=False))
+        log_it("info", __name__, f"Read in {round((time.perf_counter() - start) * 1000, 2)} ms")
@@ -0,0 +1,307 @@
+"""
+This module hosts the class MusicFullTextSearch.
+It offers ranked free-text search over songs and albums, using the tsvector columns
+(search_vector) of the song and album tables, or on SQLite the FTS5 tables song_fts and album_fts
+(see migration 0003). Both return the same columns.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import json
+import re
+
+from django.db import connection
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import is_sqlite  # pylint: disable=import-error
+
+TS_CONFIG = 'simple'
+
+SONG_VECTOR = (
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(artist, '') || ' ' || coalesce(composer, '') || ' ' || "
+    "coalesce(performer, '')), 'B') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(genre, '')), 'C') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(comment, '')), 'D')"
+)
+
+ALBUM_VECTOR = (
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(artist, '')), 'B') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(label, '')), 'C') || "
+    f"setweight(to_tsvector('{TS_CONFIG}', coalesce(comment, '')), 'D')"
+)
+
+HEADLINE_OPTIONS = 'StartSel=<b>, StopSel=</b>, MaxWords=30, MinWords=10, MaxFragments=2'
+
+DEFAULT_PAGE_SIZE = 20
+
+SONG_SEARCH_SQL = f"""
+WITH q AS (SELECT websearch_to_tsquery('{TS_CONFIG}', %s) AS query),
+hits AS (
+    SELECT s.id, ts_rank_cd(s.search_vector, q.query) AS rank
+    FROM song s, q
+    WHERE s.search_vector @@ q.query
+    ORDER BY rank DESC, s.id
+    LIMIT %s OFFSET %s
+)
+SELECT s.id, s.title, s.artist, s.composer, s.performer, s.genre, s.file, s.track_id,
+       a.id AS album_id, a.title AS album, a.path, hits.rank,
+       ts_headline('{TS_CONFIG}', coalesce(s.title, ''), q.query) AS title_headline,
+       ts_headline('{TS_CONFIG}', coalesce(s.comment, ''), q.query, '{HEADLINE_OPTIONS}') AS comment_headline
+FROM hits
+JOIN song s ON s.id = hits.id
+LEFT JOIN album a ON a.id = s.album_id, q
+ORDER BY hits.rank DESC, s.id
+"""
+
+ALBUM_SEARCH_SQL = f"""
+WITH q AS (SELECT websearch_to_tsquery('{TS_CONFIG}', %s) AS query),
+hits AS (
+    SELECT a.id, ts_rank_cd(a.search_vector, q.query) AS rank
+    FROM album a, q
+    WHERE a.search_vector @@ q.query
+    ORDER BY rank DESC, a.id
+    LIMIT %s OFFSET %s
+)
+SELECT a.id, a.title, a.artist, a.label, a.date, a.path, hits.rank,
+       ts_headline('{TS_CONFIG}', coalesce(a.title, ''), q.query) AS title_headline,
+       ts_headline('{TS_CONFIG}', coalesce(a.comment, ''), q.query, '{HEADLINE_OPTIONS}') AS comment_headline
+FROM hits
+JOIN album a ON a.id = hits.id, q
+ORDER BY hits.rank DESC, a.id
+"""
+
+COUNT_SQL = f"""
+SELECT count(*) FROM {{table}}
+WHERE search_vector @@ websearch_to_tsquery('{TS_CONFIG}', %s)
+"""
+
+# SQLite: bm25() weights per FTS5 column, in the ratio of the tsvector weights A, B, C, D above
+FTS5_HIGHLIGHT = "'<b>', '</b>'"
+FTS5_SNIPPET_TOKENS = 30
+
+SONG_SEARCH_SQLITE = f"""
+WITH hits AS (
+    SELECT rowid AS id, -bm25(song_fts, 10.0, 4.0, 4.0, 4.0, 2.0, 1.0) AS score,
+           highlight(song_fts, 0, {FTS5_HIGHLIGHT}) AS title_headline,
+           snippet(song_fts, 5, {FTS5_HIGHLIGHT}, '...', {FTS5_SNIPPET_TOKENS}) AS comment_headline
+    FROM song_fts
+    WHERE song_fts MATCH %s
+    ORDER BY score DESC, rowid
+    LIMIT %s OFFSET %s
+)
+SELECT s.id, s.title, s.artist, s.composer, s.performer, s.genre, s.file, s.track_id,
+       a.id AS album_id, a.title AS album, a.path, hits.score AS rank,
+       coalesce(hits.title_headline, '') AS title_headline, coalesce(hits.comment_headline, '') AS comment_headline
+FROM hits
+JOIN song s ON s.id = hits.id
+LEFT JOIN album a ON a.id = s.album_id
+ORDER BY hits.score DESC, s.id
+"""
+
+ALBUM_SEARCH_SQLITE = f"""
+WITH hits AS (
+    SELECT rowid AS id, -bm25(album_fts, 10.0, 4.0, 2.0, 1.0) AS score,
+           highlight(album_fts, 0, {FTS5_HIGHLIGHT}) AS title_headline,
+           snippet(album_fts, 3, {FTS5_HIGHLIGHT}, '...', {FTS5_SNIPPET_TOKENS}) AS comment_headline
+    FROM album_fts
+    WHERE album_fts MATCH %s
+    ORDER BY score DESC, rowid
+    LIMIT %s OFFSET %s
+)
+SELECT a.id, a.title, a.artist, a.label, a.date, a.path, hits.score AS rank,
+       coalesce(hits.title_headline, '') AS title_headline, coalesce(hits.comment_headline, '') AS comment_headline
+FROM hits
+JOIN album a ON a.id = hits.id
+ORDER BY hits.score DESC, a.id
+"""
+
+COUNT_SQLITE = "SELECT count(*) FROM {table}_fts WHERE {table}_fts MATCH %s"
+
+WEB_SEARCH_TERM = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+
+
+def websearch_to_fts5(query):
+    """
+    Translate a query in web search syntax (quotes, OR, -exclude), as read by websearch_to_tsquery(),
+    to an FTS5 query. Every term is quoted, so that no character of the query is taken for FTS5 syntax.
+    :param query: Free-text query
+    :return: An FTS5 query, empty if the query has no term to match
+    """
+    groups = []
+    negatives = []
+    follows_or = False
+
+    for negate, phrase, word in WEB_SEARCH_TERM.findall(query):
+        if not negate and word.lower() == 'or' and groups:
+            follows_or = True
+            continue
+
+        text = phrase or word
+
+        if not re.search(r'\w', text):
+            continue
+
+        term = '"' + text.replace('"', '""') + '"'
+
+        if negate:
+            negatives.append(term)
+        elif follows_or:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+
+        follows_or = False
+
+    if not groups:
+        return ''
+
+    positives = ' AND '.join(f"({' OR '.join(group)})" if len(group) > 1 else group[0] for group in groups)
+
+    return positives + ''.join(f" NOT {term}" for term in negatives)
+
+
+def refresh_search_vectors(album_id):
+    """
+    Recompute the search vectors of an album and its songs, called by the ingest writer after the album
+    has been written, so that full-text queries never need to compute vectors on the fly.
+    :param album_id: ID of the album (album.id) whose vectors to refresh
+    :return: void
+    """
+    if is_sqlite():
+        # The FTS5 tables are kept current by triggers
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE album SET search_vector = {ALBUM_VECTOR} WHERE id = %s", [album_id])
+        cursor.execute(f"UPDATE song SET search_vector = {SONG_VECTOR} WHERE album_id = %s", [album_id])
+
+
+class MusicFullTextSearch:
+    """
+    This class encapsulates ranked, highlighted and paginated free-text search over songs and albums.
+    """
+
+    def __init__(self, page_size=DEFAULT_PAGE_SIZE):
+        self._page_size = DEFAULT_PAGE_SIZE
+        self.page_size = page_size
+
+    @property
+    def page_size(self):  # pylint: disable=missing-function-docstring
+        return self._page_size
+
+    @page_size.setter
+    def page_size(self, in_size):
+        self._page_size = max(1, int(in_size or DEFAULT_PAGE_SIZE))
+
+    @staticmethod
+    def fetch_dicts(sql, params):
+        """
+        Run a query and return its rows as dictionaries.
+        :param sql: SQL to run
+        :param params: A list of query parameters
+        :return: A list of dictionaries, one per row, keyed by column name
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def count(table, query):
+        """
+        Count the rows of a table matching a query.
+        :param table: Name of the table (album or song)
+        :param query: Free-text query (web search syntax: quotes, OR, -exclude), on SQLite an FTS5 query
+        :return: Number of matching rows as an int
+        """
+        with connection.cursor() as cursor:
+            if is_sqlite():
+                cursor.execute(COUNT_SQLITE.format(table=table), [query])
+            else:
+                cursor.execute(COUNT_SQL.format(table=table), [query])
+
+            return cursor.fetchone()[0]
+
+    def search(self, query, kind='song', page=1):
+        """
+        Search songs or albums.
+        :param query: Free-text query (web search syntax: quotes, OR, -exclude)
+        :param kind: What to search: 'song' or 'album'
+        :param page: Number of the page (1-based) of results to return
+        :return: A dictionary with the total number of hits, the page details and the ranked results
+        """
+        page = max(1, int(page or 1))
+        result = {
+            'query': query,
+            'kind': kind,
+            'page': page,
+            'page_size': self.page_size,
+            'total': 0,
+            'results': []
+        }
+
+        if is_sqlite():
+            query = websearch_to_fts5(query or '')
+            sql = SONG_SEARCH_SQLITE if kind == 'song' else ALBUM_SEARCH_SQLITE
+        else:
+            sql = SONG_SEARCH_SQL if kind == 'song' else ALBUM_SEARCH_SQL
+
+        if not query or not query.strip():
+            return result
+
+        result['total'] = self.count(kind, query)
+
+        if result['total'] > (page - 1) * self.page_size:
+            result['results'] = self.fetch_dicts(sql, [query, self.page_size, (page - 1) * self.page_size])
+
+        return result
+
+    def search_songs(self, query, page=1):  # pylint: disable=missing-function-docstring
+        return self.search(query, kind='song', page=page)
+
+    def search_albums(self, query, page=1):  # pylint: disable=missing-function-docstring
+        return self.search(query, kind='album', page=page)
+
+
+PROGRAM_DESCRIPTION = "This program runs a ranked full-text search over songs and albums."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-f", "--find",
+                        help="Text to find, e.g. 'miles davis -live' or '\"kind of blue\"'.",
+                        type=str,
+                        dest='search_str',
+                        required=True)
+
+    parser.add_argument("-k", "--kind",
+                        help="What to search: song (default) or album.",
+                        type=str,
+                        dest='kind',
+                        choices=['song', 'album'],
+                        default='song',
+                        required=False)
+
+    parser.add_argument("-p", "--page",
+                        help="Page of results to show (1-based).",
+                        type=int,
+                        dest='page',
+                        default=1,
+                        required=False)
+
+    parser.add_argument("-n", "--page_size",
+                        help="Number of results per page.",
+                        type=int,
+                        dest='page_size',
+                        default=DEFAULT_PAGE_SIZE,
+                        required=False)
+
+    args = parser.parse_args()
+
+    fts = MusicFullTextSearch(page_size=args.page_size)
+    print(json.dumps(fts.search(args.search_str, kind=args.kind, page=args.page), indent=4, default=str,
+                     ensure_ascii=False))
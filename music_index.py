@@ -0,0 +1,708 @@
+"""
+This module hosts the classes MusicIndex and MusicIndexSearch.
+MusicIndex is an inverted index (token -> sorted song ids) over the song and album tags,
+stored in a compact file which is memory-mapped when loaded, so lookups need neither a DB round trip
+nor a scan of the audio files.
+
+File layout (little-endian):
+    header:   magic (4s), version (I), ID typecode (4s), key count (I), posting count (Q), key blob size (Q),
+              trigram count (Q), trigram posting count (Q), trigram blob size (Q)
+    keys:     sorted keys separated by '\n', UTF-8, padded to 8 bytes
+    offsets:  key count + 1 unsigned ints (Q), the postings of key i are postings[offsets[i]:offsets[i + 1]]
+    postings: sorted song IDs, unsigned ints (I or Q, see the header), padded to 8 bytes
+    trigrams: sorted trigrams of the tokens of the field keys (padded with GRAM_PAD, so that every token has some),
+              separated by '\n', UTF-8, padded to 8 bytes
+    trigram offsets and postings: as for the keys, the postings being the sorted positions of the keys (I),
+              so that the keys containing a substring are found without a scan of all the keys
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import itertools
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+
+from django.db.models import Q
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from music_db_search import MusicDbSearch  # pylint: disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from utils import fold_text, log_it, write_json_file  # pylint: disable=import-error
+
+INDEX_MAGIC = b'MBIX'
+INDEX_VERSION = 2
+VERSION_FORMAT = '<4sI'
+HEADER_FORMAT = VERSION_FORMAT + '4sIQQQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+DEFAULT_INDEX_PATH = os.path.join(str(Path.home()), 'temp', 'music_index.bin')
+
+# Song fields and the album fields (prefixed "album__") to index; keys are the field names used in queries:
+INDEXED_FIELDS = {
+    'title': 'title',
+    'artist': 'artist',
+    'composer': 'composer',
+    'performer': 'performer',
+    'genre': 'genre',
+    'comment': 'comment',
+    'album': 'album__title',
+    'albumartist': 'album__artist',
+    'label': 'album__label',
+}
+
+ALBUM_KEY_PREFIX = '\x00album:'
+FIELD_SEPARATOR = ':'
+GRAM_SIZE = 3
+GRAM_PAD = ' '
+DB_FETCH_CHUNK = 2000
+
+
+def tokenize(in_text):
+    """
+    Split text into folded word tokens.
+    :param in_text: Text to split
+    :return: A list of tokens
+    """
+    if not in_text:
+        return []
+
+    return re.findall(r'\w+', fold_text(in_text))
+
+
+def token_grams(token):
+    """
+    Split a token into its trigrams.
+    :param token: A folded token
+    :return: A set of strings, empty for a token shorter than GRAM_SIZE
+    """
+    return {token[ix:ix + GRAM_SIZE] for ix in range(len(token) - GRAM_SIZE + 1)}
+
+
+def read_section(view, pos, count, typecode):
+    """
+    Read an array section of the index file.
+    :param view: memoryview of the file
+    :param pos: Offset of the section
+    :param count: Number of items
+    :param typecode: Item type, see array
+    :return: A tuple (memoryview cast to typecode, offset after the section padded to 8 bytes)
+    """
+    size = array(typecode).itemsize * count
+
+    return view[pos:pos + size].cast(typecode), pos + size + (-size % 8)
+
+
+def intersect(first, second):
+    """
+    Intersect two sorted sequences of IDs.
+    :param first: Sorted sequence of ints
+    :param second: Sorted sequence of ints
+    :return: A sorted list of the IDs present in both
+    """
+    if len(first) > len(second):
+        first, second = second, first
+
+    out = []
+    lo = 0
+
+    for song_id in first:
+        lo = bisect_left(second, song_id, lo)
+
+        if lo == len(second):
+            break
+
+        if second[lo] == song_id:
+            out.append(song_id)
+
+    return out
+
+
+class MusicIndex:
+    """
+    This class encapsulates an inverted index of song tags.
+    """
+
+    def __init__(self, index_path=DEFAULT_INDEX_PATH):
+        self._path = index_path
+        self._mm = None
+        self._view = None
+        self._keys = []
+        self._offsets = self._postings = memoryview(b'')
+        self._grams = []
+        self._gram_offsets = self._gram_postings = memoryview(b'')
+        self._added = {}
+        self._added_docs = {}
+        self._removed = set()
+        self.load()
+
+    @property
+    def path(self):  # pylint: disable=missing-function-docstring
+        return self._path
+
+    @property
+    def modified(self):  # pylint: disable=missing-function-docstring
+        return bool(self._added or self._removed)
+
+    @staticmethod
+    def song_keys(song_values, album_id=None):
+        """
+        Produce the index keys for a song.
+        :param song_values: A dictionary of field name (see INDEXED_FIELDS) to value
+        :param album_id: ID of the song's album, if any
+        :return: A set of keys ("field:token")
+        """
+        keys = {f"{field}{FIELD_SEPARATOR}{token}"
+                for field, value in song_values.items() for token in tokenize(value)}
+
+        if album_id is not None:
+            keys.add(f"{ALBUM_KEY_PREFIX}{album_id}")
+
+        return keys
+
+    def load(self):
+        """
+        Memory-map the index file, if it exists.
+        :return: True if an index was loaded, otherwise False
+        """
+        if not self.path or not os.path.isfile(self.path):
+            return False
+
+        with open(self.path, 'rb') as f_index:
+            self._mm = mmap.mmap(f_index.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from(VERSION_FORMAT, self._mm)
+
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            log_it("error", __name__, f"Not a music index (version {INDEX_VERSION}), rebuild it: {self.path}")
+            self._mm.close()
+            self._mm = None
+            return False
+
+        typecode, key_count, posting_count, keys_size, gram_count, gram_posting_count, grams_size = \
+            struct.unpack_from(HEADER_FORMAT, self._mm)[2:]
+        typecode = typecode.rstrip(b'\x00').decode()
+        self._view = memoryview(self._mm)
+        pos = HEADER_SIZE
+        self._keys = bytes(self._view[pos:pos + keys_size]).decode('UTF-8').split('\n') if key_count else []
+        pos += keys_size + (-keys_size % 8)
+        self._offsets, pos = read_section(self._view, pos, key_count + 1, 'Q')
+        self._postings, pos = read_section(self._view, pos, posting_count, typecode)
+        self._grams = bytes(self._view[pos:pos + grams_size]).decode('UTF-8').split('\n') if gram_count else []
+        pos += grams_size + (-grams_size % 8)
+        self._gram_offsets, pos = read_section(self._view, pos, gram_count + 1, 'Q')
+        self._gram_postings, pos = read_section(self._view, pos, gram_posting_count, 'I')
+
+        return True
+
+    def close(self):
+        """
+        Release the memory-mapped file.
+        :return: void
+        """
+        for section in [self._offsets, self._postings, self._gram_offsets, self._gram_postings]:
+            section.release()
+
+        self._offsets = self._postings = memoryview(b'')
+        self._gram_offsets = self._gram_postings = memoryview(b'')
+        self._keys = []
+        self._grams = []
+
+        if self._view:
+            self._view.release()
+            self._view = None
+
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+
+    def base_postings(self, key):
+        """
+        Get the postings of a key in the memory-mapped file.
+        :param key: Index key
+        :return: A sorted sequence of song IDs (a memoryview, no copy)
+        """
+        pos = bisect_left(self._keys, key)
+
+        if pos == len(self._keys) or self._keys[pos] != key:
+            return []
+
+        return self._postings[self._offsets[pos]:self._offsets[pos + 1]]
+
+    def postings(self, key):
+        """
+        Get the postings of a key, taking into account albums re-indexed since the file was written.
+        :param key: Index key
+        :return: A sorted sequence of song IDs
+        """
+        base = self.base_postings(key)
+
+        if not self.modified:
+            return base
+
+        ids = {song_id for song_id in base if song_id not in self._removed}
+        ids.update(self._added.get(key, ()))
+
+        return sorted(ids)
+
+    def field_keys(self, token, field=None):
+        """
+        Get the keys for a token in one field or in all indexed fields.
+        :param token: A folded token
+        :param field: Field name (see INDEXED_FIELDS) or None for all fields
+        :return: A list of keys
+        """
+        fields = [field] if field else list(INDEXED_FIELDS.keys())
+        return [f"{fld}{FIELD_SEPARATOR}{token}" for fld in fields]
+
+    def term_postings(self, term):
+        """
+        Get the song IDs matching a search term, e.g. "miles", "artist:miles" or "artist:miles davis"
+        (all the words of a term must match).
+        :param term: Search term as a string
+        :return: A sorted list of song IDs
+        """
+        field = None
+        field_prefix, sep, rest = term.partition(FIELD_SEPARATOR)
+
+        if sep and field_prefix.lower() in INDEXED_FIELDS:
+            field = field_prefix.lower()
+            term = rest
+
+        result = None
+
+        for token in tokenize(term):
+            key_postings = [self.postings(key) for key in self.field_keys(token, field)]
+            token_ids = key_postings[0] if len(key_postings) == 1 else \
+                sorted(set().union(*key_postings))
+            result = list(token_ids) if result is None else intersect(result, token_ids)
+
+            if not result:
+                return []
+
+        return result or []
+
+    def gram_positions(self, pos):
+        """
+        Get the keys of the file with a trigram.
+        :param pos: Position of the trigram
+        :return: A sorted sequence of key positions
+        """
+        return self._gram_postings[self._gram_offsets[pos]:self._gram_offsets[pos + 1]]
+
+    def gram_key_positions(self, token):
+        """
+        Get the keys of the file whose tokens have all the trigrams of a token (or, for a shorter token, a trigram
+        containing it), a superset of the keys whose tokens contain the token.
+        :param token: A folded token
+        :return: A sorted sequence of key positions
+        """
+        if len(token) < GRAM_SIZE:
+            return sorted(set().union(*[self.gram_positions(pos) for pos, gram in enumerate(self._grams)
+                                        if token in gram]))
+
+        result = None
+
+        for gram in sorted(token_grams(token)):
+            pos = bisect_left(self._grams, gram)
+
+            if pos == len(self._grams) or self._grams[pos] != gram:
+                return []
+
+            positions = self.gram_positions(pos)
+            result = positions if result is None else intersect(result, positions)
+
+            if not len(result):
+                return []
+
+        return result
+
+    def token_keys(self, token, field=None):
+        """
+        Get the keys of the tokens containing a token, in one field or in all indexed fields. The keys of the file
+        are narrowed down by their trigrams (see gram_key_positions()), the keys added since the file was written
+        are checked one by one.
+        :param token: A folded token
+        :param field: Field name (see INDEXED_FIELDS) or None for all fields
+        :return: A list of keys
+        """
+        fields = [field] if field else list(INDEXED_FIELDS.keys())
+        candidates = [self._keys[pos] for pos in self.gram_key_positions(token)]
+        found = set()
+
+        for key in itertools.chain(candidates, self._added.keys()):
+            fld, _, key_token = key.partition(FIELD_SEPARATOR)
+
+            if fld in fields and token in key_token:
+                found.add(key)
+
+        return sorted(found)
+
+    def substring_postings(self, text, field=None):
+        """
+        Get the songs in which each word of a text is part of a token, a superset of the songs whose field
+        contains the text (as matched by the DB, see SearchQuery.to_q()).
+        :param text: Text to find
+        :param field: Field name (see INDEXED_FIELDS) or None for all fields
+        :return: A sorted list of song IDs or None if the text has no word, i.e. the index cannot tell
+        """
+        tokens = tokenize(text)
+
+        if not tokens:
+            return None
+
+        result = None
+
+        for token in tokens:
+            token_ids = set()
+
+            for key in self.token_keys(token, field):
+                token_ids.update(self.postings(key))
+
+            result = sorted(token_ids) if result is None else intersect(result, sorted(token_ids))
+
+            if not result:
+                return []
+
+        return result
+
+    def search(self, terms, match_all=True):
+        """
+        Find songs matching all (AND) or any (OR) of the search terms.
+        :param terms: A list of search terms (see term_postings())
+        :param match_all: True to require all the terms, False for any of them
+        :return: A sorted list of song IDs
+        """
+        result = None
+
+        for term in terms:
+            term_ids = self.term_postings(term)
+
+            if match_all:
+                result = term_ids if result is None else intersect(result, term_ids)
+
+                if not result:
+                    return []
+
+                continue
+
+            result = term_ids if result is None else sorted(set(result).union(term_ids))
+
+        return result or []
+
+    def update_album(self, album_id, songs):
+        """
+        Re-index the songs of an album, replacing what the index holds for it.
+        :param album_id: ID of the album
+        :param songs: A dictionary of song ID to a dictionary of field name to value
+        :return: void
+        """
+        album_key = f"{ALBUM_KEY_PREFIX}{album_id}"
+        old_ids = set(self.postings(album_key)) | set(songs.keys())
+
+        for song_id in old_ids:
+            self._removed.add(song_id)
+
+            for key in self._added_docs.pop(song_id, []):
+                self._added[key].discard(song_id)
+
+        for song_id, song_values in songs.items():
+            keys = self.song_keys(song_values, album_id)
+            self._added_docs[song_id] = keys
+
+            for key in keys:
+                self._added.setdefault(key, set()).add(song_id)
+
+    @staticmethod
+    def db_song_rows(**filters):
+        """
+        Read songs from the DB.
+        :param filters: Song queryset filters, e.g. album_id=1
+        :return: A generator of (song ID, album ID, dict of field name to value) tuples
+        """
+        db_fields = list(INDEXED_FIELDS.values())
+        rows = Song.objects.filter(**filters).values_list('id', 'album_id', *db_fields)  # NOQA
+
+        for row in rows.iterator(chunk_size=DB_FETCH_CHUNK):
+            yield row[0], row[1], dict(zip(INDEXED_FIELDS.keys(), row[2:]))
+
+    def update_album_from_db(self, album_id):
+        """
+        Re-index an album from the DB, called by the ingest writer after the album has been written.
+        :param album_id: ID of the album
+        :return: void
+        """
+        self.update_album(album_id, {song_id: values for song_id, _, values in self.db_song_rows(album_id=album_id)})
+
+    def all_keys(self):
+        """
+        List all keys, including keys added since the file was written.
+        :return: A sorted list of keys
+        """
+        return sorted(set(self._keys) | set(self._added.keys()))
+
+    @staticmethod
+    def write(index_path, key_postings):
+        """
+        Write an index file.
+        :param index_path: Path of the file to write, it is replaced atomically
+        :param key_postings: An iterable of (key, sorted song IDs) tuples, sorted by key
+        :return: void
+        """
+        keys = []
+        offsets = array('Q', [0])
+        postings = array('Q')
+        gram_positions = {}
+
+        for key, ids in key_postings:
+            if not ids:
+                continue
+
+            fld, _, key_token = key.partition(FIELD_SEPARATOR)
+
+            if fld in INDEXED_FIELDS:
+                for gram in token_grams(f"{GRAM_PAD}{key_token}{GRAM_PAD}"):
+                    gram_positions.setdefault(gram, array('I')).append(len(keys))
+
+            keys.append(key)
+            postings.extend(ids)
+            offsets.append(len(postings))
+
+        typecode = 'I' if not postings or max(postings) < 2 ** 32 else 'Q'
+        postings = array(typecode, postings)
+        keys_blob = '\n'.join(keys).encode('UTF-8')
+        grams = sorted(gram_positions.keys())
+        grams_blob = '\n'.join(grams).encode('UTF-8')
+        gram_offsets = array('Q', [0])
+        gram_postings = array('I')
+
+        for gram in grams:
+            gram_postings.extend(gram_positions[gram])
+            gram_offsets.append(len(gram_postings))
+
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        tmp_path = index_path + '.tmp'
+
+        with open(tmp_path, 'wb') as f_index:
+            f_index.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, typecode.encode(), len(keys),
+                                      len(postings), len(keys_blob), len(grams), len(gram_postings),
+                                      len(grams_blob)))
+
+            for section in [keys_blob, offsets, postings, grams_blob, gram_offsets, gram_postings]:
+                blob = section if isinstance(section, bytes) else section.tobytes()
+                f_index.write(blob)
+                f_index.write(b'\x00' * (-len(blob) % 8))
+
+        os.replace(tmp_path, index_path)
+
+    def save(self):
+        """
+        Write the index, merging the albums re-indexed since it was loaded, and re-map it.
+        :return: void
+        """
+        self.write(self.path, ((key, self.postings(key)) for key in self.all_keys()))
+        self.close()
+        self._added = {}
+        self._added_docs = {}
+        self._removed = set()
+        self.load()
+
+    @classmethod
+    def build(cls, song_rows, index_path=DEFAULT_INDEX_PATH):
+        """
+        Build an index from scratch.
+        :param song_rows: An iterable of (song ID, album ID, dict of field name to value) tuples
+        :param index_path: Path of the index file
+        :return: A MusicIndex instance for the new file
+        """
+        key_ids = {}
+
+        for song_id, album_id, values in song_rows:
+            for key in cls.song_keys(values, album_id):
+                key_ids.setdefault(key, array('Q')).append(song_id)
+
+        cls.write(index_path, ((key, sorted(key_ids[key])) for key in sorted(key_ids.keys())))
+
+        return cls(index_path)
+
+    @classmethod
+    def build_from_db(cls, index_path=DEFAULT_INDEX_PATH):
+        """
+        Build an index from the song and album tables.
+        :param index_path: Path of the index file
+        :return: A MusicIndex instance
+        """
+        return cls.build(cls.db_song_rows(), index_path)
+
+    @staticmethod
+    def tag_cache_docs(cache_path):
+        """
+        Read a tag cache (JSON written by music_meta_search.py) as a flat list of song tag dictionaries.
+        :param cache_path: Path to the JSON file
+        :return: A list of dictionaries
+        """
+        with open(cache_path, encoding="UTF-8") as f_cache:
+            cache = json.load(f_cache)
+
+        return [song_tags for dir_name in sorted(cache.keys()) for song_tags in cache[dir_name]]
+
+    @classmethod
+    def build_from_tag_cache(cls, cache_path, index_path=DEFAULT_INDEX_PATH):
+        """
+        Build an index from a tag cache (JSON written by music_meta_search.py). Songs are indexed under their
+        IDs in the DB, found by album path and file name, as searches read the matching songs from the DB;
+        songs of the cache which are not in the DB are left out.
+        :param cache_path: Path to the JSON file
+        :param index_path: Path of the index file
+        :return: A MusicIndex instance
+        """
+        docs = {(song_tags.get('directory', ''), song_tags.get('file', '')): song_tags
+                for song_tags in cls.tag_cache_docs(cache_path)}
+        db_ids = cls.db_song_ids({album_path for album_path, _ in docs})
+        rows = [
+            (*db_ids[doc_key], {field: song_tags.get(field) for field in INDEXED_FIELDS})
+            for doc_key, song_tags in docs.items() if doc_key in db_ids
+        ]
+
+        if len(rows) < len(docs):
+            log_it("warning", __name__, f"{len(docs) - len(rows)} of {len(docs)} songs in {cache_path} "
+                                        "are not in the DB and are not indexed")
+
+        return cls.build(rows, index_path)
+
+    @staticmethod
+    def db_song_ids(album_paths):
+        """
+        Read the IDs of the songs of albums.
+        :param album_paths: A set of album paths
+        :return: A dictionary: (album path, file name) -> (song ID, album ID)
+        """
+        paths = sorted(album_paths)
+        ids = {}
+
+        for ix in range(0, len(paths), DB_FETCH_CHUNK):
+            rows = Song.objects.filter(album__path__in=paths[ix:ix + DB_FETCH_CHUNK]).values_list(  # NOQA
+                'album__path', 'file', 'id', 'album_id')
+            ids.update({(album_path, file): (song_id, album_id) for album_path, file, song_id, album_id in rows})
+
+        return ids
+
+
+class MusicIndexSearch(MusicDbSearch):
+    """
+    This class answers MusicMetaSearch-style queries from a MusicIndex, reading only the matching rows from the DB.
+    Search text given as a string is split into terms on whitespace; a term may be scoped to a field,
+    e.g. "artist:davis". A SearchQuery is planned against the index and the candidates are checked in the DB.
+    """
+
+    def __init__(self, find_txt=None, max_albums=None, match_all=True, index_path=DEFAULT_INDEX_PATH, query=None,
+                 on_match=None, index=None):
+        super().__init__(find_txt=find_txt, use_regex=False, max_albums=max_albums, match_all=match_all,
+                         query=query, on_match=on_match)
+        self.index = index or MusicIndex(index_path)
+
+    def collect_tags(self):
+        """
+        Find songs matching the search terms and save the first matching song of each album in `self.tags`.
+        :return: void
+        """
+        start_time = datetime.datetime.now()
+
+        if not self.terms and not self.query:
+            log_it("info", __name__, f"No search criteria provided ({self.find_this})")
+            return
+
+        if self.query:
+            song_ids = self.query.index_plan(self.index)
+
+            if song_ids is None:
+                log_it("info", __name__, f"The index cannot narrow {self.query}, querying the DB")
+                super().collect_tags()
+                return
+
+            # The index finds candidates, ranges, negations and unindexed fields are checked by the DB:
+            song_filter = self.query.to_q()
+        else:
+            terms = self.find_this.split() if isinstance(self.find_this, str) else self.terms
+            song_ids = self.index.search(terms, match_all=self.match_all)
+            song_filter = Q()
+
+        for ix in range(0, len(song_ids), DB_FETCH_CHUNK):
+            songs = Song.objects.select_related('album').filter(  # NOQA
+                song_filter, id__in=song_ids[ix:ix + DB_FETCH_CHUNK])
+
+            for song in sorted(songs, key=lambda s: (s.album.path if s.album else '', s.track_id or 0, s.id)):
+                dir_name = song.album.path if song.album else ''
+
+                if dir_name in self.albums_seen:
+                    continue
+
+                if self.save_album_tags(dir_name, [self.song_as_tags(song)]):
+                    log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
+                    return
+
+        log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
+
+
+PROGRAM_DESCRIPTION = "This program builds or queries the inverted index of music tags."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-n", "--index",
+                        help=f"Path to the index file, default: {DEFAULT_INDEX_PATH}",
+                        type=str,
+                        dest='index_path',
+                        default=DEFAULT_INDEX_PATH,
+                        required=False)
+
+    parser.add_argument("-b", "--build",
+                        help="Build the index from 'db' (album and song tables) or from the path to a tag cache "
+                             "(JSON file written by music_meta_search.py).",
+                        type=str,
+                        dest='build',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-f", "--find",
+                        help="Search terms separated by spaces, a term can be scoped to a field, e.g. artist:davis.",
+                        type=str,
+                        dest='search_str',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-a", "--any",
+                        help="If provided, a song matching any of the terms is a hit, otherwise all must match.",
+                        action='store_true',
+                        dest='match_any',
+                        required=False)
+
+    args = parser.parse_args()
+
+    if args.build:
+        build_start = datetime.datetime.now()
+        music_index = MusicIndex.build_from_db(args.index_path) if args.build == 'db' else \
+            MusicIndex.build_from_tag_cache(args.build, args.index_path)
+        log_it("info", __name__, f"Index {args.index_path} built in {str(datetime.datetime.now() - build_start)}")
+
+    if not args.search_str:
+        sys.exit(0)
+
+    rd = MusicIndexSearch(find_txt=args.search_str, match_all=not args.match_any, index_path=args.index_path)
+    rd.collect_tags()
+
+    if rd.tags:
+        out_path = os.path.join(str(Path.home()), 'temp')
+        print(f"Writing results to {os.path.join(out_path, 'temp.json')}")
+        write_json_file(rd.tags, out_path, 'temp.json')
+
+    print(f"Search found {len(rd.tags.keys())} albums")
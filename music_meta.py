@@ -8,9 +8,12 @@ This module hosts the class MusicMeta
 #
 ###############################################################################
 import datetime
+import hashlib
+import json
 import os
 import re
 import sys
+from contextlib import nullcontext
 from os import listdir
 from os.path import isfile, join
 
@@ -18,6 +21,7 @@ import ruamel
 from addict import Dict
 from anyio import create_task_group
 from asgiref.sync import sync_to_async
+from django.db import connection, DataError
 from mutagen.easyid3 import EasyID3
 
 from mutagen.flac import FLAC, FLACNoHeaderError  # NOQA # pylint: disable=unused-import
@@ -27,6 +31,12 @@ from ruamel.yaml.comments import CommentedMap, CommentedSeq  # NOQA  # pylint: d
 from tinytag import TinyTag
 from orm.models import Album, Song  # NOQA # pylint: disable=unused-import, disable=import-error
 import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from db_vendor import as_date, year_sql  # pylint: disable=import-error
+from music_facets import MusicFacets  # pylint: disable=import-error
+from music_fts import refresh_search_vectors  # pylint: disable=import-error
+from music_dims import MusicDimensions  # pylint: disable=import-error
+from music_index import MusicIndex  # pylint: disable=import-error
+from query_cache import bump_library_generation  # pylint: disable=import-error
 from utils import eval_bool, log_it, read_yaml, USE_FILE_EXTENSIONS  # pylint: disable=import-error
 
 composer_classical = ['Beethoven', 'Mozart', 'Chopin']
@@ -45,13 +55,84 @@ MAX_YEAR_DIGITS = 4
 
 DEFAULT_TAG_MAPPING = {-1: -1}
 
+# Upserts on the natural keys (see migration 0008): a row is only written if a value has changed,
+# so that RETURNING yields the rows created or updated. {year_a} and {year_x} are the years of a.date
+# and EXCLUDED.date (see db_vendor.year_sql()).
+ALBUM_UPSERT_COLUMNS = ['title', 'artist', 'comment', 'label', 'path', 'date', 'track_count', 'total_duration',
+                        'digest']
+ALBUM_UPSERT_SQL = """
+INSERT INTO album AS a (title, artist, comment, label, path, date, track_count, total_duration, digest)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (path) DO UPDATE SET
+    title = EXCLUDED.title, artist = EXCLUDED.artist, comment = EXCLUDED.comment, label = EXCLUDED.label,
+    date = CASE WHEN {year_a} = {year_x} THEN a.date ELSE EXCLUDED.date END, track_count = EXCLUDED.track_count,
+    total_duration = EXCLUDED.total_duration, digest = EXCLUDED.digest
+WHERE (a.title, a.artist, a.comment, a.label, {year_a}, a.digest) IS DISTINCT FROM
+    (EXCLUDED.title, EXCLUDED.artist, EXCLUDED.comment, EXCLUDED.label, {year_x}, EXCLUDED.digest)
+RETURNING id, date
+"""
+ALBUM_BY_PATH_SQL = "SELECT id, date FROM album WHERE path = %s"
+
+# Digests of an album and its songs (see migration 0011), read in one statement before writing the album:
+STORED_DIGESTS_SQL = "SELECT a.id, a.date, a.digest, s.file, s.digest FROM album a " \
+                     "LEFT JOIN song s ON s.album_id = a.id WHERE a.path = %s"
+
+# Fields left out of row digests: the ID of a row is not content, nor is the album ID of a song
+DIGEST_SKIP_FIELDS = ['id', 'album_id', 'digest']
+
+# Technical properties of a song, read from the audio stream and the file system (see migration 0012)
+AUDIO_PROPERTIES = ['bitrate', 'samplerate', 'channels', 'filesize', 'mtime']
+
+SONG_UPSERT_KEY = ['album_id', 'file']
+SONG_UPSERT_COLUMNS = SONG_UPSERT_KEY + ['title', 'track_id', 'comment', 'genre', 'artist', 'performer', 'composer',
+                                         'date', 'duration'] + AUDIO_PROPERTIES + ['digest']
+SONG_UPDATE_COLUMNS = [column for column in SONG_UPSERT_COLUMNS if column not in SONG_UPSERT_KEY]
+SONG_UPSERT_SQL = (
+    f"INSERT INTO song AS s ({', '.join(SONG_UPSERT_COLUMNS)}) VALUES {{rows}} "
+    f"ON CONFLICT ({', '.join(SONG_UPSERT_KEY)}) DO UPDATE SET "
+    f"{', '.join(f'{column} = EXCLUDED.{column}' for column in SONG_UPDATE_COLUMNS)} "
+    f"WHERE ({', '.join(f's.{column}' for column in SONG_UPDATE_COLUMNS)}) IS DISTINCT FROM "
+    f"({', '.join(f'EXCLUDED.{column}' for column in SONG_UPDATE_COLUMNS)}) "
+    "RETURNING id"
+)
+
+
+def row_digest(field_dict):
+    """
+    Compute the content digest of a row: stable across runs for the same field values.
+    :param field_dict: A dictionary of normalised field values (see MusicMeta.album_field_dict(), song_field_dict())
+    :return: 32 hex digits
+    """
+    content = {key: val for key, val in field_dict.items() if key not in DIGEST_SKIP_FIELDS}
+
+    return hashlib.blake2b(json.dumps(content, sort_keys=True, default=str, ensure_ascii=False).encode('UTF-8'),
+                           digest_size=16).hexdigest()
+
+
+def stored_digests(album_path):
+    """
+    Read the digests of an album and its songs.
+    :param album_path: Album path
+    :return: A tuple (album ID, album date, album digest, dictionary: song file -> digest) or None if the album
+             is not in the DB
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(STORED_DIGESTS_SQL, [album_path])
+        rows = cursor.fetchall()
+
+    if not rows:
+        return None
+
+    return rows[0][0], as_date(rows[0][1]), rows[0][2], {file: digest for *_, file, digest in rows if file is not None}
+
 
 class MusicMeta:
     """
     This class encapsulates music metadata.
     """
 
-    def __init__(self, base_dir, check_only=False, update_records=False, max_albums=None):
+    def __init__(self, base_dir, check_only=False, update_records=False, max_albums=None, index_path=None,
+                 query_stats=None):
         self.split_pattern = r'[_-]+$'
         self._base_dir = base_dir
         self._candidate = {}
@@ -66,6 +147,9 @@ class MusicMeta:
         self.created = False
         self.update = eval_bool(update_records)
         self.max_albums = max_albums
+        self.index = MusicIndex(index_path) if index_path else None
+        self.dims = MusicDimensions()
+        self.query_stats = query_stats
 
     @property
     def tags(self):  # pylint: disable=missing-function-docstring
@@ -138,8 +222,13 @@ class MusicMeta:
         tag_dict = {}
         f_path = os.path.join(file_obj.get('dir_path', ''), file_obj.get('file', ''))
         try:
-            tag_dict = {k.lower(): v for k, v in dict(list(FLAC(f_path).tags)).items()}
-            return self.map_tags(tag_dict)
+            flac_file = FLAC(f_path)
+            tag_dict = self.map_tags({k.lower(): v for k, v in dict(list(flac_file.tags)).items()})
+            # Stream properties, named and scaled as by TinyTag (bitrate in kbps):
+            tag_dict['duration'] = flac_file.info.length
+            tag_dict['bitrate'] = flac_file.info.bitrate / 1000
+            tag_dict['samplerate'] = flac_file.info.sample_rate
+            tag_dict['channels'] = flac_file.info.channels
 
         except FLACNoHeaderError:
             try:
@@ -148,6 +237,15 @@ class MusicMeta:
             except Exception as ex:  # pylint: disable=broad-exception-caught
                 log_it("debug", __name__, repr(ex))
 
+        if tag_dict:
+            try:
+                file_stat = os.stat(f_path)
+                tag_dict['filesize'] = file_stat.st_size
+                tag_dict['mtime'] = file_stat.st_mtime
+
+            except OSError as ex:
+                log_it("debug", __name__, repr(ex))
+
         return tag_dict
 
     @staticmethod
@@ -509,21 +607,16 @@ class MusicMeta:
             only_files = [f for f in files if f.split('.')[-1] in USE_FILE_EXTENSIONS]
             curr_dir_name = re.sub(r'^/', '', re.sub(re.compile(self.base_dir), '', curr_dir))
 
-            try:
-                if curr_dir == self.base_dir:
-                    continue
-                # log_it("info", __name__, f"Processing: {curr_dir_name}")
-                res = await sync_to_async(Album.objects.get)(path=curr_dir_name)  # NOQA
+            if curr_dir == self.base_dir:
+                continue
 
-                if res:
-                    self.albums_existing += 1
+            # log_it("info", __name__, f"Processing: {curr_dir_name}")
+            if await sync_to_async(self.album_exists)(curr_dir_name):
+                self.albums_existing += 1
 
-                if res and not self.update:
+                if not self.update:
                     continue
 
-            except Album.DoesNotExist:  # NOQA
-                pass
-
             yml_info = await self.get_music_metadata(in_files=only_files, dir_path=curr_dir, dir_name=curr_dir_name)
             curr_dir_tags = self.tags.get(curr_dir_name)
             if not curr_dir_tags:
@@ -541,8 +634,31 @@ class MusicMeta:
             if self.albums_new_mod >= self.max_albums > 0:
                 break
 
+        if self.index and self.index.modified:
+            self.index.save()
+
+        if self.query_stats:
+            log_it("info", __name__, f"queries={json.dumps(self.query_stats.summary(), indent=4)}")
+
         log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
 
+    def recording(self, album_path):
+        """
+        Record the DB statements run in a block for an album, if query statistics are kept (see db_instrument.py).
+        :param album_path: Album path (relative to the base directory)
+        :return: A context manager
+        """
+        return self.query_stats.album(album_path) if self.query_stats else nullcontext()
+
+    def album_exists(self, album_path):
+        """
+        Tell whether an album directory is in the DB already.
+        :param album_path: Album path (relative to the base directory)
+        :return: True if it is, otherwise False
+        """
+        with self.recording(album_path):
+            return Album.objects.filter(path=album_path).exists()  # NOQA
+
     async def get_music_metadata(self, in_files=None, dir_path=None, dir_name=None):
         """
         Retrieve metadata from tags in .mp3, .flac, .ogg, etc. files and from a .yml if present.
@@ -1008,12 +1124,12 @@ class MusicMeta:
 
         return self.render_as_str(in_notes, in_lead="")
 
-    def album_tags_to_db(self, in_tags, in_yml_data=None):
+    def album_field_dict(self, in_tags, in_yml_data=None):
         """
-        Save Album tags to db -- create a row if necessary or update
+        Build a dictionary of the fields in Album (but the ID) from tags and non-tag data
         :param in_tags: a set of tags from which to extract values
         :param in_yml_data: a dictionary containing information extraction from a yml file
-        :return: an Album instance (new or updated, or existing)
+        :return: A dictionary (see ALBUM_UPSERT_COLUMNS)
         """
         album_name = self.determine_album_title(in_tags)
         album_label = self.determine_album_label(in_tags, in_yml_data)
@@ -1021,6 +1137,7 @@ class MusicMeta:
         album_path = self.determine_album_path(in_tags)
         album_artist = self.determine_album_artist(in_tags, in_yml_data)
         album_comment = self.fix_comment(self.determine_album_comment(in_tags, in_yml_data))
+        track_count, total_duration = self.determine_album_totals(in_tags)
 
         album_dict = {
             'title': album_name,
@@ -1028,33 +1145,46 @@ class MusicMeta:
             'comment': album_comment,
             'label': album_label,
             'path': album_path,
-            'date': datetime.datetime(album_year, 1, 1)
+            'date': datetime.date(album_year, 1, 1),
+            'track_count': track_count,
+            'total_duration': total_duration
         }
-        album_identifiers = ['title', 'artist', 'path']
 
-        new_mod = 0
+        return {**album_dict, 'digest': row_digest(album_dict)}
+
+    def album_tags_to_db(self, in_tags, in_yml_data=None, stored=None):
+        """
+        Save Album tags to db -- create a row if necessary or update
+        :param in_tags: a set of tags from which to extract values
+        :param in_yml_data: a dictionary containing information extraction from a yml file
+        :param stored: Digests of the album in the DB (see stored_digests()), so that it is not written if unchanged
+        :return: a tuple (Album instance, 1 if the row has been created or updated, otherwise 0)
+        """
+        album_dict = self.album_field_dict(in_tags, in_yml_data)
+        album_path = album_dict['path']
+
+        if stored and stored[2] == album_dict['digest']:
+            return Album(**{**album_dict, 'id': stored[0], 'date': stored[1]}), 0
+
+        values = [album_dict[column] for column in ALBUM_UPSERT_COLUMNS]
+
         try:
-            db_album = Album.objects.get(**{k: v for k, v in album_dict.items() if k in album_identifiers})  # NOQA
-            use_date = db_album.date if (db_album.date and album_year == db_album.date.year) else \
-                datetime.datetime(album_year or 1900, 1, 1)
-            album_dict['date'] = use_date
-            updates = {k: v for k, v in album_dict.items() if v != db_album.__dict__.get(k, None)}
-
-            if not updates:
-                return db_album, new_mod
-
-            new_mod = 1
-            db_album.__dict__.update(**updates)
-            db_album.save()
-        except Album.DoesNotExist:  # NOQA
-            new_mod = 1
-            db_album = Album(**album_dict)
-            db_album.save()
-        except ValueError:
+            with connection.cursor() as cursor:
+                cursor.execute(ALBUM_UPSERT_SQL.format(year_a=year_sql('a.date'), year_x=year_sql('EXCLUDED.date')),
+                               values)
+                row = cursor.fetchone()
+                new_mod = 1 if row else 0
+
+                if not row:
+                    # Unchanged: the upsert skipped the row and returned nothing
+                    cursor.execute(ALBUM_BY_PATH_SQL, [album_path])
+                    row = cursor.fetchone()
+
+        except (ValueError, DataError):
             log_it('error', __name__, f"\n{repr(album_dict)}")
             sys.exit(111)
 
-        return db_album, new_mod
+        return Album(**{**album_dict, 'id': row[0], 'date': as_date(row[1])}), new_mod
 
     def song_field_dict(self, in_tags, album_inst, non_tag_data=None, song_id_map=None):
         """
@@ -1086,9 +1216,9 @@ class MusicMeta:
 
         year = self.determine_song_year(tag_data.year, non_tag_data.get('year', 1900))
         use_date = album_inst.date if (album_inst and year == album_inst.date.year) else \
-            datetime.datetime(year or 1900, 1, 1)
+            datetime.date(year or 1900, 1, 1)
 
-        return {
+        song_dict = {
             'title': tag_data.title or '',
             'file': tag_data.file or '',
             'track_id': (track + 1) if track >= 0 else track,
@@ -1098,39 +1228,90 @@ class MusicMeta:
             'performer': tag_data.albumartist or '',
             'composer': tag_data.composer or '',
             'date': use_date,
+            'duration': self.determine_song_duration(in_tags),
+            **self.determine_audio_properties(in_tags),
             'album_id': album_inst.id
         }
 
-    def song_tags_to_db(self, music_tags, album_obj, meta_data=None, id_map=None):
+        return {**song_dict, 'digest': row_digest(song_dict)}
+
+    @staticmethod
+    def determine_song_duration(in_tags):
         """
-        Save Song tags to db -- create a row if necessary or update
-        :param music_tags: A set of tags from which to extract values
+        Get the song duration from the received tags.
+        :param in_tags: Dictionary of tags (the duration is read from the audio stream, not from a tag)
+        :return: Duration in seconds as a float or None if not known
+        """
+        try:
+            duration = float(in_tags.get('duration') or 0)
+        except (TypeError, ValueError):
+            return None
+
+        return round(duration, 3) if duration > 0 else None
+
+    @staticmethod
+    def determine_audio_properties(in_tags):
+        """
+        Get the technical properties of a song from the received tags.
+        :param in_tags: Dictionary of tags (see get_tags_from_file(): the properties are not tags)
+        :return: A dictionary (see AUDIO_PROPERTIES), None for the properties not known
+        """
+        properties = {}
+
+        for name in AUDIO_PROPERTIES:
+            try:
+                value = float(in_tags.get(name) or 0)
+            except (TypeError, ValueError):
+                value = 0
+
+            # mtime is kept to the millisecond, the others are whole numbers
+            properties[name] = (round(value, 3) if name == 'mtime' else round(value)) if value > 0 else None
+
+        return properties
+
+    def determine_album_totals(self, in_tags):
+        """
+        Get the number of tracks and the total duration of an album.
+        :param in_tags: A list of tag dictionaries, one per music file
+        :return: A tuple (number of tracks, duration in seconds or None if no track duration is known)
+        """
+        durations = {music_tags.get('file', ''): self.determine_song_duration(music_tags) for music_tags in in_tags}
+        known = [duration for duration in durations.values() if duration]
+
+        return len(durations), round(sum(known), 3) if known else None
+
+    def songs_tags_to_db(self, dir_tags, album_obj, meta_data=None, id_map=None, song_digests=None):
+        """
+        Save the Song tags of an album to db in one statement -- create rows if necessary or update
+        :param dir_tags: A list of tag dictionaries, one per music file
         :param album_obj: Instance of Album
         :param meta_data: Metadata retrieved from the album yaml file (if any)
         :param id_map: A dict mapping string song id's in an album/collection to numeric indexes
-        :return: True on creation or update, otherwise False
+        :param song_digests: A dictionary: file -> digest of the songs in the DB; songs with the same digest are
+                             not written
+        :return: Number of rows created or updated
         """
-        song_dict = self.song_field_dict(music_tags, album_obj, meta_data, id_map)
-        song_identifiers = ['title', 'file', 'artist']
-        new_mod = 0
+        # One row per file, or the upsert would hit the same row twice:
+        song_rows = {}
+        song_digests = song_digests or {}
 
-        try:
-            db_song = Song.objects.get(**{k: v for k, v in song_dict.items() if k in song_identifiers})  # NOQA
-            updates = {k: v for k, v in song_dict.items() if v != db_song.__dict__.get(k, None)}
+        for music_tags in dir_tags:
+            song_dict = self.song_field_dict(music_tags, album_obj, meta_data, id_map)
+            song_rows[song_dict['file']] = [song_dict[column] for column in SONG_UPSERT_COLUMNS]
 
-            if not updates:
-                return new_mod
+        digest_ix = SONG_UPSERT_COLUMNS.index('digest')
+        song_rows = {file: values for file, values in song_rows.items() if song_digests.get(file) != values[digest_ix]}
 
-            new_mod = 1
-            db_song.__dict__.update(**updates)
-            db_song.save()
+        if not song_rows:
+            return 0
 
-        except Song.DoesNotExist:  # NOQA
-            new_mod = 1
-            db_song = Song(**song_dict)
-            db_song.save()
+        row_sql = f"({', '.join(['%s'] * len(SONG_UPSERT_COLUMNS))})"
+        sql = SONG_UPSERT_SQL.format(rows=', '.join([row_sql] * len(song_rows)))
 
-        return new_mod
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [val for values in song_rows.values() for val in values])
+
+            return len(cursor.fetchall())
 
     def tags_to_db(self, dir_tags, from_yaml=None, id_map=None):
         """
@@ -1140,10 +1321,20 @@ class MusicMeta:
         :param id_map: A mapping of track ID's
         :return: void
         """
-        album, new_or_mod = self.album_tags_to_db(dir_tags, from_yaml)
+        album_path = self.determine_album_path(dir_tags)
+
+        with self.recording(album_path):
+            # One statement reads the digests of the album and its songs: an unchanged album costs nothing more
+            stored = stored_digests(album_path)
+            album, new_or_mod = self.album_tags_to_db(dir_tags, from_yaml, stored)
+            new_or_mod += self.songs_tags_to_db(dir_tags, album, from_yaml, id_map, stored[3] if stored else None)
 
-        for tags in dir_tags:
-            new_or_mod += self.song_tags_to_db(tags, album, from_yaml, id_map)
+            if new_or_mod > 0:
+                self.albums_new_mod += 1
+                refresh_search_vectors(album.id)
+                self.dims.link_album(album.id)
+                MusicFacets.update_album(album.id)
+                bump_library_generation()
 
-        if new_or_mod > 0:
-            self.albums_new_mod += 1
+                if self.index:
+                    self.index.update_album_from_db(album.id)
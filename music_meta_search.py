@@ -11,9 +11,13 @@ the user.
 ###############################################################################
 import argparse
 import datetime
+import json
 import os
 import re
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 # from ctypes.wintypes import BOOLEAN
 from os import listdir
 from os.path import isfile, join
@@ -28,6 +32,11 @@ from mutagen.flac import FLAC, FLACNoHeaderError  # NOQA # pylint: disable=unuse
 from ruamel.yaml.comments import CommentedMap, CommentedSeq  # NOQA  # pylint: disable=unused-import
 from tinytag import TinyTag
 import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from music_db_search import MusicDbSearch  # pylint: disable=import-error
+from music_index import DEFAULT_INDEX_PATH, MusicIndexSearch  # pylint: disable=import-error
+from tag_matcher import TagMatcher  # pylint: disable=import-error
+from search_query import QuerySyntaxError, SearchQuery  # pylint: disable=import-error
+from tag_prefilter import TagPrefilter  # pylint: disable=import-error
 from utils import log_it, USE_FILE_EXTENSIONS, eval_bool, write_json_file  # pylint: disable=import-error
 
 composer_classical = ['Beethoven', 'Mozart', 'Chopin']
@@ -46,19 +55,26 @@ MAX_YEAR_DIGITS = 4
 
 DEFAULT_TAG_MAPPING = {-1: -1}
 
+# How many album directories to queue per worker thread ahead of the one whose result is awaited:
+PENDING_DIRS_PER_WORKER = 4
+
+INDEX_REGEX_ERROR = "The index matches words, not regex patterns: search source db or fs with -x"
+
 
 class MusicMetaSearch:
     """
     This class encapsulates music metadata.
     """
 
-    def __init__(self, base_dir, find_txt=None, use_regex=False, max_albums=None):
+    def __init__(self, base_dir, find_txt=None, use_regex=False, max_albums=None, ignore_case=False,
+                 match_all=False, workers=1, query=None, on_match=None):
         self.split_pattern = r'[_-]+$'
         self._base_dir = base_dir
         self._candidate = {}
         self._consider = {}
         self._tags = {}
-        self._find_this = self._rx_search = None
+        self._find_this = self._rx_search = self._ignore_case = self._match_all = None
+        self._matcher = self._prefilter = self._query = None
         self._max_albums = -1
         self.albums_existing = 0
         self.albums_new_mod = 0
@@ -66,7 +82,13 @@ class MusicMetaSearch:
         self.created = False
         self.find_this = find_txt
         self.rx_search = use_regex
+        self.ignore_case = ignore_case
+        self.match_all = match_all
         self.max_albums = max_albums
+        self.workers = max(1, int(workers or 1))
+        self.query = query
+        self.on_match = on_match
+        self.albums_seen = set()
 
     @property
     def tags(self):  # pylint: disable=missing-function-docstring
@@ -98,9 +120,10 @@ class MusicMetaSearch:
         This property holds the text to search for or a regex pattern
         to use in the search.
         :param in_find_what: A string which holds either the text to
-        find or a regex patter to use in the search.
+        find or a regex patter to use in the search, or a list of such strings.
         """
         self._find_this = in_find_what
+        self._matcher = self._prefilter = None
 
     @property
     def rx_search(self):
@@ -117,6 +140,65 @@ class MusicMetaSearch:
         :param in_val: A value that indicates whether to run regex searchh.
         """
         self._rx_search = eval_bool(in_val)
+        self._matcher = self._prefilter = None
+
+    @property
+    def ignore_case(self):
+        """
+        This property indicates whether the search is case-insensitive.
+        """
+        return self._ignore_case
+
+    @ignore_case.setter
+    def ignore_case(self, in_val):
+        self._ignore_case = eval_bool(in_val)
+        self._matcher = self._prefilter = None
+
+    @property
+    def match_all(self):
+        """
+        This property indicates whether all the search terms must be found (otherwise any will do).
+        """
+        return self._match_all
+
+    @match_all.setter
+    def match_all(self, in_val):
+        self._match_all = eval_bool(in_val)
+        self._matcher = self._prefilter = None
+
+    @property
+    def matcher(self):
+        """
+        This property holds the TagMatcher for the current search criteria, compiled on first use.
+        """
+        if not self._matcher:
+            self._matcher = TagMatcher(self.find_this, match_all=self.match_all, use_regex=self.rx_search,
+                                       ignore_case=self.ignore_case)
+
+        return self._matcher
+
+    @property
+    def query(self):
+        """
+        This property holds a SearchQuery (field-scoped query), used instead of find_this when set.
+        """
+        return self._query
+
+    @query.setter
+    def query(self, in_query):
+        self._query = SearchQuery(in_query) if isinstance(in_query, str) and in_query.strip() else in_query or None
+        self._prefilter = None
+
+    @property
+    def prefilter(self):
+        """
+        This property holds the TagPrefilter rejecting files before their tags are decoded, or None if the
+        search criteria cannot be tested on raw tag bytes (regex and case-insensitive searches).
+        """
+        if self._prefilter is None and not self.rx_search and not self.ignore_case and not self.query:
+            self._prefilter = TagPrefilter(self.find_this, match_all=self.match_all)
+
+        return self._prefilter
 
     @property
     def max_albums(self):  # pylint: disable=missing-function-docstring
@@ -193,44 +275,31 @@ class MusicMetaSearch:
         :param in_tag_dict:  A dictionary of tags to search through
         :return: True is text is found in a tag, otherwise False
         """
-        if not in_tag_dict:
-            return False
-
-        for val in in_tag_dict.values():
-            if self.rx_search:
-                try:
-                    if re.search(re.compile(self.find_this), str(val)):
-                        return True
-                except TypeError:
-                    log_it('error', __name__, f"Val={val} s_c={self.find_this}")
-                    exit(1)
+        return self.matcher.matches(in_tag_dict)
 
-                continue
-
-            if self.find_this in str(val):
-                return True
-
-        return False
-
-    def get_music_file_tags(self, in_file_info):
+    def match_music_file(self, in_file_info):
         """
-        Get metadata tags from a music file
+        Get metadata tags from a music file if they match the search criteria. Does not change the state
+        of the instance, so it can run in worker threads.
         :param in_file_info: A dictionary containing file information (path, name)
-        :return: True if self.search_in_tags() finds search str in a tag, else False.
+        :return: A dictionary of the tags to save if self.search_in_tags() finds search str in a tag, else None.
         """
         in_file_tags = {}
         in_dir_path = in_file_info.get('dir_path', '')
-        in_dir_name = in_file_info.get('dir_name', '')
         in_file = in_file_info.get('file', '')
         in_file_tags['directory'] = re.sub(r'^/', '', re.sub(re.compile(self.base_dir), '', in_dir_path))
         in_file_tags['file'] = in_file.split('/')[-1]
-        tag_dict = self.get_tags_from_file(in_file_info)
 
-        if not self.search_in_tags(tag_dict):
-            return False
+        if self.prefilter and not self.prefilter.may_match(os.path.join(in_dir_path, in_file)):
+            return None
 
-        if in_dir_name and in_dir_name not in self.tags:
-            self.tags[in_dir_name] = []
+        tag_dict = self.get_tags_from_file(in_file_info)
+
+        if self.query:
+            if not self.query.matches({**tag_dict, **in_file_tags}):
+                return None
+        elif not self.search_in_tags(tag_dict):
+            return None
 
         save_dict = {
             **in_file_tags,
@@ -241,6 +310,23 @@ class MusicMetaSearch:
 
         save_dict['comment'] = self.fix_comment(save_dict.get('comment', ''))
 
+        return save_dict
+
+    def get_music_file_tags(self, in_file_info):
+        """
+        Get metadata tags from a music file
+        :param in_file_info: A dictionary containing file information (path, name)
+        :return: True if self.search_in_tags() finds search str in a tag, else False.
+        """
+        in_dir_name = in_file_info.get('dir_name', '')
+        save_dict = self.match_music_file(in_file_info)
+
+        if not save_dict:
+            return False
+
+        if in_dir_name and in_dir_name not in self.tags:
+            self.tags[in_dir_name] = []
+
         self.tags[in_dir_name].append(save_dict)
         return True
 
@@ -500,27 +586,118 @@ class MusicMetaSearch:
         write them to db tables (Album, Song)
         :return: void
         """
+        if self.workers > 1:
+            self.collect_tags_parallel()
+            return
+
         start_time = datetime.datetime.now()
 
-        for curr_dir, sub_dirs, files in os.walk(self.base_dir):
-            _ = sub_dirs
-            only_files = [f for f in files if f.split('.')[-1] in USE_FILE_EXTENSIONS]
-            curr_dir_name = re.sub(r'^/', '', re.sub(re.compile(self.base_dir), '', curr_dir))
+        if not self.find_this and not self.query:
+            log_it("info", __name__, f"No search criteria provided ({self.find_this})")
+            return
+
+        for curr_dir, curr_dir_name, only_files in self.walk_album_dirs():
+            dir_tags = self.search_album_dir(curr_dir, curr_dir_name, only_files)
+
+            if dir_tags and self.save_album_tags(curr_dir_name, dir_tags):
+                break
+
+        log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
+
+    def save_album_tags(self, dir_name, dir_tags):
+        """
+        Save the tags of a matching album in `self.tags` or, if on_match is set, pass them on
+        so that they need not be kept.
+        :param dir_name: The name of the album/CD directory
+        :param dir_tags: A list of tag dictionaries
+        :return: True if max_albums albums have been found, otherwise False
+        """
+        self.albums_seen.add(dir_name)
+
+        if self.on_match:
+            self.on_match(dir_name, dir_tags)
+        else:
+            self.tags[dir_name] = dir_tags
 
+        return len(self.albums_seen) >= self.max_albums > 0
+
+    def walk_album_dirs(self):
+        """
+        Walk the base directory, top-down.
+        :return: A generator of (directory path, directory name relative to the base directory, music files) tuples
+        """
+        for curr_dir, _, files in os.walk(self.base_dir):
             if curr_dir == self.base_dir:
                 continue
 
-            log_it("info", __name__, f"Processing: {curr_dir_name}")
-            self.get_music_metadata(in_files=only_files, dir_path=curr_dir, dir_name=curr_dir_name)
-            curr_dir_tags = self.tags.get(curr_dir_name)
-            if not curr_dir_tags:
-                continue
+            only_files = [f for f in files if f.split('.')[-1] in USE_FILE_EXTENSIONS]
+            curr_dir_name = re.sub(r'^/', '', re.sub(re.compile(self.base_dir), '', curr_dir))
 
-            if self.max_albums <= 0:
-                continue
+            yield curr_dir, curr_dir_name, only_files
 
-            if len(self.tags.keys()) >= self.max_albums > 0:
-                break
+    def search_album_dir(self, dir_path, dir_name, in_files, stop=None):
+        """
+        Search the files of an album directory (runs in a worker thread).
+        :param dir_path: The path to the album/CD directory
+        :param dir_name: The name of the album/CD directory
+        :param in_files: A list of files from the directory
+        :param stop: A threading.Event set when the search is over, checked before reading each file
+        :return: A list containing the tags of the first matching file, empty if no file matches
+        """
+        log_it("info", __name__, f"Processing: {dir_name}")
+
+        for f in in_files:
+            if stop and stop.is_set():
+                return []
+
+            save_dict = self.match_music_file({'file': f, 'dir_path': dir_path, 'dir_name': dir_name})
+
+            if save_dict:
+                return [save_dict]
+
+        return []
+
+    def collect_tags_parallel(self):
+        """
+        Search album directories in a pool of worker threads (see workers). Results are saved
+        (see save_album_tags()) in the order the directories are walked; once max_albums matches are found,
+        the workers stop and directories not yet searched are dropped.
+        :return: void
+        """
+        start_time = datetime.datetime.now()
+
+        if not self.find_this and not self.query:
+            log_it("info", __name__, f"No search criteria provided ({self.find_this})")
+            return
+
+        _ = self.matcher, self.prefilter  # Compile once, before the workers start
+        stop = threading.Event()
+        pending = deque()
+        album_dirs = self.walk_album_dirs()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                while len(pending) < self.workers * PENDING_DIRS_PER_WORKER:
+                    next_dir = next(album_dirs, None)
+
+                    if not next_dir:
+                        break
+
+                    pending.append((next_dir[1], pool.submit(self.search_album_dir, *next_dir, stop)))
+
+                if not pending:
+                    break
+
+                dir_name, future = pending.popleft()
+                dir_tags = future.result()
+
+                if dir_tags and self.save_album_tags(dir_name, dir_tags):
+                    stop.set()
+
+                    for _, not_done in pending:
+                        not_done.cancel()
+
+                    break
 
         log_it("info", __name__, f"runtime={str(datetime.datetime.now() - start_time)}")
 
@@ -534,7 +711,7 @@ class MusicMetaSearch:
         :return: A dictionary representing the contents fo the yaml file
         """
 
-        if not self.find_this:
+        if not self.find_this and not self.query:
             log_it("info", __name__, f"No search criteria provided ({self.find_this})")
             return
 
@@ -633,6 +810,67 @@ class MusicMetaSearch:
         return type_select.get(type(in_item), self.str_type_as_str)(in_item, in_lead)
 
 
+def ndjson_sink(out_stream):
+    """
+    Create an on_match callback writing each matching album as one line of JSON, flushed at once,
+    so results can be piped to other programs while the search runs.
+    :param out_stream: A text stream, e.g. sys.stdout
+    :return: A function taking the directory name and the list of tag dictionaries of an album
+    """
+    def write_album(dir_name, dir_tags):
+        out_stream.write(json.dumps({'directory': dir_name, 'tags': dir_tags}, sort_keys=True, ensure_ascii=False))
+        out_stream.write('\n')
+        out_stream.flush()
+
+    return write_album
+
+
+def create_search(source='fs', base_dir=None, find_txt=None, query=None, max_albums=-1, use_regex=False,
+                  ignore_case=False, match_all=False, workers=1, index_path=DEFAULT_INDEX_PATH, index=None,
+                  on_match=None):
+    """
+    Create the search object for a source.
+    :param source: Where to search: 'fs' (audio files under base_dir), 'db' (album and song tables) or 'index'
+    (the tag index, see index_path or index)
+    :param index: A loaded MusicIndex to use instead of loading index_path
+    :return: A MusicMetaSearch, MusicDbSearch or MusicIndexSearch instance
+    """
+    if source == 'index' and eval_bool(use_regex):
+        raise ValueError(INDEX_REGEX_ERROR)
+
+    if source == 'index':
+        terms = [find_txt] if isinstance(find_txt, str) else find_txt or []
+        return MusicIndexSearch(
+            max_albums=max_albums,
+            find_txt=find_txt,
+            match_all=eval_bool(match_all) or len(terms) < 2,
+            index_path=index_path,
+            index=index,
+            query=query,
+            on_match=on_match)
+
+    if source == 'db':
+        return MusicDbSearch(
+            max_albums=max_albums,
+            find_txt=find_txt,
+            use_regex=use_regex,
+            ignore_case=ignore_case,
+            match_all=match_all,
+            query=query,
+            on_match=on_match)
+
+    return MusicMetaSearch(
+        base_dir=base_dir,
+        max_albums=max_albums,
+        find_txt=find_txt,
+        use_regex=use_regex,
+        ignore_case=ignore_case,
+        match_all=match_all,
+        workers=workers,
+        query=query,
+        on_match=on_match)
+
+
 PROGRAM_DESCRIPTION = "This program searches tags in audio files."
 
 if __name__ == '__main__':
@@ -653,29 +891,119 @@ if __name__ == '__main__':
                         required=False)
 
     parser.add_argument("-f", "--find",
-                        help="If provided, the program searches for this string in metadata.",
+                        help="If provided, the program searches for this string in metadata. "
+                             "Repeat to search for several strings (see -a).",
                         type=str,
                         dest='search_str',
+                        action='append',
+                        default=[],
+                        required=False)
+
+    parser.add_argument("-q", "--query",
+                        help="If provided, the program runs this field-scoped query instead of -f, e.g. "
+                             "'artist:\"Miles Davis\" year:1955..1960 genre:jazz -live' (see search_query.py).",
+                        type=str,
+                        dest='query',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-a", "--all",
+                        help="If provided and the value evaluates to True, all the search strings must be found, "
+                             "otherwise any of them will do.",
+                        type=str,
+                        dest='match_all',
                         default='',
                         required=False)
 
     parser.add_argument("-x", "--rx",
-                        help="If provided, the program treats search_str as a regex pattern.",
-                        type=bool,
+                        help="If provided and the value evaluates to True, the program treats search_str as a "
+                             "regex pattern.",
+                        type=str,
                         dest='use_rx',
-                        default=False,
+                        default='False',
+                        required=False)
+
+    parser.add_argument("-i", "--ignore_case",
+                        help="If provided and the value evaluates to True, the search is case-insensitive.",
+                        type=str,
+                        dest='ignore_case',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-w", "--workers",
+                        help="Number of worker threads searching album directories in parallel (audio files only).",
+                        type=int,
+                        dest='workers',
+                        default=1,
+                        required=False)
+
+    parser.add_argument("-s", "--source",
+                        help="Where to search: 'fs' reads the audio files under the directory (default), "
+                             "'db' queries the album and song tables, 'index' looks up the tag index "
+                             "(all the words must match, regex is not supported).",
+                        type=str,
+                        dest='source',
+                        choices=['fs', 'db', 'index'],
+                        default='fs',
+                        required=False)
+
+    parser.add_argument("-o", "--ndjson",
+                        help="If provided, each matching album is written as soon as it is found, as one line of "
+                             "JSON, to this file or to stdout if the value is '-', instead of ~/temp/temp.json.",
+                        type=str,
+                        dest='ndjson',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-n", "--index",
+                        help=f"Path to the tag index file used with '-s index', default: {DEFAULT_INDEX_PATH}",
+                        type=str,
+                        dest='index_path',
+                        default=DEFAULT_INDEX_PATH,
                         required=False)
 
     args = parser.parse_args()
 
-    rd = MusicMetaSearch(
+    if args.source == 'index' and eval_bool(args.use_rx):
+        parser.error(INDEX_REGEX_ERROR)
+
+    try:
+        search_query = SearchQuery(args.query) if args.query else None
+    except QuerySyntaxError as query_err:
+        log_it("error", __name__, str(query_err))
+        sys.exit(1)
+
+    if not args.ndjson:
+        out_ndjson = None
+    elif args.ndjson == '-':
+        out_ndjson = sys.stdout
+    else:
+        out_ndjson = open(args.ndjson, 'w', encoding="UTF-8")  # pylint: disable=consider-using-with
+
+    on_album = ndjson_sink(out_ndjson) if out_ndjson else None
+
+    rd = create_search(
+        source=args.source,
         base_dir=args.base_dir,
-        max_albums=args.limit,
         find_txt=args.search_str,
-        use_regex=args.use_rx)
+        query=search_query,
+        max_albums=args.limit,
+        use_regex=args.use_rx,
+        ignore_case=args.ignore_case,
+        match_all=args.match_all,
+        workers=args.workers,
+        index_path=args.index_path,
+        on_match=on_album)
 
     rd.collect_tags()
 
+    if out_ndjson:
+        if out_ndjson is not sys.stdout:
+            out_ndjson.close()
+
+        log_it("info", __name__, f"Search found {len(rd.albums_seen)} albums")
+        sys.exit(0)
+
     results_count = len(list(rd.tags.keys()))
     if results_count > 0:
         out_file = 'temp.json'
@@ -24,6 +24,7 @@
 
 run_dir="$HOME/scripts/music_base/"
 activate_path="$run_dir/.venv/bin/activate"
+socket_path="$HOME/temp/music_search.sock"
 
 # echo "activation path: $activate_path"
 
@@ -32,8 +33,14 @@ Usage() {
     echo "Usage:                                                                                       "
     echo "    -d directory in which to search                                                          "
     echo "    -f find, the text to find or a regex pattern (remember to provide -x with a value        "
+    echo "    -q query, field-scoped, e.g. 'artist:\"Miles Davis\" year:1955..1960 -live', replaces -f      "
     echo "    -l max number of albums/sub-directories to search, unlimited if not given                "
     echo "    -x If provided and the value evaluates to True, a regex search is used                   "
+    echo "    -a If provided and the value evaluates to True, all search strings must be found          "
+    echo "    -i If provided and the value evaluates to True, the search is case-insensitive            "
+    echo "    -s source to search: fs (audio files, default), db (album and song tables) or index      "
+    echo "    -o NDJSON output: '-' streams one line per matching album to stdout, or a file path     "
+    echo "    -w number of worker threads searching audio files in parallel, 1 if not given            "
     echo "    --help                                                                                   "
 }
 
@@ -48,6 +55,10 @@ do
             what="$2"
             shift
             ;;
+        -q|--query)
+            query="$2"
+            shift
+            ;;
         -l|--limit)
             limit="$2"
             shift
@@ -56,6 +67,26 @@ do
             use_rx="$2"
             shift
             ;;
+        -a|--all)
+            match_all="$2"
+            shift
+            ;;
+        -i|--ignore_case)
+            ignore_case="$2"
+            shift
+            ;;
+        -s|--source)
+            source="$2"
+            shift
+            ;;
+        -o|--ndjson)
+            ndjson="$2"
+            shift
+            ;;
+        -w|--workers)
+            workers="$2"
+            shift
+            ;;
         --help|*)
             Usage
             exit 1
@@ -64,7 +95,7 @@ do
     shift
 done
 
-if [ -z "$what" ]; then
+if [ -z "$what" ] && [ -z "$query" ]; then
     echo "Search criteria missing, exiting"
     exit 1
 fi
@@ -82,9 +113,40 @@ if [ -z "$use_rx" ]; then
     use_rx="False"
 fi
 
-echo "what=""$what"
-echo "start=""$start_place"
-echo "limit=""$limit"
-echo "use_rx=""$use_rx"
+if [ -z "$match_all" ]; then
+    match_all="False"
+fi
+
+if [ -z "$ignore_case" ]; then
+    ignore_case="False"
+fi
+
+if [ -z "$source" ]; then
+    source="fs"
+fi
+
+if [ -z "$workers" ]; then
+    workers=1
+fi
+
+echo "what=""$what" >&2
+echo "query=""$query" >&2
+echo "start=""$start_place" >&2
+echo "limit=""$limit" >&2
+echo "use_rx=""$use_rx" >&2
+echo "match_all=""$match_all" >&2
+echo "ignore_case=""$ignore_case" >&2
+echo "source=""$source" >&2
+echo "workers=""$workers" >&2
+
+## With the search server (search_server.py) running, the thin client needs neither the venv nor Django:
+if [ -S "$socket_path" ]; then
+    python3 "$run_dir/search_client.py" -u "$socket_path" -d "$start_place" -f "$what" -q "$query" -l "$limit" -x "$use_rx" -a "$match_all" -i "$ignore_case" -s "$source" -w "$workers" -o "$ndjson"
+    status=$?
+
+    if [ "$status" -ne 2 ]; then
+        exit "$status"
+    fi
+fi
 
-. "$activate_path" && cd "$run_dir" && python ./music_meta_search.py -d "$start_place" -f "$what" -l "$limit" -x "$use_rx" && deactivate
+. "$activate_path" && cd "$run_dir" && python ./music_meta_search.py -d "$start_place" -f "$what" -q "$query" -l "$limit" -x "$use_rx" -a "$match_all" -i "$ignore_case" -s "$source" -w "$workers" -o "$ndjson" && deactivate
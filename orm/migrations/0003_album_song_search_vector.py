@@ -0,0 +1,117 @@
+# Full-text search support: tsvector columns on album and song, kept current by MusicMeta.tags_to_db().
+# On SQLite, external-content FTS5 tables over the same columns, kept current by triggers; the album and song
+# tables are rebuilt first with integer primary keys, which SQLite assigns on insert (as bigserial does),
+# and with the song date column of the models, which 0001 lacks.
+
+from django.db import migrations
+from orm.migrations._vendor import VendorSQL  # pylint: disable=import-error
+
+SONG_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(artist, '') || ' ' || coalesce(composer, '') || ' ' || "
+    "coalesce(performer, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(genre, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(comment, '')), 'D')"
+)
+
+ALBUM_VECTOR = (
+    "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(artist, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(label, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(comment, '')), 'D')"
+)
+
+# Columns of the FTS5 tables, in order of weight (see music_fts.py)
+FTS_COLUMNS = {
+    'album': ['title', 'artist', 'label', 'comment'],
+    'song': ['title', 'artist', 'composer', 'performer', 'genre', 'comment'],
+}
+
+SQLITE_TABLES = {
+    'album': "id integer PRIMARY KEY AUTOINCREMENT, title text, artist text, date date, comment text, label text, "
+             "path text",
+    'song': "title text, id integer PRIMARY KEY AUTOINCREMENT, track_id integer, genre text, artist text, "
+            "composer text, performer text, date date, file text, comment text, "
+            "album_id bigint REFERENCES album (id) DEFERRABLE INITIALLY DEFERRED",
+}
+
+# Columns of SQLITE_TABLES which 0001 has not created
+SQLITE_NEW_COLUMNS = {
+    'album': [],
+    'song': ['date'],
+}
+
+
+def rebuild_sql(table):
+    """
+    SQL rebuilding a table created by 0001 with its new definition, keeping the rows.
+    """
+    columns = ', '.join(column.split()[0] for column in SQLITE_TABLES[table].split(', ')
+                        if column.split()[0] not in SQLITE_NEW_COLUMNS[table])
+
+    return [
+        f"CREATE TABLE {table}_new ({SQLITE_TABLES[table]})",
+        f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}",
+        f"DROP TABLE {table}",
+        f"ALTER TABLE {table}_new RENAME TO {table}",
+    ]
+
+
+def fts_sql(table):
+    """
+    SQL creating the FTS5 table of a table and the triggers keeping it current.
+    """
+    columns = ', '.join(FTS_COLUMNS[table])
+    new_values = ', '.join(f"new.{column}" for column in FTS_COLUMNS[table])
+    old_values = ', '.join(f"old.{column}" for column in FTS_COLUMNS[table])
+    delete_old = f"INSERT INTO {table}_fts ({table}_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+    insert_new = f"INSERT INTO {table}_fts (rowid, {columns}) VALUES (new.id, {new_values});"
+
+    return [
+        f"CREATE VIRTUAL TABLE {table}_fts USING fts5({columns}, content='{table}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER {table}_fts_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+        f"CREATE TRIGGER {table}_fts_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        f"CREATE TRIGGER {table}_fts_au AFTER UPDATE ON {table} BEGIN {delete_old} {insert_new} END",
+        f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')",
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0002_authgroup_authgrouppermissions_authpermission_and_more'),
+    ]
+
+    operations = [
+        VendorSQL(
+            sql={
+                'postgresql': [
+                    "ALTER TABLE album ADD COLUMN search_vector tsvector",
+                    "ALTER TABLE song ADD COLUMN search_vector tsvector",
+                    f"UPDATE album SET search_vector = {ALBUM_VECTOR}",
+                    f"UPDATE song SET search_vector = {SONG_VECTOR}",
+                    "CREATE INDEX album_search_vector_idx ON album USING gin (search_vector)",
+                    "CREATE INDEX song_search_vector_idx ON song USING gin (search_vector)",
+                    "CREATE INDEX song_album_id_idx ON song (album_id)",
+                ],
+                'sqlite': rebuild_sql('album') + rebuild_sql('song') + fts_sql('album') + fts_sql('song') + [
+                    "CREATE INDEX song_album_id_idx ON song (album_id)",
+                ],
+            },
+            reverse_sql={
+                'postgresql': [
+                    "DROP INDEX song_album_id_idx",
+                    "DROP INDEX song_search_vector_idx",
+                    "DROP INDEX album_search_vector_idx",
+                    "ALTER TABLE song DROP COLUMN search_vector",
+                    "ALTER TABLE album DROP COLUMN search_vector",
+                ],
+                'sqlite': [
+                    "DROP INDEX song_album_id_idx",
+                ] + [f"DROP TRIGGER {table}_fts_{event}" for table in FTS_COLUMNS for event in ['ai', 'ad', 'au']] + [
+                    f"DROP TABLE {table}_fts" for table in FTS_COLUMNS
+                ],
+            },
+        ),
+    ]
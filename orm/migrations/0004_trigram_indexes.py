@@ -0,0 +1,34 @@
+# Trigram indexes so that LIKE/ILIKE and regex (~, ~*) searches on text columns can use an index.
+# PostgreSQL only: SQLite has no such index type.
+
+from django.db import migrations
+from orm.migrations._vendor import VendorSQL  # pylint: disable=import-error
+
+TRIGRAM_COLUMNS = {
+    'album': ['title', 'artist', 'label', 'comment'],
+    'song': ['title', 'artist', 'composer', 'performer', 'genre', 'comment'],
+}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0003_album_song_search_vector'),
+    ]
+
+    operations = [
+        VendorSQL(
+            sql={
+                'postgresql': ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+                    f"CREATE INDEX {table}_{column}_trgm_idx ON {table} USING gin ({column} gin_trgm_ops)"
+                    for table, columns in TRIGRAM_COLUMNS.items() for column in columns
+                ],
+            },
+            reverse_sql={
+                'postgresql': [
+                    f"DROP INDEX {table}_{column}_trgm_idx"
+                    for table, columns in TRIGRAM_COLUMNS.items() for column in columns
+                ],
+            },
+        ),
+    ]
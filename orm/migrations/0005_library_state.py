@@ -0,0 +1,40 @@
+# Library state: a generation counter bumped by the ingest writer whenever albums change, so that
+# cached search results can be invalidated without guessing TTLs
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0004_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "CREATE TABLE library_state ("
+                "id smallint PRIMARY KEY, "
+                "generation bigint NOT NULL DEFAULT 0, "
+                "updated timestamp with time zone)",
+                "INSERT INTO library_state (id, generation, updated) VALUES (1, 0, CURRENT_TIMESTAMP)",
+            ],
+            reverse_sql=[
+                "DROP TABLE library_state",
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name='LibraryState',
+                    fields=[
+                        ('id', models.SmallIntegerField(primary_key=True, serialize=False)),
+                        ('generation', models.BigIntegerField()),
+                        ('updated', models.DateTimeField(blank=True, null=True)),
+                    ],
+                    options={
+                        'db_table': 'library_state',
+                        'managed': False,
+                    },
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Indexes matching the sort keys of the web GUI, so that keyset (seek) pagination reads just one page
+
+from django.db import migrations
+
+KEYSET_COLUMNS = ['artist', 'title']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0005_library_state'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                f"CREATE INDEX song_{column}_keyset_idx ON song ((coalesce({column}, '')), id)"
+                for column in KEYSET_COLUMNS
+            ],
+            reverse_sql=[
+                f"DROP INDEX song_{column}_keyset_idx" for column in KEYSET_COLUMNS
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Song duration in seconds, read from the audio stream at ingest; used by smart playlists (smart_playlist.py)
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0006_song_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "ALTER TABLE song ADD COLUMN duration double precision",
+            ],
+            reverse_sql=[
+                "ALTER TABLE song DROP COLUMN duration",
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='song',
+                    name='duration',
+                    field=models.FloatField(blank=True, null=True),
+                ),
+            ],
+        ),
+    ]
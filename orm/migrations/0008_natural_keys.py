@@ -0,0 +1,56 @@
+# Natural keys of the album and song tables, which the ingest writer upserts on (INSERT ... ON CONFLICT):
+# an album is its directory (path) and a song is a file of an album (album_id, file).
+# Each unique index also serves the lookups by these columns, and song_album_file_key (album_id first)
+# those by album_id. Duplicates left by the former get-then-save writer are merged first, keeping the
+# newest row (PostgreSQL only: a SQLite DB is created by these migrations and has no such rows).
+
+from django.db import migrations, models
+from orm.migrations._vendor import VendorSQL  # pylint: disable=import-error
+
+DEDUPLICATE_SQL = [
+    # Point songs of duplicate albums at the newest album of the same path, then drop the duplicates:
+    "UPDATE song SET album_id = keep.id FROM album AS dup, "
+    "(SELECT path, max(id) AS id FROM album GROUP BY path HAVING count(*) > 1) AS keep "
+    "WHERE song.album_id = dup.id AND dup.path = keep.path AND dup.id <> keep.id",
+    "DELETE FROM album AS dup USING album AS keep WHERE dup.path = keep.path AND dup.id < keep.id",
+    "DELETE FROM song AS dup USING song AS keep "
+    "WHERE dup.album_id = keep.album_id AND dup.file = keep.file AND dup.id < keep.id",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0007_song_duration'),
+    ]
+
+    operations = [
+        VendorSQL(
+            sql={
+                'postgresql': DEDUPLICATE_SQL,
+            },
+            reverse_sql={},
+        ),
+        migrations.RunSQL(
+            sql=[
+                "CREATE UNIQUE INDEX album_path_key ON album (path)",
+                "CREATE UNIQUE INDEX song_album_file_key ON song (album_id, file)",
+                "ANALYZE album",
+                "ANALYZE song",
+            ],
+            reverse_sql=[
+                "DROP INDEX song_album_file_key",
+                "DROP INDEX album_path_key",
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='album',
+                    constraint=models.UniqueConstraint(fields=['path'], name='album_path_key'),
+                ),
+                migrations.AddConstraint(
+                    model_name='song',
+                    constraint=models.UniqueConstraint(fields=['album', 'file'], name='song_album_file_key'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Dimension tables of artists, genres and composers, linked to songs by many-to-many tables, so that faceted
+# filters are integer joins instead of LIKE scans of the free-text song columns.
+# The ingest writer keeps them up to date; fill them for an existing library with: python music_dims.py -r
+
+from django.db import migrations, models
+import django.db.models.deletion
+from orm.migrations._vendor import VendorSQL  # pylint: disable=import-error
+
+DIMENSIONS = ['artist', 'genre', 'composer']
+
+
+ID_COLUMNS = {
+    'postgresql': "id bigserial PRIMARY KEY",
+    'sqlite': "id integer PRIMARY KEY AUTOINCREMENT",
+}
+
+
+def create_sql(dim, vendor):
+    """
+    SQL creating a dimension table and its link table. Artists link with a role: 0 artist, 1 performer.
+    """
+    role_column, role_key = (", role smallint NOT NULL DEFAULT 0", ", role") if dim == 'artist' else ('', '')
+
+    return [
+        f"CREATE TABLE {dim} ({ID_COLUMNS[vendor]}, name text NOT NULL, name_key text NOT NULL UNIQUE)",
+        f"CREATE TABLE song_{dim} ("
+        f"song_id bigint NOT NULL REFERENCES song (id) ON DELETE CASCADE, "
+        f"{dim}_id bigint NOT NULL REFERENCES {dim} (id) ON DELETE CASCADE{role_column}, "
+        f"PRIMARY KEY (song_id, {dim}_id{role_key}))",
+        f"CREATE INDEX song_{dim}_{dim}_idx ON song_{dim} ({dim}_id, song_id)",
+    ]
+
+
+def dimension_model(dim):
+    """
+    State of a dimension model.
+    """
+    return migrations.CreateModel(
+        name=dim.capitalize(),
+        fields=[
+            ('id', models.BigAutoField(primary_key=True, serialize=False)),
+            ('name', models.TextField()),
+            ('name_key', models.TextField(unique=True)),
+        ],
+        options={
+            'db_table': dim,
+            'managed': False,
+        },
+    )
+
+
+def link_model(dim):
+    """
+    State of a link model.
+    """
+    fields = [
+        ('pk', models.CompositePrimaryKey('song', dim, *(['role'] if dim == 'artist' else []), serialize=False)),
+        ('song', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name=f'{dim}_links',
+                                   to='orm.song')),
+        (dim, models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='song_links',
+                                to=f'orm.{dim}')),
+    ]
+
+    if dim == 'artist':
+        fields.append(('role', models.SmallIntegerField(default=0)))
+
+    return migrations.CreateModel(
+        name=f'Song{dim.capitalize()}',
+        fields=fields,
+        options={
+            'db_table': f'song_{dim}',
+            'managed': False,
+        },
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0008_natural_keys'),
+    ]
+
+    operations = [
+        VendorSQL(
+            sql={
+                vendor: [statement for dim in DIMENSIONS for statement in create_sql(dim, vendor)]
+                for vendor in ID_COLUMNS
+            },
+            reverse_sql={
+                vendor: [f"DROP TABLE song_{dim}" for dim in DIMENSIONS] + [f"DROP TABLE {dim}" for dim in DIMENSIONS]
+                for vendor in ID_COLUMNS
+            },
+            state_operations=[dimension_model(dim) for dim in DIMENSIONS] + [link_model(dim) for dim in DIMENSIONS],
+        ),
+    ]
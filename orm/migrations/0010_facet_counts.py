@@ -0,0 +1,71 @@
+# Facet counts (songs and albums per genre, artist, label and decade) for browsing, maintained incrementally by
+# the ingest writer: album_facet holds what each album contributes, facet_count the totals.
+# Fill them for an existing library with: python music_facets.py -r
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0009_dimensions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "CREATE TABLE album_facet ("
+                "album_id bigint NOT NULL REFERENCES album (id) ON DELETE CASCADE, "
+                "facet varchar(16) NOT NULL, "
+                "value_key text NOT NULL, "
+                "value text NOT NULL, "
+                "songs integer NOT NULL, "
+                "PRIMARY KEY (album_id, facet, value_key))",
+                "CREATE TABLE facet_count ("
+                "facet varchar(16) NOT NULL, "
+                "value_key text NOT NULL, "
+                "value text NOT NULL, "
+                "songs integer NOT NULL, "
+                "albums integer NOT NULL, "
+                "PRIMARY KEY (facet, value_key))",
+                "CREATE INDEX facet_count_songs_idx ON facet_count (facet, songs DESC, value_key)",
+            ],
+            reverse_sql=[
+                "DROP TABLE facet_count",
+                "DROP TABLE album_facet",
+            ],
+            state_operations=[
+                migrations.CreateModel(
+                    name='AlbumFacet',
+                    fields=[
+                        ('pk', models.CompositePrimaryKey('album', 'facet', 'value_key', serialize=False)),
+                        ('album', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='orm.album')),
+                        ('facet', models.CharField(max_length=16)),
+                        ('value_key', models.TextField()),
+                        ('value', models.TextField()),
+                        ('songs', models.IntegerField()),
+                    ],
+                    options={
+                        'db_table': 'album_facet',
+                        'managed': False,
+                    },
+                ),
+                migrations.CreateModel(
+                    name='FacetCount',
+                    fields=[
+                        ('pk', models.CompositePrimaryKey('facet', 'value_key', serialize=False)),
+                        ('facet', models.CharField(max_length=16)),
+                        ('value_key', models.TextField()),
+                        ('value', models.TextField()),
+                        ('songs', models.IntegerField()),
+                        ('albums', models.IntegerField()),
+                    ],
+                    options={
+                        'db_table': 'facet_count',
+                        'managed': False,
+                    },
+                ),
+            ],
+        ),
+    ]
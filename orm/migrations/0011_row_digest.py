@@ -0,0 +1,28 @@
+# Content digest of album and song rows, computed by the ingest writer from the normalised field values
+# (see music_meta.row_digest()), so that it can skip the rows of an album which have not changed.
+# Rows written before have no digest and are rewritten once by the next update run.
+
+from django.db import migrations, models
+
+DIGEST_TABLES = ['album', 'song']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0010_facet_counts'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[f"ALTER TABLE {table} ADD COLUMN digest varchar(32)" for table in DIGEST_TABLES],
+            reverse_sql=[f"ALTER TABLE {table} DROP COLUMN digest" for table in DIGEST_TABLES],
+            state_operations=[
+                migrations.AddField(
+                    model_name=table,
+                    name='digest',
+                    field=models.CharField(blank=True, max_length=32, null=True),
+                ) for table in DIGEST_TABLES
+            ],
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Technical properties of songs, read at ingest in the same pass as the tags (see MusicMeta.get_tags_from_file()):
+# bitrate (kbps), sample rate (Hz), channels, file size (bytes) and mtime (seconds since the epoch); and the
+# number of tracks and total duration of albums, so that format and playlist-length queries need neither the
+# files nor an aggregate over song. The digests of existing rows change, so the next update run fills them in.
+
+from django.db import migrations, models
+
+# Table: column -> (SQL type, model field)
+AUDIO_COLUMNS = {
+    'song': {
+        'bitrate': ('integer', models.IntegerField(blank=True, null=True)),
+        'samplerate': ('integer', models.IntegerField(blank=True, null=True)),
+        'channels': ('smallint', models.SmallIntegerField(blank=True, null=True)),
+        'filesize': ('bigint', models.BigIntegerField(blank=True, null=True)),
+        'mtime': ('double precision', models.FloatField(blank=True, null=True)),
+    },
+    'album': {
+        'track_count': ('integer', models.IntegerField(blank=True, null=True)),
+        'total_duration': ('double precision', models.FloatField(blank=True, null=True)),
+    },
+}
+
+AUDIO_INDEXES = {
+    'song_samplerate_bitrate_idx': 'song (samplerate, bitrate)',
+    'album_total_duration_idx': 'album (total_duration)',
+}
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0011_row_digest'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}"
+                 for table, columns in AUDIO_COLUMNS.items() for column, (sql_type, _) in columns.items()] +
+                [f"CREATE INDEX {index} ON {definition}" for index, definition in AUDIO_INDEXES.items()],
+            reverse_sql=[f"DROP INDEX {index}" for index in AUDIO_INDEXES] +
+                        [f"ALTER TABLE {table} DROP COLUMN {column}"
+                         for table, columns in AUDIO_COLUMNS.items() for column in columns],
+            state_operations=[
+                migrations.AddField(
+                    model_name=table,
+                    name=column,
+                    field=field,
+                ) for table, columns in AUDIO_COLUMNS.items() for column, (_, field) in columns.items()
+            ],
+        ),
+    ]
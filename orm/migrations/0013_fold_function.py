@@ -0,0 +1,42 @@
+# SQL function music_fold(text), folding case and diacritics like utils.fold_text(), so that field-scoped
+# queries (SearchQuery.to_q()) match in the DB as they do on tags read from files. PostgreSQL uses unaccent,
+# wrapped in an immutable function so that the trigram indexes below can be built on it; SQLite registers a
+# Python function on every connection (see db_vendor.register_functions()), so nothing is created here.
+
+from django.db import migrations
+from orm.migrations._vendor import VendorSQL  # pylint: disable=import-error
+
+FOLD_COLUMNS = {
+    'album': ['title', 'artist', 'label', 'comment', 'path'],
+    'song': ['title', 'artist', 'composer', 'performer', 'genre', 'comment', 'file'],
+}
+
+FOLD_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION music_fold(text) RETURNS text
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+AS $$ SELECT lower(public.unaccent('public.unaccent'::regdictionary, $1)) $$
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orm', '0012_audio_properties'),
+    ]
+
+    operations = [
+        VendorSQL(
+            sql={
+                'postgresql': ["CREATE EXTENSION IF NOT EXISTS unaccent", FOLD_FUNCTION_SQL] + [
+                    f"CREATE INDEX {table}_{column}_fold_trgm_idx ON {table} USING gin (music_fold({column}) "
+                    "gin_trgm_ops)" for table, columns in FOLD_COLUMNS.items() for column in columns
+                ],
+            },
+            reverse_sql={
+                'postgresql': [
+                    f"DROP INDEX {table}_{column}_fold_trgm_idx"
+                    for table, columns in FOLD_COLUMNS.items() for column in columns
+                ] + ["DROP FUNCTION music_fold(text)"],
+            },
+        ),
+    ]
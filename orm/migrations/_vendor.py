@@ -0,0 +1,25 @@
+# Support for migrations whose SQL differs between the DB backends (PostgreSQL, SQLite; see settings.py).
+# The leading underscore keeps Django's migration loader from taking this module for a migration.
+
+from django.db import migrations, router
+
+
+class VendorSQL(migrations.RunSQL):
+    """
+    RunSQL with statements per backend: sql and reverse_sql map a vendor ('postgresql', 'sqlite') to a list
+    of statements. A backend without an entry runs nothing, e.g. for an index type it does not have.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if router.allow_migrate(schema_editor.connection.alias, app_label, **self.hints):
+            self._run_sql(schema_editor, self.sql.get(schema_editor.connection.vendor, []))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self.reverse_sql is None:
+            raise NotImplementedError("You cannot reverse this operation")
+
+        if router.allow_migrate(schema_editor.connection.alias, app_label, **self.hints):
+            self._run_sql(schema_editor, self.reverse_sql.get(schema_editor.connection.vendor, []))
+
+    def describe(self):
+        return f"Raw SQL operation for {', '.join(sorted(self.sql))}"
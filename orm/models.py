@@ -15,12 +15,41 @@ class Album(models.Model):
     comment = models.TextField(blank=True, null=True)
     label = models.TextField(blank=True, null=True)
     path = models.TextField(blank=True, null=True)
+    digest = models.CharField(max_length=32, blank=True, null=True)
+    track_count = models.IntegerField(blank=True, null=True)
+    total_duration = models.FloatField(blank=True, null=True)
     # id = models.BigIntegerField(primary_key=True)
     id = models.BigAutoField(primary_key=True)
 
     class Meta:
         managed = False
         db_table = 'album'
+        constraints = [
+            models.UniqueConstraint(fields=['path'], name='album_path_key'),
+        ]
+
+
+class AlbumFacet(models.Model):
+    pk = models.CompositePrimaryKey('album', 'facet', 'value_key')
+    album = models.ForeignKey(Album, models.DO_NOTHING)
+    facet = models.CharField(max_length=16)
+    value_key = models.TextField()
+    value = models.TextField()
+    songs = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'album_facet'
+
+
+class Artist(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    name = models.TextField()
+    name_key = models.TextField(unique=True)
+
+    class Meta:
+        managed = False
+        db_table = 'artist'
 
 
 class AuthGroup(models.Model):
@@ -92,6 +121,16 @@ class AuthUserUserPermissions(models.Model):
         unique_together = (('user', 'permission'),)
 
 
+class Composer(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    name = models.TextField()
+    name_key = models.TextField(unique=True)
+
+    class Meta:
+        managed = False
+        db_table = 'composer'
+
+
 class DjangoAdminLog(models.Model):
     action_time = models.DateTimeField()
     object_id = models.TextField(blank=True, null=True)
@@ -137,6 +176,39 @@ class DjangoSession(models.Model):
         db_table = 'django_session'
 
 
+class FacetCount(models.Model):
+    pk = models.CompositePrimaryKey('facet', 'value_key')
+    facet = models.CharField(max_length=16)
+    value_key = models.TextField()
+    value = models.TextField()
+    songs = models.IntegerField()
+    albums = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'facet_count'
+
+
+class Genre(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    name = models.TextField()
+    name_key = models.TextField(unique=True)
+
+    class Meta:
+        managed = False
+        db_table = 'genre'
+
+
+class LibraryState(models.Model):
+    id = models.SmallIntegerField(primary_key=True)
+    generation = models.BigIntegerField()
+    updated = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'library_state'
+
+
 class Song(models.Model):
     title = models.TextField(blank=True, null=True)
     track_id = models.IntegerField(blank=True, null=True)
@@ -147,9 +219,50 @@ class Song(models.Model):
     date = models.DateField(blank=True, null=True)
     file = models.TextField(blank=True, null=True)
     comment = models.TextField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True)
+    bitrate = models.IntegerField(blank=True, null=True)
+    samplerate = models.IntegerField(blank=True, null=True)
+    channels = models.SmallIntegerField(blank=True, null=True)
+    filesize = models.BigIntegerField(blank=True, null=True)
+    mtime = models.FloatField(blank=True, null=True)
+    digest = models.CharField(max_length=32, blank=True, null=True)
     album = models.ForeignKey(Album, models.DO_NOTHING, blank=True, null=True)
     id = models.BigAutoField(primary_key=True)
 
     class Meta:
         managed = False
         db_table = 'song'
+        constraints = [
+            models.UniqueConstraint(fields=['album', 'file'], name='song_album_file_key'),
+        ]
+
+
+class SongArtist(models.Model):
+    pk = models.CompositePrimaryKey('song', 'artist', 'role')
+    song = models.ForeignKey(Song, models.DO_NOTHING, related_name='artist_links')
+    artist = models.ForeignKey(Artist, models.DO_NOTHING, related_name='song_links')
+    role = models.SmallIntegerField(default=0)
+
+    class Meta:
+        managed = False
+        db_table = 'song_artist'
+
+
+class SongComposer(models.Model):
+    pk = models.CompositePrimaryKey('song', 'composer')
+    song = models.ForeignKey(Song, models.DO_NOTHING, related_name='composer_links')
+    composer = models.ForeignKey(Composer, models.DO_NOTHING, related_name='song_links')
+
+    class Meta:
+        managed = False
+        db_table = 'song_composer'
+
+
+class SongGenre(models.Model):
+    pk = models.CompositePrimaryKey('song', 'genre')
+    song = models.ForeignKey(Song, models.DO_NOTHING, related_name='genre_links')
+    genre = models.ForeignKey(Genre, models.DO_NOTHING, related_name='song_links')
+
+    class Meta:
+        managed = False
+        db_table = 'song_genre'
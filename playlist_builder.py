@@ -0,0 +1,334 @@
+"""
+This module hosts the class PlaylistBuilder.
+PlaylistBuilder turns the songs matching a search into an XSPF or M3U8 playlist. Songs are read from a
+server-side DB cursor and each one is written as soon as it is fetched, so the memory use does not depend
+on the size of the playlist.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import os
+import sys
+from pathlib import PurePosixPath
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from music_db_search import MusicDbSearch  # pylint: disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from search_query import SearchQuery  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+PLAYLIST_FORMATS = ['xspf', 'm3u8']
+DB_FETCH_CHUNK = 2000
+
+SONG_COLUMNS = ['album__path', 'file', 'title', 'artist', 'album__title', 'track_id', 'duration']
+
+
+class XspfWriter:
+    """
+    This class writes an XSPF playlist (https://xspf.org) track by track.
+    """
+
+    def __init__(self, out_stream, title=''):
+        self.out_stream = out_stream
+        self.title = title
+
+    @staticmethod
+    def location(path):
+        """
+        Convert a path to a file URI (or a relative URI if the path is relative).
+        :param path: Path to an audio file
+        :return: A string
+        """
+        uri = quote(path, safe='/')
+
+        return f"file://{uri}" if path.startswith('/') else uri
+
+    def begin(self):
+        """
+        Write the start of the playlist.
+        :return: void
+        """
+        self.out_stream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                              '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n')
+
+        if self.title:
+            self.out_stream.write(f"  <title>{escape(self.title)}</title>\n")
+
+        self.out_stream.write("  <trackList>\n")
+
+    def add(self, path, title=None, artist=None, album=None, track=None, duration=None):
+        """
+        Write a track.
+        :param path: Path to the audio file
+        :param title: Song title
+        :param artist: Artist
+        :param album: Album title
+        :param track: Track number
+        :param duration: Duration in seconds
+        :return: void
+        """
+        elements = [f"<location>{escape(self.location(path))}</location>"]
+
+        if title:
+            elements.append(f"<title>{escape(title)}</title>")
+
+        if artist:
+            elements.append(f"<creator>{escape(artist)}</creator>")
+
+        if album:
+            elements.append(f"<album>{escape(album)}</album>")
+
+        if track and track > 0:
+            elements.append(f"<trackNum>{track}</trackNum>")
+
+        if duration:
+            elements.append(f"<duration>{round(duration * 1000)}</duration>")
+
+        self.out_stream.write(f"    <track>{''.join(elements)}</track>\n")
+
+    def end(self):
+        """
+        Write the end of the playlist.
+        :return: void
+        """
+        self.out_stream.write("  </trackList>\n</playlist>\n")
+
+
+class M3u8Writer:
+    """
+    This class writes an extended M3U playlist, UTF-8 encoded, track by track.
+    """
+
+    def __init__(self, out_stream, title=''):
+        self.out_stream = out_stream
+        self.title = title
+
+    def begin(self):
+        """
+        Write the start of the playlist.
+        :return: void
+        """
+        self.out_stream.write("#EXTM3U\n")
+
+        if self.title:
+            self.out_stream.write(f"#PLAYLIST:{self.title}\n")
+
+    def add(self, path, title=None, artist=None, album=None, track=None,  # pylint: disable=unused-argument
+            duration=None):
+        """
+        Write a track.
+        :param path: Path to the audio file
+        :param title: Song title
+        :param artist: Artist
+        :param album: Album title
+        :param track: Track number
+        :param duration: Duration in seconds
+        :return: void
+        """
+        label = ' - '.join(val.replace('\n', ' ') for val in [artist, title] if val)
+        self.out_stream.write(f"#EXTINF:{round(duration) if duration else -1},{label}\n{path}\n")
+
+    def end(self):
+        """
+        Write the end of the playlist.
+        :return: void
+        """
+
+
+PLAYLIST_WRITERS = {
+    'xspf': XspfWriter,
+    'm3u8': M3u8Writer,
+}
+
+
+class PlaylistBuilder:
+    """
+    This class builds a playlist of the songs matching a query or search texts (see MusicDbSearch).
+    """
+
+    def __init__(self, query=None, find_txt=None, library_root='', max_songs=None, match_all=False,
+                 ignore_case=True):
+        self._library_root = ''
+        self._max_songs = -1
+        self.search = MusicDbSearch(find_txt=find_txt, query=query, match_all=match_all, ignore_case=ignore_case)
+        self.library_root = library_root
+        self.max_songs = max_songs
+        self.songs_written = 0
+
+    @property
+    def library_root(self):
+        """
+        This property holds the directory to which album paths in the DB are relative.
+        """
+        return self._library_root
+
+    @library_root.setter
+    def library_root(self, in_root):
+        self._library_root = os.path.abspath(os.path.expanduser(in_root)) if in_root else ''
+
+    @property
+    def max_songs(self):  # pylint: disable=missing-function-docstring
+        return self._max_songs
+
+    @max_songs.setter
+    def max_songs(self, in_limit):
+        self._max_songs = int(in_limit if in_limit else -1)
+
+    def song_path(self, album_path, file_name):
+        """
+        Get the path of an audio file.
+        :param album_path: Album path as stored in the DB
+        :param file_name: File name as stored in the DB
+        :return: A string: an absolute path if the library root is set, otherwise as stored in the DB
+        """
+        return str(PurePosixPath(self.library_root or '', album_path or '', file_name or ''))
+
+    def song_rows(self):
+        """
+        Read the matching songs, ordered by album and track. Only the columns written to a playlist are
+        fetched, from a server-side cursor.
+        :return: A generator of tuples (see SONG_COLUMNS)
+        """
+        songs = Song.objects.order_by('album__path', 'track_id', 'id')  # NOQA
+
+        if self.search.query:
+            songs = songs.filter(self.search.query.to_q())
+        elif self.search.terms:
+            search_terms = self.search.sql_search_terms()
+
+            if search_terms is None:
+                raise ValueError(f"Search texts cannot run in the DB: {self.search.find_this}")
+
+            songs = songs.filter(self.search.build_filter(search_terms))
+
+        if self.max_songs > 0:
+            songs = songs[:self.max_songs]
+
+        yield from songs.values_list(*SONG_COLUMNS).iterator(chunk_size=DB_FETCH_CHUNK)
+
+    @staticmethod
+    def song_rows_by_id(song_ids):
+        """
+        Read songs chosen elsewhere (e.g. by a smart playlist), in the given order.
+        :param song_ids: A list of song IDs
+        :return: A generator of tuples (see SONG_COLUMNS)
+        """
+        for ix in range(0, len(song_ids), DB_FETCH_CHUNK):
+            chunk_ids = song_ids[ix:ix + DB_FETCH_CHUNK]
+            rows = {row[0]: row[1:] for row in Song.objects.filter(id__in=chunk_ids).values_list(  # NOQA
+                'id', *SONG_COLUMNS)}
+
+            yield from (rows[song_id] for song_id in chunk_ids if song_id in rows)
+
+    def write(self, out_stream, playlist_format='xspf', title='', rows=None):
+        """
+        Write the playlist.
+        :param out_stream: A text stream
+        :param playlist_format: One of PLAYLIST_FORMATS
+        :param title: Playlist title
+        :param rows: Song rows (see SONG_COLUMNS) to write instead of the songs matching the search
+        :return: Number of songs written
+        """
+        start_time = datetime.datetime.now()
+        writer = PLAYLIST_WRITERS[playlist_format](out_stream, title=title)
+        rows = self.song_rows() if rows is None else rows
+        self.songs_written = 0
+        writer.begin()
+
+        for album_path, file_name, song_title, artist, album_title, track_id, duration in rows:
+            if not file_name:
+                continue
+
+            writer.add(self.song_path(album_path, file_name), title=song_title, artist=artist, album=album_title,
+                       track=track_id, duration=duration)
+            self.songs_written += 1
+
+        writer.end()
+        log_it("info", __name__, f"{self.songs_written} songs, runtime={str(datetime.datetime.now() - start_time)}")
+
+        return self.songs_written
+
+
+PROGRAM_DESCRIPTION = "This program builds an XSPF or M3U8 playlist of the songs matching a search."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-q", "--query",
+                        help="A field-scoped query, e.g. 'artist:davis year:1955..1960 -live'.",
+                        type=str,
+                        dest='query',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-f", "--find",
+                        help="A string to search for in the song and album text columns, repeat for several "
+                             "(used if -q is not given).",
+                        type=str,
+                        dest='search_str',
+                        action='append',
+                        default=[],
+                        required=False)
+
+    parser.add_argument("-a", "--all",
+                        help="If provided, all the search strings must be found.",
+                        action='store_true',
+                        dest='match_all',
+                        required=False)
+
+    parser.add_argument("-r", "--root",
+                        help="The library root: the directory containing the album directories. "
+                             "If not provided, paths are written as stored in the DB.",
+                        type=str,
+                        dest='library_root',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-t", "--format",
+                        help="Playlist format, default: xspf",
+                        type=str,
+                        dest='playlist_format',
+                        choices=PLAYLIST_FORMATS,
+                        default='xspf',
+                        required=False)
+
+    parser.add_argument("-o", "--output",
+                        help="Path to the playlist file, stdout if not provided.",
+                        type=str,
+                        dest='out_path',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-l", "--limit",
+                        help="If provided, determines the max number of songs in the playlist.",
+                        type=int,
+                        dest='limit',
+                        default=-1,
+                        required=False)
+
+    parser.add_argument("-n", "--title",
+                        help="Playlist title.",
+                        type=str,
+                        dest='title',
+                        default='',
+                        required=False)
+
+    args = parser.parse_args()
+
+    if not args.query and not any(args.search_str):
+        parser.error("Provide a query (-q) or search strings (-f)")
+
+    builder = PlaylistBuilder(query=SearchQuery(args.query) if args.query else None, find_txt=args.search_str,
+                              library_root=args.library_root, max_songs=args.limit, match_all=args.match_all)
+
+    if args.out_path:
+        with open(args.out_path, 'w', encoding="UTF-8") as out:
+            builder.write(out, playlist_format=args.playlist_format, title=args.title)
+    else:
+        builder.write(sys.stdout, playlist_format=args.playlist_format, title=args.title)
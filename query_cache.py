@@ -0,0 +1,250 @@
+"""
+This module hosts the class QueryCache.
+A QueryCache keeps the results of recent searches, keyed by the normalised query, and evicts the least
+recently used ones beyond a size bound. Results are invalidated by the library generation, a counter in
+the library_state table which the ingest writer bumps whenever an album changes: entries computed for an
+older generation are never returned.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from django.db import connection
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from music_db_search import MusicDbSearch  # pylint: disable=import-error
+from search_query import SearchQuery  # pylint: disable=import-error
+
+LIBRARY_STATE_ID = 1
+DEFAULT_MAX_ENTRIES = 1000
+
+GENERATION_SQL = "SELECT generation FROM library_state WHERE id = %s"
+BUMP_GENERATION_SQL = "UPDATE library_state SET generation = generation + 1, updated = CURRENT_TIMESTAMP " \
+                      "WHERE id = %s RETURNING generation"
+
+
+def library_generation():
+    """
+    Read the library generation.
+    :return: The generation as an int, 0 if the library state row is missing
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(GENERATION_SQL, [LIBRARY_STATE_ID])
+        row = cursor.fetchone()
+
+    return row[0] if row else 0
+
+
+def bump_library_generation():
+    """
+    Increment the library generation, called by the ingest writer after an album has been written.
+    :return: The new generation as an int
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(BUMP_GENERATION_SQL, [LIBRARY_STATE_ID])
+        row = cursor.fetchone()
+
+    return row[0] if row else 0
+
+
+def normalise_query(query):
+    """
+    Normalise a query so that equivalent ones share a cache key: a SearchQuery by its canonical form, which
+    folds case and diacritics as the search does; search strings, whose case may matter (see ignore_case),
+    by spacing only.
+    :param query: A SearchQuery, a string or a list of strings
+    :return: A string or a tuple of strings
+    """
+    if isinstance(query, SearchQuery):
+        return query.canonical()
+
+    if isinstance(query, str):
+        return re.sub(r'\s+', ' ', query.strip())
+
+    return tuple(sorted({normalise_query(term) for term in query or [] if term}))
+
+
+class QueryCache:
+    """
+    This class encapsulates an LRU cache of search results, invalidated by the library generation.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, generation_source=library_generation):
+        self.max_entries = max(1, max_entries)
+        self.generation_source = generation_source
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(kind, query, **options):
+        """
+        Create a cache key.
+        :param kind: What is searched, e.g. 'db', 'index' or 'fts'
+        :param query: The query (see normalise_query())
+        :param options: Search options which change the results, e.g. match_all=True
+        :return: A hashable key
+        """
+        return kind, normalise_query(query), tuple(sorted((name, str(val)) for name, val in options.items()))
+
+    def sync_generation(self, generation=None):
+        """
+        Drop every entry if the library has changed since the entries were computed.
+        :param generation: The current generation if the caller has read it, otherwise it is read now
+        :return: The current generation
+        """
+        generation = self.generation_source() if generation is None else generation
+
+        with self._lock:
+            if generation != self._generation:
+                if self._entries:
+                    self.invalidations += 1
+
+                self._entries.clear()
+                self._generation = generation
+
+        return generation
+
+    def get(self, key, generation=None):
+        """
+        Look up a cached result.
+        :param key: Cache key (see make_key())
+        :param generation: The current library generation, read if not given
+        :return: A tuple (found, result)
+        """
+        self.sync_generation(generation)
+
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return True, self._entries[key]
+
+    def put(self, key, result, generation=None):
+        """
+        Cache a result.
+        :param key: Cache key (see make_key())
+        :param result: The result to cache, it must not be modified afterwards
+        :param generation: The library generation the result was computed for, read if not given
+        :return: void
+        """
+        generation = self.generation_source() if generation is None else generation
+
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        Return a cached result or compute and cache it.
+        :param key: Cache key (see make_key())
+        :param compute: A function without arguments which returns the result
+        :return: The result
+        """
+        generation = self.sync_generation()
+        found, result = self.get(key, generation)
+
+        if found:
+            return result
+
+        result = compute()
+        self.put(key, result, generation)
+
+        return result
+
+    def collect_tags(self, search):
+        """
+        Run collect_tags() of a MusicDbSearch or MusicIndexSearch through the cache. Filesystem searches are
+        not cached, as the library generation does not follow changes to audio files.
+        :param search: A search instance
+        :return: void
+        """
+        if not isinstance(search, MusicDbSearch):
+            search.collect_tags()
+            return
+
+        key = self.make_key(type(search).__name__, search.query or search.terms, use_regex=search.rx_search,
+                            ignore_case=search.ignore_case, match_all=search.match_all, limit=search.max_albums)
+        on_match = search.on_match
+        generation = self.sync_generation()
+        found, albums = self.get(key, generation)
+
+        if found:
+            for dir_name, dir_tags in albums:
+                search.save_album_tags(dir_name, dir_tags)
+
+            return
+
+        albums = []
+
+        def record_album(dir_name, dir_tags):
+            albums.append((dir_name, dir_tags))
+
+            if on_match:
+                on_match(dir_name, dir_tags)
+            else:
+                search.tags[dir_name] = dir_tags
+
+        search.on_match = record_album
+
+        try:
+            search.collect_tags()
+        finally:
+            search.on_match = on_match
+
+        self.put(key, albums, generation)
+
+    def stats(self):
+        """
+        Get the cache statistics.
+        :return: A dictionary
+        """
+        lookups = self.hits + self.misses
+
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'generation': self._generation,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+PROGRAM_DESCRIPTION = "This program shows or bumps the library generation which invalidates cached search results."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-b", "--bump",
+                        help="If provided, increment the generation, e.g. after changing tables by hand.",
+                        action='store_true',
+                        dest='bump',
+                        required=False)
+
+    args = parser.parse_args()
+
+    print(json.dumps({'generation': bump_library_generation() if args.bump else library_generation()}))
@@ -0,0 +1,232 @@
+"""
+This module is the thin client of the music search service (search_server.py).
+It uses the standard library only, so it starts in milliseconds and needs no virtual environment.
+It takes the options of music_meta_search.py and writes the results the same way: to ~/temp/temp.json,
+or as NDJSON to stdout or a file with -o.
+Exit status: 0 on success, 1 if the search failed, 2 if the server is not running.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+
+# Same as search_server.DEFAULT_SOCKET_PATH, not imported as search_server needs Django:
+DEFAULT_SOCKET_PATH = os.path.join(str(Path.home()), 'temp', 'music_search.sock')
+RESULTS_DIR = os.path.join(str(Path.home()), 'temp')
+RESULTS_FILE = 'temp.json'
+
+EXIT_FAILED = 1
+EXIT_NO_SERVER = 2
+
+
+def send_request(socket_path, request):
+    """
+    Send a request to the search server and read the answer line by line.
+    :param socket_path: Path to the server's Unix socket
+    :param request: A dictionary
+    :return: A generator of dictionaries, one per line of the answer
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(request) + '\n').encode('UTF-8'))
+
+        with conn.makefile('rb') as answer:
+            for line in answer:
+                yield json.loads(line)
+
+
+def build_request(in_args):
+    """
+    Build the request to the search server from the command line arguments.
+    :param in_args: Parsed arguments
+    :return: A dictionary
+    """
+    # A fuzzy lookup takes one text, a search a list of strings:
+    find = ' '.join(in_args.search_str) if in_args.op == 'fuzzy' else [term for term in in_args.search_str if term]
+
+    return {
+        'op': in_args.op,
+        'source': in_args.source,
+        'base_dir': os.path.abspath(in_args.base_dir) if in_args.base_dir else '',
+        'find': find,
+        'query': in_args.query,
+        'limit': in_args.limit,
+        'use_rx': in_args.use_rx,
+        'match_all': in_args.match_all,
+        'ignore_case': in_args.ignore_case,
+        'workers': in_args.workers,
+    }
+
+
+def exchange(socket_path, request, out_ndjson=None):
+    """
+    Send a request and collect the answer: matching albums are kept, or written as NDJSON as they arrive.
+    :param socket_path: Path to the server's Unix socket
+    :param request: A dictionary (see build_request())
+    :param out_ndjson: Stream to write the albums to as NDJSON, None to keep them
+    :return: A tuple (dictionary: directory -> tags, summary dictionary or None if the server closed the
+             connection without one)
+    """
+    found_tags = {}
+
+    try:
+        for record in send_request(socket_path, request):
+            if 'done' in record:
+                return found_tags, record
+
+            if out_ndjson:
+                out_ndjson.write(json.dumps(record, sort_keys=True, ensure_ascii=False) + '\n')
+                out_ndjson.flush()
+            else:
+                found_tags[record['directory']] = record['tags']
+
+    except ConnectionResetError:
+        pass
+
+    return found_tags, None
+
+
+PROGRAM_DESCRIPTION = "This program sends a search to the music search service (search_server.py)."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-d", "--directory",
+                        help="Full path to the parent directory containing sub-directories with music files "
+                             "(source fs).",
+                        type=str,
+                        dest='base_dir',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-l", "--limit",
+                        help="If provided, determines the max number of albums to find.",
+                        type=int,
+                        dest='limit',
+                        default=-1,
+                        required=False)
+
+    parser.add_argument("-f", "--find",
+                        help="The string to search for in metadata, repeat for several (see -a).",
+                        type=str,
+                        dest='search_str',
+                        action='append',
+                        default=[],
+                        required=False)
+
+    parser.add_argument("-q", "--query",
+                        help="A field-scoped query, used instead of -f, e.g. 'artist:davis year:1955..1960 -live'.",
+                        type=str,
+                        dest='query',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-a", "--all",
+                        help="If the value evaluates to True, all the search strings must be found.",
+                        type=str,
+                        dest='match_all',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-x", "--rx",
+                        help="If the value evaluates to True, the search strings are regex patterns.",
+                        type=str,
+                        dest='use_rx',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-i", "--ignore_case",
+                        help="If the value evaluates to True, the search is case-insensitive.",
+                        type=str,
+                        dest='ignore_case',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-s", "--source",
+                        help="Where to search: fs (audio files, default), db (album and song tables) or index.",
+                        type=str,
+                        dest='source',
+                        choices=['fs', 'db', 'index'],
+                        default='fs',
+                        required=False)
+
+    parser.add_argument("-w", "--workers",
+                        help="Number of worker threads searching album directories in parallel (source fs).",
+                        type=int,
+                        dest='workers',
+                        default=1,
+                        required=False)
+
+    parser.add_argument("-o", "--ndjson",
+                        help="If provided, each matching album is written as one line of JSON as soon as it "
+                             f"arrives, to this file or to stdout if the value is '-', instead of "
+                             f"{os.path.join(RESULTS_DIR, RESULTS_FILE)}.",
+                        type=str,
+                        dest='ndjson',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-p", "--op",
+                        help="Operation: search (default), fuzzy (typo-tolerant lookup of the -f text), stats or ping.",
+                        type=str,
+                        dest='op',
+                        choices=['search', 'fuzzy', 'stats', 'ping'],
+                        default='search',
+                        required=False)
+
+    parser.add_argument("-u", "--socket",
+                        help=f"Path to the server's Unix socket, default: {DEFAULT_SOCKET_PATH}",
+                        type=str,
+                        dest='socket_path',
+                        default=DEFAULT_SOCKET_PATH,
+                        required=False)
+
+    args = parser.parse_args()
+
+    if not args.ndjson:
+        out_ndjson = None
+    elif args.ndjson == '-':
+        out_ndjson = sys.stdout
+    else:
+        out_ndjson = open(args.ndjson, 'w', encoding="UTF-8")  # pylint: disable=consider-using-with
+
+    try:
+        found_tags, summary = exchange(args.socket_path, build_request(args), out_ndjson)
+
+    except (FileNotFoundError, ConnectionRefusedError) as conn_err:
+        print(f"Search server not running on {args.socket_path}: {conn_err}", file=sys.stderr)
+        sys.exit(EXIT_NO_SERVER)
+
+    finally:
+        if out_ndjson and out_ndjson is not sys.stdout:
+            out_ndjson.close()
+
+    if summary is None:
+        print(f"Search server on {args.socket_path} closed the connection before the search was done",
+              file=sys.stderr)
+        sys.exit(EXIT_FAILED)
+
+    if summary.get('error'):
+        print(f"Search failed: {summary['error']}", file=sys.stderr)
+        sys.exit(EXIT_FAILED)
+
+    if args.op != 'search':
+        print(json.dumps(summary, indent=4, sort_keys=True, ensure_ascii=False))
+        sys.exit(0)
+
+    if found_tags:
+        out_dir = RESULTS_DIR if os.path.isdir(RESULTS_DIR) else os.getcwd()
+        print(f"Writing results to {os.path.join(out_dir, RESULTS_FILE)}")
+
+        with open(os.path.join(out_dir, RESULTS_FILE), 'w', encoding="UTF-8") as out:
+            out.write(json.dumps(found_tags, indent=4, sort_keys=True, ensure_ascii=False))
+
+    print(f"Search found {summary.get('albums', 0)} albums in {summary.get('ms', 0)} ms", file=sys.stderr)
+    sys.exit(0)
@@ -0,0 +1,404 @@
+"""
+This module hosts the class SearchQuery.
+A SearchQuery parses a field-scoped query once, e.g.
+    artist:"Miles Davis" year:1955..1960 genre:jazz -live
+and compiles it into a filter for each search backend: a Q object (SQL WHERE clause) for the DB,
+a plan of posting list operations for the tag index and a predicate for tag dictionaries read from files.
+
+Syntax:
+    word, "a phrase"        text found in any of the text fields (see TEXT_FIELDS)
+    field:word, field:"a phrase"
+    year:1955, year:1955..1960, year:..1960, track:1..3
+    -clause                 negation
+    clause clause           both must match (AND is optional)
+    clause OR clause        either must match, binds looser than AND
+    ( ... )                 grouping
+Text matching finds substrings and ignores case and diacritics on every backend; the tag index narrows a
+query down to the songs with words containing the text, which the DB then checks.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import json
+import re
+from collections import namedtuple
+
+from django.db.models import CharField, Lookup, Q, TextField
+from db_vendor import FOLD_FUNCTION  # pylint: disable=import-error
+from utils import fold_text  # pylint: disable=import-error
+
+# Query field: (key in tag dictionaries, Song field, tag index field or None if not indexed)
+QUERY_FIELDS = {
+    'title': ('title', 'title', 'title'),
+    'artist': ('artist', 'artist', 'artist'),
+    'albumartist': ('albumartist', 'performer', 'performer'),
+    'performer': ('albumartist', 'performer', 'performer'),
+    'composer': ('composer', 'composer', 'composer'),
+    'genre': ('genre', 'genre', 'genre'),
+    'comment': ('comment', 'comment', 'comment'),
+    'album': ('album', 'album__title', 'album'),
+    'label': ('label', 'album__label', 'label'),
+    'year': ('year', 'date__year', None),
+    'track': ('track', 'track_id', None),
+    'file': ('file', 'file', None),
+    'dir': ('directory', 'album__path', None),
+}
+
+NUMERIC_FIELDS = ['year', 'track']
+
+# Fields searched by terms without a field:
+TEXT_FIELDS = ['title', 'artist', 'albumartist', 'composer', 'genre', 'comment', 'album', 'label']
+ALBUM_TEXT_FIELDS = ['album__artist', 'album__comment']
+
+RANGE_SEPARATOR = '..'
+
+TOKEN_RX = re.compile(r'\s*(?:(?P<paren>[()])|(?P<neg>-)(?=[^\s-])|'
+                      r'(?:(?P<field>\w+):)?(?:"(?P<phrase>[^"]*)"?|(?P<word>[^\s()"]+)))')
+LEADING_INT_RX = re.compile(r'\s*(\d+)')
+
+Term = namedtuple('Term', ['field', 'value'])
+Range = namedtuple('Range', ['field', 'low', 'high'])
+Not = namedtuple('Not', ['child'])
+And = namedtuple('And', ['children'])
+Or = namedtuple('Or', ['children'])
+
+
+class FoldContains(Lookup):
+    """
+    Substring lookup ignoring case and diacritics, e.g. Song.objects.filter(artist__foldcontains='zimerman'):
+    the column is folded in SQL (see db_vendor.FOLD_FUNCTION) and the value by utils.fold_text().
+    """
+    lookup_name = 'foldcontains'
+    prepare_rhs = False
+
+    def get_db_prep_lookup(self, value, connection):
+        return '%s', [f"%{connection.ops.prep_for_like_query(fold_text(value))}%"]
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+
+        return f"{FOLD_FUNCTION}({lhs}) LIKE {rhs} ESCAPE '\\'", [*lhs_params, *rhs_params]
+
+
+TextField.register_lookup(FoldContains)
+CharField.register_lookup(FoldContains)
+
+
+class QuerySyntaxError(ValueError):
+    """
+    Raised for a query which cannot be parsed.
+    """
+
+
+def leading_int(in_value):
+    """
+    Get the number a tag value starts with, e.g. 1957 from "1957-03-02" or 3 from "3/12".
+    :param in_value: Tag value
+    :return: An int or None
+    """
+    if isinstance(in_value, int):
+        return in_value
+
+    found = LEADING_INT_RX.match(str(in_value)) if in_value is not None else None
+
+    return int(found.group(1)) if found else None
+
+
+class SearchQuery:
+    """
+    This class encapsulates a parsed query and its compiled forms.
+    """
+
+    def __init__(self, query_text):
+        self.text = query_text
+        self.tree = self.parse(query_text)
+
+    def __repr__(self):
+        return f"SearchQuery({self.text!r})"
+
+    @staticmethod
+    def tokenize(in_text):
+        """
+        Split query text into tokens.
+        :param in_text: Query text
+        :return: A list of tuples (kind, field, value), kind is one of '(', ')', '-', 'OR', 'AND', 'term'
+        """
+        tokens = []
+        pos = 0
+        in_text = in_text.strip()
+
+        while pos < len(in_text):
+            found = TOKEN_RX.match(in_text, pos)
+
+            if not found or found.end() == pos:
+                raise QuerySyntaxError(f"Unexpected character at {pos} in: {in_text}")
+
+            pos = found.end()
+
+            if found.group('paren'):
+                tokens.append((found.group('paren'), None, None))
+                continue
+
+            if found.group('neg'):
+                tokens.append(('-', None, None))
+                continue
+
+            field = (found.group('field') or '').lower()
+            value = found.group('phrase') if found.group('phrase') is not None else found.group('word')
+
+            if field and field not in QUERY_FIELDS:
+                value = f"{found.group('field')}:{value}"
+                field = None
+
+            if not field and found.group('word') in ('OR', 'AND'):
+                tokens.append((value, None, None))
+                continue
+
+            tokens.append(('term', field or None, value))
+
+        return tokens
+
+    def parse(self, in_text):
+        """
+        Parse query text into a tree of Term, Range, Not, And and Or nodes.
+        :param in_text: Query text
+        :return: The root node or None for an empty query
+        """
+        tokens = self.tokenize(in_text or '')
+
+        if not tokens:
+            return None
+
+        node, pos = self.parse_or(tokens, 0)
+
+        if pos < len(tokens):
+            raise QuerySyntaxError(f"Unexpected '{tokens[pos][2] or tokens[pos][0]}' in: {in_text}")
+
+        return node
+
+    def parse_or(self, tokens, pos):  # pylint: disable=missing-function-docstring
+        children = []
+
+        while True:
+            node, pos = self.parse_and(tokens, pos)
+            children.append(node)
+
+            if pos < len(tokens) and tokens[pos][0] == 'OR':
+                pos += 1
+                continue
+
+            return (children[0] if len(children) == 1 else Or(tuple(children))), pos
+
+    def parse_and(self, tokens, pos):  # pylint: disable=missing-function-docstring
+        children = []
+
+        while pos < len(tokens) and tokens[pos][0] not in (')', 'OR'):
+            if tokens[pos][0] == 'AND':
+                pos += 1
+                continue
+
+            node, pos = self.parse_unary(tokens, pos)
+            children.append(node)
+
+        if not children:
+            raise QuerySyntaxError(f"Empty expression in: {self.text}")
+
+        return (children[0] if len(children) == 1 else And(tuple(children))), pos
+
+    def parse_unary(self, tokens, pos):  # pylint: disable=missing-function-docstring
+        kind, field, value = tokens[pos]
+
+        if kind == '-':
+            if pos + 1 == len(tokens):
+                raise QuerySyntaxError(f"Nothing to negate in: {self.text}")
+
+            node, pos = self.parse_unary(tokens, pos + 1)
+            return Not(node), pos
+
+        if kind == '(':
+            node, pos = self.parse_or(tokens, pos + 1)
+
+            if pos == len(tokens) or tokens[pos][0] != ')':
+                raise QuerySyntaxError(f"Missing ')' in: {self.text}")
+
+            return node, pos + 1
+
+        if kind != 'term':
+            raise QuerySyntaxError(f"Unexpected '{kind}' in: {self.text}")
+
+        return self.make_term(field, value), pos + 1
+
+    @staticmethod
+    def make_term(field, value):
+        """
+        Create the node for a field and value.
+        :return: A Range node for numeric fields, otherwise a Term node
+        """
+        if field not in NUMERIC_FIELDS:
+            return Term(field, value)
+
+        low, sep, high = value.partition(RANGE_SEPARATOR)
+
+        try:
+            low = int(low) if low else None
+            high = (int(high) if high else None) if sep else low
+        except ValueError as err:
+            raise QuerySyntaxError(f"{field} takes a number or a range (from..to), not: {value}") from err
+
+        return Range(field, low, high)
+
+    def canonical(self, node=None):
+        """
+        Get a normalised form of the query, the same for queries which differ only in spacing, case,
+        diacritics or the order of clauses, e.g. to use as a cache key. Terms are folded by utils.fold_text(),
+        as by to_q() (see FoldContains) and matches(), so queries with the same form have the same results.
+        :param node: Node to convert, the root if not given
+        :return: A string
+        """
+        node = self.tree if node is None else node
+
+        if node is None:
+            return ''
+
+        if isinstance(node, Term):
+            value = json.dumps(fold_text(node.value), ensure_ascii=False)
+            return f"{node.field}:{value}" if node.field else value
+
+        if isinstance(node, Range):
+            low = '' if node.low is None else node.low
+            high = '' if node.high is None else node.high
+            return f"{node.field}:{low}{RANGE_SEPARATOR}{high}"
+
+        if isinstance(node, Not):
+            return f"-{self.canonical(node.child)}"
+
+        children = sorted(set(self.canonical(child) for child in node.children))
+        return f"({(' ' if isinstance(node, And) else ' OR ').join(children)})"
+
+    def to_q(self, node=None):
+        """
+        Compile the query into a filter for Song querysets.
+        :param node: Node to compile, the root if not given
+        :return: A Q object
+        """
+        node = self.tree if node is None else node
+
+        if node is None:
+            return Q()
+
+        if isinstance(node, Term):
+            fields = [QUERY_FIELDS[node.field][1]] if node.field else \
+                [QUERY_FIELDS[field][1] for field in TEXT_FIELDS] + ALBUM_TEXT_FIELDS
+            term_q = Q()
+
+            for field in fields:
+                term_q |= Q(**{f"{field}__foldcontains": node.value})
+
+            return term_q
+
+        if isinstance(node, Range):
+            db_field = QUERY_FIELDS[node.field][1]
+            range_q = Q(**{f"{db_field}__isnull": False})
+
+            if node.low is not None:
+                range_q &= Q(**{f"{db_field}__gte": node.low})
+
+            if node.high is not None:
+                range_q &= Q(**{f"{db_field}__lte": node.high})
+
+            return range_q
+
+        if isinstance(node, Not):
+            return ~self.to_q(node.child)
+
+        out_q = Q()
+
+        for child in node.children:
+            out_q = (out_q & self.to_q(child)) if isinstance(node, And) else (out_q | self.to_q(child))
+
+        return out_q
+
+    def index_plan(self, index, node=None):
+        """
+        Run the parts of the query the tag index can answer.
+        :param index: A MusicIndex instance
+        :param node: Node to plan, the root if not given
+        :return: A sorted list of candidate song IDs (a superset of the matches) or None if the index
+        cannot narrow the search, i.e. every song is a candidate
+        """
+        node = self.tree if node is None else node
+
+        if isinstance(node, Term):
+            # Terms without a field also match album comments, which are not indexed:
+            index_field = QUERY_FIELDS[node.field][2] if node.field else None
+
+            if index_field is None:
+                return None
+
+            # The DB matches substrings, not whole words:
+            return index.substring_postings(node.value, index_field)
+
+        if isinstance(node, And):
+            result = None
+
+            for child_ids in (self.index_plan(index, child) for child in node.children):
+                if child_ids is None:
+                    continue
+
+                result = child_ids if result is None else sorted(set(result).intersection(child_ids))
+
+                if not result:
+                    return []
+
+            return result
+
+        if isinstance(node, Or):
+            ids = set()
+
+            for child in node.children:
+                child_ids = self.index_plan(index, child)
+
+                if child_ids is None:
+                    return None
+
+                ids.update(child_ids)
+
+            return sorted(ids)
+
+        # Ranges are not indexed and a negation cannot narrow the search:
+        return None
+
+    def matches(self, in_tag_dict, node=None):
+        """
+        Test a tag dictionary (as read from an audio file) against the query.
+        :param in_tag_dict: A dictionary of tags
+        :param node: Node to test, the root if not given
+        :return: True if the tags match, otherwise False
+        """
+        node = self.tree if node is None else node
+
+        if node is None:
+            return False
+
+        if isinstance(node, Term):
+            keys = [QUERY_FIELDS[node.field][0]] if node.field else TEXT_FIELDS
+            needle = fold_text(node.value)
+
+            return any(needle in fold_text(str(in_tag_dict[key])) for key in keys if in_tag_dict.get(key) is not None)
+
+        if isinstance(node, Range):
+            value = leading_int(in_tag_dict.get(QUERY_FIELDS[node.field][0]))
+
+            return value is not None and (node.low is None or value >= node.low) and \
+                (node.high is None or value <= node.high)
+
+        if isinstance(node, Not):
+            return not self.matches(in_tag_dict, node.child)
+
+        found = (self.matches(in_tag_dict, child) for child in node.children)
+
+        return all(found) if isinstance(node, And) else any(found)
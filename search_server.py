@@ -0,0 +1,276 @@
+"""
+This module hosts the class SearchServer.
+SearchServer is a resident search service on a local Unix socket. It keeps Django, the DB connections,
+the tag index, the fuzzy search index and the query cache warm, so that a query costs a socket round trip
+instead of interpreter and Django start-up (see search_client.py).
+
+Protocol: the client sends one line of JSON, e.g.
+    {"op": "search", "source": "index", "query": "artist:davis year:1955..1960", "limit": 10}
+and the server answers with lines of JSON: one per matching album ({"directory": ..., "tags": [...]}),
+as soon as it is found, and a last one with "done" (or "error") and a summary.
+Operations: search (default), fuzzy, stats, ping.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import datetime
+import json
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.db import close_old_connections, connections, DatabaseError, DEFAULT_DB_ALIAS
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from fuzzy_search import DEFAULT_BUDGET_MS, DEFAULT_LIMIT, FuzzySearch  # pylint: disable=import-error
+from music_index import DEFAULT_INDEX_PATH, MusicIndex  # pylint: disable=import-error
+from music_meta_search import create_search  # pylint: disable=import-error
+from query_cache import DEFAULT_MAX_ENTRIES, QueryCache  # pylint: disable=import-error
+from search_query import QuerySyntaxError, SearchQuery  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+# search_client.py has its own copy, it must not import Django:
+DEFAULT_SOCKET_PATH = os.path.join(str(Path.home()), 'temp', 'music_search.sock')
+DEFAULT_WORKERS = 4
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class SearchRequestHandler(socketserver.StreamRequestHandler):
+    """
+    This class handles one client connection: a request line in, JSON lines out.
+    """
+
+    def send(self, record):
+        """
+        Write a JSON line to the client.
+        :param record: A dictionary
+        :return: void
+        """
+        self.wfile.write((json.dumps(record, sort_keys=True, ensure_ascii=False, default=str) + '\n').encode('UTF-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        start = time.perf_counter()
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+
+        try:
+            request = json.loads(line or b'{}')
+
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object")
+
+            summary = self.server.run(request, self.send)
+            self.send({'done': True, 'ms': round((time.perf_counter() - start) * 1000, 2), **summary})
+
+        except (BrokenPipeError, ConnectionResetError):
+            log_it("info", __name__, "Client went away")
+
+        except (QuerySyntaxError, DatabaseError, OSError, ValueError, TypeError) as ex:
+            log_it("error", __name__, repr(ex))
+            self.send({'done': True, 'error': str(ex)})
+
+
+class SearchServer(socketserver.UnixStreamServer):
+    """
+    This class encapsulates the search service. Requests are handled by a fixed pool of threads,
+    each of which keeps its own DB connection open between requests.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, index_path=DEFAULT_INDEX_PATH, workers=DEFAULT_WORKERS,
+                 cache_size=DEFAULT_MAX_ENTRIES, conn_max_age=None):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+        super().__init__(socket_path, SearchRequestHandler)
+        os.chmod(socket_path, 0o600)
+        # Django closes a connection after each request unless it may be kept (CONN_MAX_AGE, Django's default is 0),
+        # so that the connections of the pool threads stay open for conn_max_age seconds, or for good if None:
+        connections[DEFAULT_DB_ALIAS].settings_dict['CONN_MAX_AGE'] = conn_max_age
+        self.socket_path = socket_path
+        self.index_path = index_path
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cache = QueryCache(max_entries=cache_size)
+        self.started = datetime.datetime.now()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._fuzzy_lock = threading.Lock()
+        self._index = None
+        self._index_mtime = None
+        self._fuzzy = None
+        self._fuzzy_generation = None
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """
+        Handle a connection in a pool thread (see socketserver.ThreadingMixIn). The DB connection of the thread
+        is re-used, unless it is broken or older than conn_max_age.
+        """
+        close_old_connections()
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    @property
+    def index(self):
+        """
+        This property holds the tag index, re-loaded when the index file has been rewritten.
+        """
+        mtime = os.path.getmtime(self.index_path) if os.path.isfile(self.index_path) else None
+
+        with self._lock:
+            if self._index is None or mtime != self._index_mtime:
+                # Requests still using the previous index keep it mapped until they are done:
+                self._index = MusicIndex(self.index_path)
+                self._index_mtime = mtime
+                log_it("info", __name__, f"Loaded index {self.index_path}")
+
+            return self._index
+
+    def fuzzy(self, generation):
+        """
+        Get the fuzzy search index, rebuilt from the DB when the library generation has changed.
+        :param generation: The current library generation
+        :return: A FuzzySearch instance
+        """
+        with self._fuzzy_lock:
+            if self._fuzzy is None or generation != self._fuzzy_generation:
+                self._fuzzy = FuzzySearch.build_from_db()
+                self._fuzzy_generation = generation
+                log_it("info", __name__, f"Built the fuzzy index, {self._fuzzy.size} values")
+
+            return self._fuzzy
+
+    def stats(self):
+        """
+        Get the server statistics.
+        :return: A dictionary
+        """
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'requests': self.requests,
+            'cache': self.cache.stats(),
+            'index': self.index_path if self._index else None,
+            'fuzzy_values': self._fuzzy.size if self._fuzzy else None,
+        }
+
+    def run(self, request, send):
+        """
+        Run a request.
+        :param request: A dictionary (see the module docstring)
+        :param send: A function writing a dictionary to the client
+        :return: A dictionary summarising the result, sent to the client as the last line
+        """
+        with self._lock:
+            self.requests += 1
+
+        op = request.get('op', 'search')
+
+        if op == 'ping':
+            return {'pong': True}
+
+        if op == 'stats':
+            return self.stats()
+
+        if op == 'fuzzy':
+            generation = self.cache.sync_generation()
+            return self.fuzzy(generation).search(
+                request.get('find', ''), fields=request.get('fields'), limit=int(request.get('limit', DEFAULT_LIMIT)),
+                max_distance=request.get('edits'), budget_ms=int(request.get('budget_ms', DEFAULT_BUDGET_MS)))
+
+        if op != 'search':
+            raise ValueError(f"Unknown op: {op}")
+
+        source = request.get('source', 'fs')
+        query = SearchQuery(request['query']) if request.get('query') else None
+        search = create_search(
+            source=source,
+            base_dir=request.get('base_dir'),
+            find_txt=request.get('find') or [],
+            query=query,
+            max_albums=request.get('limit', -1),
+            use_regex=request.get('use_rx', False),
+            ignore_case=request.get('ignore_case', False),
+            match_all=request.get('match_all', False),
+            workers=request.get('workers', 1),
+            index=self.index if source == 'index' else None,
+            on_match=lambda dir_name, dir_tags: send({'directory': dir_name, 'tags': dir_tags}))
+
+        if source == 'fs' and not (request.get('base_dir') and os.path.isdir(request['base_dir'])):
+            raise ValueError(f"Not a directory: {request.get('base_dir')}")
+
+        self.cache.collect_tags(search)
+
+        return {'albums': len(search.albums_seen)}
+
+
+PROGRAM_DESCRIPTION = "This program runs the resident music search service (see search_client.py)."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-u", "--socket",
+                        help=f"Path to the Unix socket, default: {DEFAULT_SOCKET_PATH}",
+                        type=str,
+                        dest='socket_path',
+                        default=DEFAULT_SOCKET_PATH,
+                        required=False)
+
+    parser.add_argument("-n", "--index",
+                        help=f"Path to the tag index file, default: {DEFAULT_INDEX_PATH}",
+                        type=str,
+                        dest='index_path',
+                        default=DEFAULT_INDEX_PATH,
+                        required=False)
+
+    parser.add_argument("-w", "--workers",
+                        help="Number of requests handled at the same time.",
+                        type=int,
+                        dest='workers',
+                        default=DEFAULT_WORKERS,
+                        required=False)
+
+    parser.add_argument("-c", "--cache_size",
+                        help="Max number of search results kept in the query cache.",
+                        type=int,
+                        dest='cache_size',
+                        default=DEFAULT_MAX_ENTRIES,
+                        required=False)
+
+    parser.add_argument("-m", "--conn_max_age",
+                        help="Seconds each worker keeps its DB connection open, default: until the server stops.",
+                        type=int,
+                        dest='conn_max_age',
+                        default=None,
+                        required=False)
+
+    args = parser.parse_args()
+
+    server = SearchServer(socket_path=args.socket_path, index_path=args.index_path, workers=args.workers,
+                          cache_size=args.cache_size, conn_max_age=args.conn_max_age)
+    log_it("info", __name__, f"Listening on {args.socket_path}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -8,24 +8,67 @@ from utils import read_file  # pylint: disable=import-error
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-HOST_ADDRESS = f'{read_file(".host_address", os.getcwd())}'
+# Backend: 'postgresql' (default) or 'sqlite' for a single-node deployment without a DB server
+MUSIC_DB = os.environ.get('MUSIC_DB', 'postgresql')
 
-ALLOWED_HOSTS = [HOST_ADDRESS]
+if MUSIC_DB == 'sqlite':
+    HOST_ADDRESS = ''
 
-# PostgreSQL
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': 'music',
-        'USER': 'postgres',
-        'PASSWORD': 'postgres',  # 'bromberg58'
-        'HOST': HOST_ADDRESS,  # '127.0.0.1'
-        'PORT': '5432',
+    # WAL lets searches read while the ingest writes; writes take the lock up front (IMMEDIATE) so that
+    # concurrent writers wait for it (timeout, in seconds) instead of failing on a lock upgrade.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.expanduser(os.environ.get('MUSIC_SQLITE_PATH', '~/temp/music.sqlite3')),
+            'OPTIONS': {
+                'init_command': "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA mmap_size=268435456; "
+                                "PRAGMA cache_size=-65536; PRAGMA temp_store=MEMORY",
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
     }
-}
+else:
+    HOST_ADDRESS = f'{read_file(".host_address", os.getcwd())}'
+
+    # PostgreSQL
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': 'music',
+            'USER': 'postgres',
+            'PASSWORD': 'postgres',  # 'bromberg58'
+            'HOST': HOST_ADDRESS,  # '127.0.0.1'
+            'PORT': '5432',
+        }
+    }
+
+ALLOWED_HOSTS = [host for host in [HOST_ADDRESS, 'localhost', '127.0.0.1'] if host]
 
 INSTALLED_APPS = (
     'orm',
+    'gui',
 )
 
+ROOT_URLCONF = 'urls'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {},
+    },
+]
+
+# Rendered result fragments (see gui/views.py), keyed by the library generation so they never go stale
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'music-gui',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    }
+}
+
 SECRET_KEY = 'django-insecure-$4fy=p%n8^d(*wzxk32ylu!x)keef&463sl#%3_c6can@n5=-%'
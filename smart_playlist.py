@@ -0,0 +1,577 @@
+"""
+This module hosts the classes SongFeatures, PlaylistPick and SmartPlaylist.
+A smart playlist is described by constraints instead of a list of songs, e.g. "90 minutes of jazz from
+1955-1965, no artist twice in a row, at least 5 labels". SongFeatures loads the features the constraints
+need (duration, year, genre, artist, album, label) of every song into compact arrays, and SmartPlaylist
+picks and orders songs satisfying the constraints with randomised greedy attempts within a time budget.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import argparse
+import bisect
+import json
+import random
+import sys
+import time
+from array import array
+from collections import Counter, deque
+
+import application_imports  # NOQA # pylint: disable=unused-import, disable=import-error
+from orm.models import Song  # NOQA # pylint: disable=unused-import, disable=import-error
+from playlist_builder import PLAYLIST_FORMATS, PlaylistBuilder  # pylint: disable=import-error
+from search_query import SearchQuery  # pylint: disable=import-error
+from utils import log_it  # pylint: disable=import-error
+
+DB_FETCH_CHUNK = 5000
+DEFAULT_TOLERANCE = 60
+DEFAULT_BUDGET_MS = 500
+MIN_ATTEMPTS = 3
+
+# The ingest writes 1900 when the year of a song is not known:
+UNKNOWN_YEAR = 1900
+# Code of empty genres, artists and labels, which count neither for nor against a constraint:
+UNKNOWN = 0
+
+FEATURE_COLUMNS = ['id', 'duration', 'date__year', 'genre', 'artist', 'album_id', 'album__label']
+
+# Penalty of a constraint violation, in seconds of distance from the target duration:
+VIOLATION_PENALTY = 600
+
+
+class SongFeatures:
+    """
+    This class holds the playlist features of songs in parallel arrays, with text features
+    (genre, artist, label) encoded as integer codes.
+    """
+
+    def __init__(self):
+        self.song_ids = array('q')
+        self.durations = array('d')
+        self.years = array('h')
+        self.genres = array('l')
+        self.artists = array('l')
+        self.albums = array('q')
+        self.labels = array('l')
+        self.codes = {'genre': {}, 'artist': {}, 'label': {}}
+        self.names = {'genre': [''], 'artist': [''], 'label': ['']}
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def code(self, kind, value):
+        """
+        Get the code of a text feature, case and surrounding space being ignored.
+        :param kind: 'genre', 'artist' or 'label'
+        :param value: The text
+        :return: An int, UNKNOWN for an empty text
+        """
+        key = (value or '').strip().casefold()
+
+        if not key:
+            return UNKNOWN
+
+        codes = self.codes[kind]
+
+        if key not in codes:
+            codes[key] = len(self.names[kind])
+            self.names[kind].append(value.strip())
+
+        return codes[key]
+
+    def add(self, song_id, duration, year, genre, artist, album_id, label):  # pylint: disable=too-many-arguments
+        """
+        Add a song.
+        :param song_id: Song ID
+        :param duration: Duration in seconds
+        :param year: Year or None
+        :param genre: Genre text
+        :param artist: Artist text
+        :param album_id: Album ID or None
+        :param label: Label of the album
+        :return: void
+        """
+        self.song_ids.append(song_id)
+        self.durations.append(duration)
+        self.years.append(year if year and year != UNKNOWN_YEAR else 0)
+        self.genres.append(self.code('genre', genre))
+        self.artists.append(self.code('artist', artist))
+        self.albums.append(album_id or 0)
+        self.labels.append(self.code('label', label))
+
+    @classmethod
+    def load(cls, query=None):
+        """
+        Load the features of the songs of known duration from the DB.
+        :param query: A SearchQuery narrowing the songs or None for the whole library
+        :return: A SongFeatures instance
+        """
+        start = time.perf_counter()
+        features = cls()
+        songs = Song.objects.filter(duration__gt=0)  # NOQA
+
+        if query:
+            songs = songs.filter(query.to_q())
+
+        for row in songs.values_list(*FEATURE_COLUMNS).iterator(chunk_size=DB_FETCH_CHUNK):
+            features.add(*row)
+
+        log_it("info", __name__, f"Loaded {len(features)} songs in {round(time.perf_counter() - start, 3)} s")
+
+        return features
+
+    def select(self, years=None, genres=None):
+        """
+        Select songs by year and genre.
+        :param years: A tuple (first, last) of years, either of which may be None, or None for any year
+        :param genres: A list of texts, one of which must be part of the genre, or None for any genre
+        :return: A list of song indexes
+        """
+        first, last = years or (None, None)
+        genre_codes = None
+
+        if genres:
+            wanted = [genre.strip().casefold() for genre in genres if genre.strip()]
+            genre_codes = {code for name, code in self.codes['genre'].items() if any(w in name for w in wanted)}
+
+        selected = []
+
+        for ix in range(len(self.song_ids)):
+            year = self.years[ix]
+
+            if first is not None and (not year or year < first):
+                continue
+
+            if last is not None and (not year or year > last):
+                continue
+
+            if genre_codes is not None and self.genres[ix] not in genre_codes:
+                continue
+
+            selected.append(ix)
+
+        return selected
+
+
+class PlaylistPick:
+    """
+    This class holds the songs picked by an attempt of SmartPlaylist, with the counts its constraints check.
+    """
+
+    def __init__(self, playlist):
+        self.playlist = playlist
+        self.features = playlist.features
+        self.chosen = []
+        self.chosen_set = set()
+        self.per_artist = Counter()
+        self.per_album = Counter()
+        self.labels = set()
+        self.total = 0.0
+
+    def allowed(self, ix, extra=0.0):
+        """
+        Tell whether a song may be added.
+        :param ix: Song index
+        :param extra: Seconds added to the total duration (negative for a song about to be replaced)
+        :return: True if the song is not picked yet and does not break the duration or a cap
+        """
+        feat = self.features
+        playlist = self.playlist
+
+        if ix in self.chosen_set or self.total + extra + feat.durations[ix] > playlist.target + playlist.tolerance:
+            return False
+
+        if playlist.max_per_artist and feat.artists[ix] and \
+                self.per_artist[feat.artists[ix]] >= playlist.max_per_artist:
+            return False
+
+        return not (playlist.max_per_album and feat.albums[ix] and
+                    self.per_album[feat.albums[ix]] >= playlist.max_per_album)
+
+    def take(self, ix):
+        """
+        Add a song.
+        :param ix: Song index
+        :return: void
+        """
+        feat = self.features
+        self.chosen.append(ix)
+        self.chosen_set.add(ix)
+        self.per_artist[feat.artists[ix]] += 1
+        self.per_album[feat.albums[ix]] += 1
+        self.total += feat.durations[ix]
+
+        if feat.labels[ix]:
+            self.labels.add(feat.labels[ix])
+
+    def replace(self, pos, new_ix):
+        """
+        Replace a song by another one, keeping the total duration up to date.
+        :param pos: Position of the song in chosen
+        :param new_ix: Index of the new song
+        :return: void
+        """
+        old_ix = self.chosen[pos]
+        self.total += self.features.durations[new_ix] - self.features.durations[old_ix]
+        self.chosen_set.discard(old_ix)
+        self.chosen_set.add(new_ix)
+        self.chosen[pos] = new_ix
+
+
+class SmartPlaylist:
+    """
+    This class builds a playlist from SongFeatures, subject to constraints:
+    - total duration: minutes, within tolerance seconds,
+    - artist_gap: the number of following songs in which an artist must not appear again (0: no rule),
+    - min_labels: the minimum number of distinct labels,
+    - max_per_artist, max_per_album: caps on songs by one artist or from one album (0: no cap).
+    """
+
+    def __init__(self, features, minutes, tolerance=DEFAULT_TOLERANCE, artist_gap=1, min_labels=0,
+                 max_per_artist=0, max_per_album=0, seed=None):
+        self.features = features
+        self.target = minutes * 60
+        self.tolerance = tolerance
+        self.artist_gap = max(0, artist_gap)
+        self.min_labels = max(0, min_labels)
+        self.max_per_artist = max(0, max_per_artist)
+        self.max_per_album = max(0, max_per_album)
+        self.rng = random.Random(seed)
+
+    def attempt(self, candidates, by_duration):
+        """
+        Pick songs in a random order: first one per label until min_labels are covered, then any, until
+        the target duration is reached; then close the remaining gap with the best fitting song or swap.
+        :param candidates: A list of song indexes
+        :param by_duration: The candidates as (duration, index) tuples sorted by duration
+        :return: A list of song indexes (not ordered for play yet)
+        """
+        order = candidates[:]
+        self.rng.shuffle(order)
+        pick = PlaylistPick(self)
+
+        if self.min_labels:
+            self.cover_labels(pick, order)
+
+        for ix in order:
+            if pick.total >= self.target - self.tolerance:
+                break
+
+            if pick.allowed(ix):
+                pick.take(ix)
+
+        if pick.total < self.target - self.tolerance:
+            self.close_gap(pick, by_duration)
+
+        return pick.chosen
+
+    def cover_labels(self, pick, order):
+        """
+        Pick songs of labels not picked yet, until min_labels are covered.
+        :param pick: A PlaylistPick
+        :param order: Song indexes in the order to try them
+        :return: void
+        """
+        labels = self.features.labels
+
+        for ix in order:
+            if len(pick.labels) >= self.min_labels:
+                break
+
+            if labels[ix] and labels[ix] not in pick.labels and pick.allowed(ix):
+                pick.take(ix)
+
+    def close_gap(self, pick, by_duration):
+        """
+        Add the song closest to the gap left to the target duration, otherwise swap a picked song for a longer one.
+        :param pick: A PlaylistPick
+        :param by_duration: The candidates as (duration, index) tuples sorted by duration
+        :return: void
+        """
+        durations = self.features.durations
+        gap = self.target - pick.total
+        closest = self.closest(by_duration, gap, pick.allowed)
+
+        if closest is not None:
+            pick.take(closest)
+            return
+
+        for pos, old_ix in enumerate(pick.chosen):
+            new_ix = self.closest(by_duration, durations[old_ix] + gap,
+                                  lambda ix, old=old_ix: pick.allowed(ix, -durations[old]))
+
+            if new_ix is not None and durations[new_ix] > durations[old_ix]:
+                pick.replace(pos, new_ix)
+                return
+
+    def closest(self, by_duration, duration, accept, probes=64):
+        """
+        Find a song whose duration is close to the given one.
+        :param by_duration: Songs as (duration, index) tuples sorted by duration
+        :param duration: Wanted duration in seconds
+        :param accept: A function telling whether a song index may be used
+        :param probes: Max number of songs to look at on either side of the wanted duration
+        :return: A song index or None
+        """
+        pos = bisect.bisect_left(by_duration, (duration, -1))
+        best = None
+        best_diff = self.tolerance
+
+        above = range(pos, min(pos + probes, len(by_duration)))
+        below = range(pos - 1, max(pos - probes, 0) - 1, -1)
+
+        for ix in list(above) + list(below):
+            song_duration, song_ix = by_duration[ix]
+            diff = abs(song_duration - duration)
+
+            if diff <= best_diff and accept(song_ix):
+                best, best_diff = song_ix, diff
+
+        return best
+
+    def arrange(self, chosen):
+        """
+        Order songs so that an artist does not come back within artist_gap songs: at each step play the
+        artist with the most songs left among those not heard recently.
+        :param chosen: A list of song indexes
+        :return: A tuple (list of song indexes, number of artist gap violations)
+        """
+        feat = self.features
+        songs = chosen[:]
+        self.rng.shuffle(songs)
+
+        if not self.artist_gap:
+            return songs, 0
+
+        by_artist = {}
+        singles = []
+
+        for ix in songs:
+            if feat.artists[ix]:
+                by_artist.setdefault(feat.artists[ix], []).append(ix)
+            else:
+                singles.append(ix)
+
+        recent = deque(maxlen=self.artist_gap)
+        ordered = []
+        violations = 0
+
+        while by_artist or singles:
+            ready = [artist for artist in by_artist if artist not in recent]
+            ready_count = max((len(by_artist[artist]) for artist in ready), default=0)
+
+            if singles and len(singles) >= ready_count:
+                ordered.append(singles.pop())
+                recent.append(UNKNOWN)
+                continue
+
+            if not ready:
+                violations += 1
+                ready = list(by_artist)
+
+            best_count = max(len(by_artist[artist]) for artist in ready)
+            artist = self.rng.choice([artist for artist in ready if len(by_artist[artist]) == best_count])
+            ordered.append(by_artist[artist].pop())
+            recent.append(artist)
+
+            if not by_artist[artist]:
+                del by_artist[artist]
+
+        return ordered, violations
+
+    def assess(self, ordered, violations):
+        """
+        Score a playlist.
+        :param ordered: A list of song indexes in play order
+        :param violations: Number of artist gap violations
+        :return: A dictionary; 'penalty' is 0 if every constraint is met
+        """
+        feat = self.features
+        seconds = sum(feat.durations[ix] for ix in ordered)
+        labels = len({feat.labels[ix] for ix in ordered if feat.labels[ix]})
+        penalty = max(0.0, abs(seconds - self.target) - self.tolerance)
+        penalty += VIOLATION_PENALTY * (violations + max(0, self.min_labels - labels))
+
+        return {
+            'penalty': round(penalty, 3),
+            'seconds': round(seconds, 3),
+            'songs': len(ordered),
+            'labels': labels,
+            'artist_gap_violations': violations,
+        }
+
+    def solve(self, candidates=None, budget_ms=DEFAULT_BUDGET_MS):
+        """
+        Build the playlist: repeat randomised attempts until one meets every constraint or the time
+        budget is spent, and keep the best.
+        :param candidates: A list of song indexes (see SongFeatures.select()), all songs if None
+        :param budget_ms: Time budget in milliseconds
+        :return: A dictionary with the song IDs in play order and the assessment of the playlist
+        """
+        start = time.perf_counter()
+        feat = self.features
+        candidates = list(range(len(feat))) if candidates is None else candidates
+        by_duration = sorted((feat.durations[ix], ix) for ix in candidates)
+        best_order, best_score = [], None
+        attempts = 0
+
+        while candidates and (attempts < MIN_ATTEMPTS or (time.perf_counter() - start) * 1000 < budget_ms):
+            attempts += 1
+            ordered, violations = self.arrange(self.attempt(candidates, by_duration))
+            score = self.assess(ordered, violations)
+
+            if best_score is None or score['penalty'] < best_score['penalty']:
+                best_order, best_score = ordered, score
+
+            if not score['penalty']:
+                break
+
+        return {
+            'song_ids': [feat.song_ids[ix] for ix in best_order],
+            'complete': bool(best_score) and not best_score['penalty'],
+            'attempts': attempts,
+            'candidates': len(candidates),
+            'ms': round((time.perf_counter() - start) * 1000, 2),
+            **(best_score or self.assess([], 0)),
+        }
+
+
+def parse_years(in_years):
+    """
+    Parse a year range.
+    :param in_years: A string: 'YYYY', 'YYYY..YYYY', 'YYYY..' or '..YYYY'
+    :return: A tuple (first, last), either of which may be None
+    """
+    if not in_years:
+        return None, None
+
+    first, _, last = in_years.partition('..') if '..' in in_years else (in_years, '', in_years)
+
+    return int(first) if first.strip() else None, int(last) if last.strip() else None
+
+
+PROGRAM_DESCRIPTION = "This program builds a smart playlist: songs picked to satisfy duration, " \
+                      "year, genre, artist and label constraints."
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROGRAM_DESCRIPTION)
+    parser.add_argument("-m", "--minutes",
+                        help="Playlist duration in minutes.",
+                        type=float,
+                        dest='minutes',
+                        required=True)
+
+    parser.add_argument("-y", "--years",
+                        help="Year range, e.g. 1955..1965, 1960.. or 1972.",
+                        type=str,
+                        dest='years',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-g", "--genre",
+                        help="A genre (part of the genre text), repeat for several.",
+                        type=str,
+                        dest='genres',
+                        action='append',
+                        default=[],
+                        required=False)
+
+    parser.add_argument("-q", "--query",
+                        help="A field-scoped query narrowing the songs loaded from the DB, e.g. 'composer:mingus'.",
+                        type=str,
+                        dest='query',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-k", "--min_labels",
+                        help="Min number of distinct labels.",
+                        type=int,
+                        dest='min_labels',
+                        default=0,
+                        required=False)
+
+    parser.add_argument("-j", "--artist_gap",
+                        help="Number of following songs in which an artist may not appear again, 0 to allow "
+                             "repeats, default: 1 (no artist twice in a row).",
+                        type=int,
+                        dest='artist_gap',
+                        default=1,
+                        required=False)
+
+    parser.add_argument("-A", "--max_per_artist",
+                        help="Max number of songs by one artist, 0 for no limit.",
+                        type=int,
+                        dest='max_per_artist',
+                        default=0,
+                        required=False)
+
+    parser.add_argument("-B", "--max_per_album",
+                        help="Max number of songs from one album, 0 for no limit.",
+                        type=int,
+                        dest='max_per_album',
+                        default=0,
+                        required=False)
+
+    parser.add_argument("-e", "--tolerance",
+                        help=f"Allowed difference from the duration in seconds, default: {DEFAULT_TOLERANCE}",
+                        type=float,
+                        dest='tolerance',
+                        default=DEFAULT_TOLERANCE,
+                        required=False)
+
+    parser.add_argument("-b", "--budget",
+                        help=f"Time budget of the solver in milliseconds, default: {DEFAULT_BUDGET_MS}",
+                        type=int,
+                        dest='budget_ms',
+                        default=DEFAULT_BUDGET_MS,
+                        required=False)
+
+    parser.add_argument("-s", "--seed",
+                        help="Random seed, to get the same playlist again.",
+                        type=int,
+                        dest='seed',
+                        default=None,
+                        required=False)
+
+    parser.add_argument("-r", "--root",
+                        help="The library root: the directory containing the album directories.",
+                        type=str,
+                        dest='library_root',
+                        default='',
+                        required=False)
+
+    parser.add_argument("-t", "--format",
+                        help="Playlist format, default: xspf",
+                        type=str,
+                        dest='playlist_format',
+                        choices=PLAYLIST_FORMATS,
+                        default='xspf',
+                        required=False)
+
+    parser.add_argument("-o", "--output",
+                        help="Path to the playlist file, stdout if not provided.",
+                        type=str,
+                        dest='out_path',
+                        default='',
+                        required=False)
+
+    args = parser.parse_args()
+
+    song_features = SongFeatures.load(SearchQuery(args.query) if args.query else None)
+    smart_playlist = SmartPlaylist(song_features, args.minutes, tolerance=args.tolerance, artist_gap=args.artist_gap,
+                                   min_labels=args.min_labels, max_per_artist=args.max_per_artist,
+                                   max_per_album=args.max_per_album, seed=args.seed)
+    result = smart_playlist.solve(song_features.select(parse_years(args.years), args.genres), budget_ms=args.budget_ms)
+    print(json.dumps({k: v for k, v in result.items() if k != 'song_ids'}), file=sys.stderr)
+
+    builder = PlaylistBuilder(library_root=args.library_root)
+    playlist_rows = builder.song_rows_by_id(result['song_ids'])
+
+    if args.out_path:
+        with open(args.out_path, 'w', encoding="UTF-8") as out:
+            builder.write(out, playlist_format=args.playlist_format, rows=playlist_rows)
+    else:
+        builder.write(sys.stdout, playlist_format=args.playlist_format, rows=playlist_rows)
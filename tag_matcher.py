@@ -0,0 +1,122 @@
+"""
+This module hosts the class TagMatcher.
+A TagMatcher is compiled once per query and then tests tag dictionaries for one or more
+search terms (plain text or regex patterns).
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import re
+
+from utils import fold_text, log_it  # pylint: disable=import-error
+
+# Tag values are joined with this separator before a plain-text search, so a term cannot match across values:
+VALUE_SEPARATOR = '\x00'
+
+
+class TagMatcher:
+    """
+    This class encapsulates a matcher for many search terms at once.
+    Plain terms are compiled into one alternation, so that a single scan of the tag text finds any
+    of them; regex terms are compiled once each.
+    """
+
+    def __init__(self, terms, match_all=False, use_regex=False, ignore_case=False):
+        self._terms = []
+        self.match_all = match_all
+        self.use_regex = use_regex
+        self.ignore_case = ignore_case
+        self.terms = terms
+        self._any_rx = None
+        self._patterns = []
+        self.compile()
+
+    @property
+    def terms(self):
+        """
+        This property holds the search terms as a list of strings.
+        """
+        return self._terms
+
+    @terms.setter
+    def terms(self, in_terms):
+        if not in_terms:
+            in_terms = []
+
+        if isinstance(in_terms, str):
+            in_terms = [in_terms]
+
+        self._terms = [term for term in in_terms if term]
+
+    def fold(self, in_text):
+        """
+        Prepare text (tag values or plain search terms) for matching.
+        :param in_text: A string to prepare
+        :return: The text, case-folded and stripped of diacritics if the search ignores case
+        """
+        return fold_text(in_text) if self.ignore_case else in_text
+
+    def compile(self):
+        """
+        Compile the search terms.
+        :return: void
+        """
+        if self.use_regex:
+            flags = re.IGNORECASE if self.ignore_case else 0
+            self._patterns = []
+
+            for term in self.terms:
+                try:
+                    self._patterns.append(re.compile(term, flags))
+                except re.error as err:
+                    log_it('error', __name__, f"Bad pattern {term}: {err}")
+
+            return
+
+        self._patterns = list(dict.fromkeys(self.fold(term) for term in self.terms))
+        # Longest first, so the alternation prefers the longest term starting at a position:
+        self._any_rx = re.compile('|'.join(re.escape(term) for term in sorted(self._patterns, key=len, reverse=True)))
+
+    @staticmethod
+    def tag_values(in_tag_dict):
+        """
+        Get the searchable values from a tag dictionary.
+        :param in_tag_dict: A dictionary of tags
+        :return: A list of strings
+        """
+        return [val if isinstance(val, str) else str(val) for val in in_tag_dict.values() if val is not None]
+
+    def matches_text(self, in_text):
+        """
+        Test text for the search terms.
+        :param in_text: Text (already folded, see fold()) to search
+        :return: True if the text matches (any or all terms, see match_all), otherwise False
+        """
+        if len(self._patterns) == 1:
+            return self._patterns[0] in in_text
+
+        if not self.match_all:
+            return self._any_rx.search(in_text) is not None
+
+        return all(term in in_text for term in self._patterns)
+
+    def matches(self, in_tag_dict):
+        """
+        Test a tag dictionary for the search terms.
+        :param in_tag_dict: A dictionary of tags
+        :return: True if the tags match (any or all terms, see match_all), otherwise False
+        """
+        if not in_tag_dict or not self._patterns:
+            return False
+
+        values = self.tag_values(in_tag_dict)
+
+        if not self.use_regex:
+            return self.matches_text(self.fold(VALUE_SEPARATOR.join(values)))
+
+        found = (any(pattern.search(val) for val in values) for pattern in self._patterns)
+
+        return all(found) if self.match_all else any(found)
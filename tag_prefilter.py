@@ -0,0 +1,299 @@
+"""
+This module hosts the class TagPrefilter.
+A TagPrefilter looks for plain-text search terms in the raw bytes of the tag region of an audio
+file (ID3v2 frames, FLAC Vorbis comment block, ID3v1 tail), so that files which cannot match
+are rejected before their tags are decoded. Files whose ID3v2 tag or frames are unsynchronised, compressed
+or encrypted are not prefiltered, as their text is not stored as it is.
+"""
+###############################################################################
+#
+# Copyright (C) 2022-2024 Adam Bukolt.
+# All Rights Reserved.
+#
+###############################################################################
+import mmap
+import os
+import struct
+
+from utils import log_it  # pylint: disable=import-error
+
+try:
+    from tinytag.tinytag import _ID3  # pylint: disable=import-error
+    ID3_GENRES = " ".join(getattr(_ID3, '_ID3V1_GENRES', ()))
+except ImportError:
+    ID3_GENRES = ""
+
+ID3V2_HEADER_SIZE = 10
+ID3V2_FRAME_HEADER_SIZE = 10
+ID3V2_FLAG_UNSYNC = 0x80
+ID3V2_FLAG_EXTENDED = 0x40
+ID3V2_FLAG_FOOTER = 0x10
+# ID3v2.2 uses the extended header flag for a compressed tag:
+ID3V22_FLAG_COMPRESSED = 0x40
+# Frame format flags (second flag byte) under which the stored bytes differ from the text, per version:
+# ID3v2.3 compression and encryption, ID3v2.4 compression, encryption and unsynchronisation
+ID3V2_FRAME_TRANSFORMS = {3: 0x80 | 0x40, 4: 0x08 | 0x04 | 0x02}
+ID3V1_SIZE = 128
+FLAC_MAGIC = b'fLaC'
+FLAC_BLOCK_HEADER_SIZE = 4
+FLAC_VORBIS_COMMENT = 4
+
+# ID3v2 text frames are in one of these (UTF-16 with a BOM in either byte order), Vorbis comments in UTF-8:
+NEEDLE_ENCODINGS = ['utf-8', 'latin-1', 'utf-16-le', 'utf-16-be']
+
+# Decoded tag dictionaries also hold numbers (duration, bitrate, track, ...) and flags which never appear
+# as text in the tag bytes; terms which could be found there are not prefiltered:
+NUMERIC_CHARS = set('0123456789.+-e')
+NON_TAG_TEXT = "True False None inf nan"
+
+
+def synchsafe(in_bytes):
+    """
+    Decode an ID3v2 synchsafe integer (7 bits per byte).
+    :param in_bytes: The bytes of the integer
+    :return: An int
+    """
+    value = 0
+
+    for byte in in_bytes:
+        value = (value << 7) | (byte & 0x7f)
+
+    return value
+
+
+class TagPrefilter:
+    """
+    This class tests whether the tag bytes of an audio file can possibly contain the search terms.
+    A negative answer is definite, a positive one means the tags have to be decoded and searched.
+    """
+
+    def __init__(self, terms, match_all=False):
+        self.match_all = match_all
+        self.needles = []
+
+        for term in [terms] if isinstance(terms, str) else terms or []:
+            if term:
+                self.needles.append((term, self.encode(term)))
+
+    @staticmethod
+    def encode(in_term):
+        """
+        Encode a search term the ways it can be stored in a tag.
+        :param in_term: A string
+        :return: A list of distinct byte strings
+        """
+        encoded = []
+
+        for encoding in NEEDLE_ENCODINGS:
+            try:
+                needle = in_term.encode(encoding)
+            except UnicodeEncodeError:
+                continue
+
+            if needle not in encoded:
+                encoded.append(needle)
+
+        return encoded
+
+    @staticmethod
+    def decoded_only(in_term, has_id3):
+        """
+        Check whether a term may be found in decoded tags without being in the tag bytes.
+        :param in_term: A search term
+        :param has_id3: True if the file has ID3 tags (genre numbers are decoded to names)
+        :return: True if the term cannot be prefiltered
+        """
+        if set(in_term) <= NUMERIC_CHARS or in_term in NON_TAG_TEXT:
+            return True
+
+        return has_id3 and in_term in ID3_GENRES
+
+    @classmethod
+    def id3v2_region(cls, fh):
+        """
+        Find the ID3v2 tag at the start of a file.
+        :param fh: File opened in binary mode, positioned at the start
+        :return: A tuple (end of the tag, searchable) where end is 0 if there is no tag
+        """
+        header = fh.read(ID3V2_HEADER_SIZE)
+
+        if len(header) < ID3V2_HEADER_SIZE or not header.startswith(b'ID3'):
+            return 0, True
+
+        version, flags = header[3], header[5]
+        frames_end = ID3V2_HEADER_SIZE + synchsafe(header[6:10])
+        size = frames_end + (ID3V2_HEADER_SIZE if flags & ID3V2_FLAG_FOOTER else 0)
+
+        # Unsynchronised frames may have zero bytes inserted anywhere, a plain byte search would miss text:
+        if flags & ID3V2_FLAG_UNSYNC or (version == 2 and flags & ID3V22_FLAG_COMPRESSED):
+            return size, False
+
+        return size, cls.id3v2_frames_plain(fh, version, flags, frames_end)
+
+    @staticmethod
+    def id3v2_frames_plain(fh, version, flags, frames_end):
+        """
+        Check that no frame of an ID3v2 tag is stored compressed, encrypted or unsynchronised, i.e. that
+        the text of every frame is in the file as it is.
+        :param fh: File opened in binary mode, positioned after the tag header
+        :param version: Major version of the tag (2, 3 or 4)
+        :param flags: Flags of the tag header
+        :param frames_end: Position of the end of the frames (and padding)
+        :return: True if the frames can be searched as bytes
+        """
+        transforms = ID3V2_FRAME_TRANSFORMS.get(version)
+
+        if transforms is None:
+            # ID3v2.2 frames have no flags, an unknown version cannot be trusted:
+            return version == 2
+
+        pos = ID3V2_HEADER_SIZE
+
+        if flags & ID3V2_FLAG_EXTENDED:
+            ext_size = fh.read(4)
+
+            if len(ext_size) < 4:
+                return False
+
+            # The ID3v2.4 size includes the size field, the ID3v2.3 one does not:
+            pos += synchsafe(ext_size) if version == 4 else 4 + struct.unpack('>I', ext_size)[0]
+
+        while pos + ID3V2_FRAME_HEADER_SIZE <= frames_end:
+            fh.seek(pos)
+            frame_header = fh.read(ID3V2_FRAME_HEADER_SIZE)
+
+            # Padding (or a truncated file) ends the frames:
+            if len(frame_header) < ID3V2_FRAME_HEADER_SIZE or frame_header[0] == 0:
+                break
+
+            if frame_header[9] & transforms:
+                return False
+
+            frame_size = synchsafe(frame_header[4:8]) if version == 4 else struct.unpack('>I', frame_header[4:8])[0]
+            pos += ID3V2_FRAME_HEADER_SIZE + frame_size
+
+        return True
+
+    @staticmethod
+    def flac_region(fh, start):
+        """
+        Find the Vorbis comment block of a FLAC stream.
+        :param fh: File opened in binary mode
+        :param start: Position of the FLAC stream (after an ID3v2 tag if there is one)
+        :return: A tuple (start, end) of the block, (start, start) if there is none, or None if this is not FLAC
+        """
+        fh.seek(start)
+
+        if fh.read(len(FLAC_MAGIC)) != FLAC_MAGIC:
+            return None
+
+        pos = start + len(FLAC_MAGIC)
+
+        while True:
+            block_header = fh.read(FLAC_BLOCK_HEADER_SIZE)
+
+            if len(block_header) < FLAC_BLOCK_HEADER_SIZE:
+                return start, start
+
+            block_size = struct.unpack('>I', b'\x00' + block_header[1:])[0]
+            pos += FLAC_BLOCK_HEADER_SIZE
+
+            if block_header[0] & 0x7f == FLAC_VORBIS_COMMENT:
+                return pos, pos + block_size
+
+            if block_header[0] & 0x80:
+                return start, start
+
+            pos += block_size
+            fh.seek(pos)
+
+    def tag_regions(self, fh, file_size):
+        """
+        Find the parts of a file holding tags.
+        :param fh: File opened in binary mode, positioned at the start
+        :param file_size: Size of the file
+        :return: A tuple (list of (start, end) ranges to map, ID3v1 tag bytes, has ID3) or None if the file
+        format is not known or the tags cannot be searched as bytes
+        """
+        id3_end, searchable = self.id3v2_region(fh)
+
+        if not searchable:
+            return None
+
+        regions = [(0, min(id3_end, file_size))] if id3_end else []
+        flac = self.flac_region(fh, id3_end)
+        id3v1 = b''
+
+        if flac:
+            regions.append((flac[0], min(flac[1], file_size)))
+        elif id3_end or self.is_mpeg(fh):
+            if file_size >= ID3V1_SIZE:
+                fh.seek(file_size - ID3V1_SIZE)
+                id3v1 = fh.read(ID3V1_SIZE)
+                id3v1 = id3v1 if id3v1.startswith(b'TAG') else b''
+        else:
+            return None
+
+        return regions, id3v1, bool(id3_end or id3v1)
+
+    @staticmethod
+    def is_mpeg(fh):
+        """
+        Check for an MPEG audio frame sync at the start of a file without an ID3v2 tag.
+        :param fh: File opened in binary mode
+        :return: True if the file starts with an MPEG frame
+        """
+        fh.seek(0)
+        head = fh.read(2)
+
+        return len(head) == 2 and head[0] == 0xff and head[1] & 0xe0 == 0xe0
+
+    @staticmethod
+    def term_in_bytes(needles, tag_map, regions, id3v1):
+        """
+        Look for the encodings of a term in the tag bytes.
+        :return: True if one is found
+        """
+        for needle in needles:
+            if any(tag_map.find(needle, start, end) != -1 for start, end in regions if end > start):
+                return True
+
+            if id3v1 and needle in id3v1:
+                return True
+
+        return False
+
+    def may_match(self, f_path):
+        """
+        Test an audio file for the search terms.
+        :param f_path: Path to the file
+        :return: False if the tags of the file cannot contain the terms (any or all, see match_all), otherwise True
+        """
+        if not self.needles:
+            return True
+
+        try:
+            with open(f_path, 'rb') as fh:
+                file_size = os.fstat(fh.fileno()).st_size
+                layout = self.tag_regions(fh, file_size) if file_size else None
+
+                if not layout:
+                    return True
+
+                regions, id3v1, has_id3 = layout
+                map_len = max([end for _, end in regions] + [0])
+                tag_map = mmap.mmap(fh.fileno(), map_len, access=mmap.ACCESS_READ) if map_len else b''
+
+                try:
+                    found = (self.decoded_only(term, has_id3) or term in f_path
+                             or self.term_in_bytes(needles, tag_map, regions, id3v1)
+                             for term, needles in self.needles)
+
+                    return all(found) if self.match_all else any(found)
+                finally:
+                    if map_len:
+                        tag_map.close()
+
+        except (OSError, ValueError) as ex:
+            log_it("debug", __name__, repr(ex) + f" file: {f_path}")
+            return True
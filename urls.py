@@ -0,0 +1,8 @@
+"""
+URL configuration of the web GUI
+"""
+from django.urls import include, path
+
+urlpatterns = [
+    path('', include('gui.urls')),
+]
@@ -16,6 +16,7 @@ import logging
 import json
 import os
 import re
+import unicodedata
 from enum import Enum
 from ruamel.yaml import YAML
 from ruamel.yaml.parser import ParserError
@@ -27,6 +28,11 @@ OUT_RELATIVE_PATH = '/../out/'
 
 USE_FILE_EXTENSIONS = ["ape", "flac", "mp3", "ogg", "wma", "yml"]
 
+COMBINING_MARKS_RX = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]+')
+
+# Letters which Unicode does not decompose into a base letter and a diacritic:
+FOLD_LETTERS = {'ł': 'l', 'ø': 'o', 'đ': 'd', 'ħ': 'h', 'ı': 'i', 'ŧ': 't', 'æ': 'ae', 'œ': 'oe', 'þ': 'th'}
+
 
 def log_it(level='info', src_name=None, text=None):
     """
@@ -180,6 +186,26 @@ def last_dir_in_path(in_path: str):
     return in_path.split("/")[-1]
 
 
+def fold_text(in_text):
+    """
+    Fold text for case- and accent-insensitive matching: case-fold and strip diacritics (combining marks).
+    :param in_text: Text to fold
+    :return: Folded text as a string
+    """
+    in_text = str(in_text)
+
+    if in_text.isascii():
+        return in_text.lower()
+
+    in_text = in_text.casefold()
+
+    for letter, base in FOLD_LETTERS.items():
+        if letter in in_text:
+            in_text = in_text.replace(letter, base)
+
+    return COMBINING_MARKS_RX.sub('', unicodedata.normalize('NFKD', in_text))
+
+
 def eval_bool(in_value):
     """
     Evaluate the received value as a Boolean